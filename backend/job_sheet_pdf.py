@@ -0,0 +1,419 @@
+"""
+Job sheet PDF rendering
+Runs inside the PDF worker processes, so it only takes plain job/tenant dicts and returns bytes
+"""
+from datetime import datetime, timezone
+from functools import lru_cache
+from io import BytesIO
+import hashlib
+import json
+import os
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.lib.colors import HexColor, lightgrey
+from reportlab.lib.enums import TA_CENTER
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, PageBreak, HRFlowable
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+import qrcode
+import qrcode.image.svg
+
+# Bump whenever the layout changes so cached sheets are re-rendered
+TEMPLATE_VERSION = 1
+
+# Encoded QR images kept per process, keyed by payload and format
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', 4096))
+QR_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+# Everything render_job_sheet reads from the job; updated_at catches any other edit
+JOB_SHEET_FIELDS = (
+    "job_number", "tracking_token", "status", "customer", "device", "accessories", "problem_description",
+    "diagnosis", "repair", "delivery", "created_at", "updated_at"
+)
+
+# Colors
+PRIMARY_COLOR = HexColor("#2563eb")  # Blue
+DARK_COLOR = HexColor("#1e293b")  # Dark slate
+MUTED_COLOR = HexColor("#64748b")  # Slate
+LIGHT_BG = HexColor("#f8fafc")  # Light background
+BORDER_COLOR = HexColor("#e2e8f0")  # Border
+SUCCESS_COLOR = HexColor("#22c55e")  # Green
+AMBER_BG = HexColor("#fef3c7")  # Amber light
+AMBER_COLOR = HexColor("#f59e0b")
+GREEN_BG = HexColor("#dcfce7")  # Green light
+
+TERMS_TEXT = """
+    <b>Terms & Conditions:</b> 1. Please collect your device within 30 days of repair completion.
+    2. Warranty covers only the specific repair performed. 3. Data backup is the customer's responsibility.
+    4. We are not responsible for any pre-existing damage or defects. 5. Payment is due upon delivery.
+    """
+
+
+def job_sheet_key(job: dict, tenant: dict) -> str:
+    """Content hash of everything that ends up on a job sheet"""
+    content = {
+        "version": TEMPLATE_VERSION,
+        "job": {field: job.get(field) for field in JOB_SHEET_FIELDS},
+        "company_name": tenant.get("company_name"),
+        "settings": tenant.get("settings") or {}
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def tracking_payload(job: dict) -> str:
+    """What a job's QR code encodes: its job number and public tracking token, which never change"""
+    return f"{job['job_number']}|{job.get('tracking_token', '')}"
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_code(data: str, format: str = "png") -> bytes:
+    """Encoded QR image for a payload; format is png or svg"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=8,
+        border=2,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = BytesIO()
+    if format == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def generate_qr_code(data: str) -> BytesIO:
+    """Generate QR code as bytes"""
+    return BytesIO(qr_code(data))
+
+def card_style(background, border, padding: int, left_padding: int, *extra) -> TableStyle:
+    """Shaded, boxed table style shared by the section cards"""
+    return TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -1), background),
+        ('BOX', (0, 0), (-1, -1), 0.5, border),
+        ('TOPPADDING', (0, 0), (-1, -1), padding),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), padding),
+        ('LEFTPADDING', (0, 0), (-1, -1), left_padding),
+        *extra
+    ])
+
+
+class JobSheetStyles:
+    """Paragraph and table styles for job sheets; nothing in them depends on the tenant or the job"""
+
+    def __init__(self):
+        styles = getSampleStyleSheet()
+
+        self.company_style = ParagraphStyle(
+            'CompanyName',
+            parent=styles['Heading1'],
+            fontSize=22,
+            textColor=DARK_COLOR,
+            spaceAfter=2,
+            fontName='Helvetica-Bold'
+        )
+
+        self.section_title_style = ParagraphStyle(
+            'SectionTitle',
+            parent=styles['Heading2'],
+            fontSize=11,
+            textColor=PRIMARY_COLOR,
+            spaceBefore=12,
+            spaceAfter=6,
+            fontName='Helvetica-Bold',
+            borderPadding=5
+        )
+
+        self.label_style = ParagraphStyle('Label', parent=styles['Normal'], fontSize=9, textColor=MUTED_COLOR, fontName='Helvetica')
+        self.value_style = ParagraphStyle('Value', parent=styles['Normal'], fontSize=10, textColor=DARK_COLOR, fontName='Helvetica-Bold')
+        self.normal_style = ParagraphStyle('NormalText', parent=styles['Normal'], fontSize=10, textColor=DARK_COLOR, fontName='Helvetica')
+        self.small_style = ParagraphStyle('SmallText', parent=styles['Normal'], fontSize=8, textColor=MUTED_COLOR, fontName='Helvetica')
+        self.footer_style = ParagraphStyle(
+            'Footer',
+            parent=styles['Normal'],
+            fontSize=9,
+            textColor=MUTED_COLOR,
+            alignment=TA_CENTER,
+            fontName='Helvetica-Oblique'
+        )
+        self.job_number_style = ParagraphStyle('JN', fontSize=9, textColor=DARK_COLOR, alignment=TA_CENTER, fontName='Helvetica-Bold')
+        self.job_date_style = ParagraphStyle('JD', fontSize=8, textColor=MUTED_COLOR, alignment=TA_CENTER)
+        self.amount_style = ParagraphStyle('Amount', fontSize=12, textColor=SUCCESS_COLOR, fontName='Helvetica-Bold')
+        self.terms_style = ParagraphStyle('Terms', fontSize=7, textColor=MUTED_COLOR, fontName='Helvetica', leading=9)
+        self.sig_label_style = ParagraphStyle('SigLabel', fontSize=8, textColor=MUTED_COLOR, alignment=TA_CENTER)
+        self.sig_line_style = ParagraphStyle('SigLine', fontSize=10, textColor=DARK_COLOR, alignment=TA_CENTER)
+        self.generated_style = ParagraphStyle('GenDate', fontSize=7, textColor=lightgrey, alignment=TA_CENTER)
+
+        self.header_right_style = TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ])
+        self.main_header_style = TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
+        ])
+        self.side_by_side_style = TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ])
+        self.details_card_style = card_style(LIGHT_BG, BORDER_COLOR, 4, 8, ('RIGHTPADDING', (0, 0), (-1, -1), 8))
+        self.accessories_card_style = card_style(LIGHT_BG, BORDER_COLOR, 6, 8, ('RIGHTPADDING', (0, 0), (-1, -1), 8))
+        self.problem_card_style = card_style(AMBER_BG, AMBER_COLOR, 8, 10, ('RIGHTPADDING', (0, 0), (-1, -1), 10))
+        self.info_card_style = card_style(LIGHT_BG, BORDER_COLOR, 4, 8, ('VALIGN', (0, 0), (-1, -1), 'TOP'))
+        self.repair_card_style = card_style(GREEN_BG, SUCCESS_COLOR, 4, 8, ('VALIGN', (0, 0), (-1, -1), 'TOP'))
+        self.signature_style = TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('TOPPADDING', (0, 0), (-1, -1), 2),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+        ])
+
+
+@lru_cache(maxsize=1)
+def job_sheet_styles() -> JobSheetStyles:
+    """Built once per worker process and shared by every render"""
+    return JobSheetStyles()
+
+
+class JobSheetTemplate:
+    """
+    The shop's own text for one render, on top of the shared styles.
+    Flowables keep layout state once a document has placed them, so every render gets new ones.
+    """
+    titles = {
+        "customer": "👤 CUSTOMER DETAILS",
+        "device": "📱 DEVICE DETAILS",
+        "accessories": "🎒 ACCESSORIES RECEIVED",
+        "problem": "⚠️ PROBLEM DESCRIPTION",
+        "diagnosis": "🔍 DIAGNOSIS",
+        "repair": "🔧 REPAIR DETAILS",
+        "delivery": "📦 DELIVERY DETAILS",
+    }
+
+    def __init__(self, company_name: str, settings: dict):
+        self.styles = job_sheet_styles()
+
+        # Shop details
+        shop_details_parts = []
+        if settings.get("address", ""):
+            shop_details_parts.append(settings["address"])
+        if settings.get("phone", ""):
+            shop_details_parts.append(f"📞 {settings['phone']}")
+        if settings.get("email", ""):
+            shop_details_parts.append(f"✉ {settings['email']}")
+        shop_details = " | ".join(shop_details_parts)
+
+        self.company_name = company_name
+        self.shop_details = shop_details
+        self.footer_text = settings.get("footer_text", "Thank you for choosing us!")
+
+    def text(self, value: str, style: ParagraphStyle = None) -> Paragraph:
+        return Paragraph(value, style or self.styles.normal_style)
+
+    def title(self, name: str) -> Paragraph:
+        return Paragraph(self.titles[name], self.styles.section_title_style)
+
+    def label(self, text: str) -> Paragraph:
+        return Paragraph(text, self.styles.label_style)
+
+    def terms(self) -> Paragraph:
+        return Paragraph(TERMS_TEXT.strip(), self.styles.terms_style)
+
+    def signatures(self) -> Table:
+        return self.table([
+            [Paragraph("_" * 30, self.styles.sig_line_style), Paragraph("_" * 30, self.styles.sig_line_style)],
+            [Paragraph("Customer Signature", self.styles.sig_label_style), Paragraph("Authorized Signature", self.styles.sig_label_style)],
+        ], [87*mm, 87*mm], self.styles.signature_style)
+
+    def footer(self) -> Paragraph:
+        return Paragraph(self.footer_text, self.styles.footer_style)
+
+    def table(self, rows: list, col_widths: list, style: TableStyle, **kwargs) -> Table:
+        table = Table(rows, colWidths=col_widths, **kwargs)
+        table.setStyle(style)
+        return table
+
+    def header(self, job: dict) -> Table:
+        """Shop info on the left, tracking QR + job number + date on the right"""
+        company_name = Paragraph(self.company_name, self.styles.company_style)
+        shop_details = Paragraph(self.shop_details, self.styles.small_style) if self.shop_details else Spacer(1, 1)
+        header_left_table = Table([[company_name], [shop_details]], colWidths=[120*mm])
+
+        # QR code for public tracking
+        job_number = job['job_number']
+        qr_buffer = generate_qr_code(tracking_payload(job))
+        qr_image = Image(qr_buffer, width=22*mm, height=22*mm)
+        job_date = job['created_at'][:10] if job.get('created_at') else ""
+
+        header_right_table = self.table([
+            [qr_image],
+            [Paragraph(f"<b>{job_number}</b>", self.styles.job_number_style)],
+            [Paragraph(f"{job_date}", self.styles.job_date_style)]
+        ], [28*mm], self.styles.header_right_style)
+
+        return self.table([[header_left_table, header_right_table]], [145*mm, 30*mm], self.styles.main_header_style)
+
+
+def build_document(elements: list) -> bytes:
+    """Lay out flowables on A4 pages and return the PDF"""
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=A4,
+        rightMargin=15*mm,
+        leftMargin=15*mm,
+        topMargin=15*mm,
+        bottomMargin=15*mm
+    )
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+def render_job_sheet(job: dict, tenant: dict) -> bytes:
+    """Render the A4 job sheet for a job; tenant needs company_name and settings"""
+    return build_document(job_sheet_elements(job, tenant))
+
+
+def render_job_sheets(jobs: list, tenant: dict) -> bytes:
+    """Render several job sheets into one document, each starting on a new page"""
+    elements = []
+    for job in jobs:
+        if elements:
+            elements.append(PageBreak())
+        elements.extend(job_sheet_elements(job, tenant))
+    return build_document(elements)
+
+
+def job_sheet_elements(job: dict, tenant: dict) -> list:
+    """Flowables for one job sheet"""
+    t = JobSheetTemplate(tenant["company_name"], tenant.get("settings") or {})
+    styles = t.styles
+    elements = []
+
+    # ============ HEADER SECTION ============
+    elements.append(t.header(job))
+
+    # Divider line
+    elements.append(Spacer(1, 3*mm))
+    elements.append(HRFlowable(width="100%", thickness=1, color=BORDER_COLOR, spaceBefore=0, spaceAfter=8))
+
+    # ============ CUSTOMER & DEVICE SECTION (Side by Side) ============
+    customer = job["customer"]
+    device = job["device"]
+
+    # Customer info card
+    customer_rows = [
+        [t.title("customer")],
+        [t.text(f"<b>{customer['name']}</b>", styles.value_style)],
+        [t.text(f"📱 {customer['mobile']}")],
+    ]
+    if customer.get("email"):
+        customer_rows.append([t.text(f"✉ {customer['email']}")])
+    if customer.get("address"):
+        customer_rows.append([t.text(f"📍 {customer['address']}", styles.small_style)])
+    customer_table = t.table(customer_rows, [85*mm], styles.details_card_style)
+
+    # Device info card
+    device_rows = [
+        [t.title("device")],
+        [t.text(f"<b>{device['brand']} {device['model']}</b>", styles.value_style)],
+        [t.text(f"Type: {device['device_type']}")],
+    ]
+    if device.get("serial_imei"):
+        device_rows.append([t.text(f"IMEI/Serial: {device['serial_imei']}", styles.small_style)])
+    if device.get("condition"):
+        device_rows.append([t.text(f"Condition: {device['condition']}", styles.small_style)])
+    if device.get("password"):
+        device_rows.append([t.text(f"🔐 Password: {device['password']}", styles.small_style)])
+    if device.get("unlock_pattern"):
+        device_rows.append([t.text(f"🔓 Pattern: {device['unlock_pattern']}", styles.small_style)])
+    device_table = t.table(device_rows, [85*mm], styles.details_card_style)
+
+    # Side by side layout
+    elements.append(t.table([[customer_table, device_table]], [87*mm, 87*mm], styles.side_by_side_style, hAlign='LEFT'))
+    elements.append(Spacer(1, 4*mm))
+
+    # ============ ACCESSORIES SECTION ============
+    checked_accessories = [a["name"] for a in job.get("accessories", []) if a.get("checked")]
+    if checked_accessories:
+        elements.append(t.title("accessories"))
+        elements.append(t.table([[t.text(" • ".join(checked_accessories))]], [174*mm], styles.accessories_card_style))
+        elements.append(Spacer(1, 4*mm))
+
+    # ============ PROBLEM DESCRIPTION ============
+    elements.append(t.title("problem"))
+    elements.append(t.table([[t.text(job.get("problem_description", "N/A"))]], [174*mm], styles.problem_card_style))
+    elements.append(Spacer(1, 4*mm))
+
+    # ============ DIAGNOSIS SECTION ============
+    if job.get("diagnosis"):
+        diag = job["diagnosis"]
+        elements.append(t.title("diagnosis"))
+
+        diag_content = [
+            [t.label("Findings:"), t.text(diag.get("diagnosis", "N/A"))],
+            [t.label("Est. Cost:"), t.text(f"<b>₹{diag.get('estimated_cost', 0):,.2f}</b>", styles.value_style)],
+            [t.label("Timeline:"), t.text(diag.get("estimated_timeline", "N/A"))],
+        ]
+        if diag.get("parts_required"):
+            diag_content.append([t.label("Parts Needed:"), t.text(diag.get("parts_required", ""))])
+
+        elements.append(t.table(diag_content, [30*mm, 144*mm], styles.info_card_style))
+        elements.append(Spacer(1, 4*mm))
+
+    # ============ REPAIR SECTION ============
+    if job.get("repair"):
+        repair = job["repair"]
+        elements.append(t.title("repair"))
+
+        repair_content = [
+            [t.label("Work Done:"), t.text(repair.get("work_done", "N/A"))],
+        ]
+
+        # Parts used from inventory
+        if repair.get("parts_used") and len(repair["parts_used"]) > 0:
+            parts_text = ", ".join([f"{p.get('item_name', 'Part')} (×{p.get('quantity', 1)})" for p in repair["parts_used"]])
+            repair_content.append([t.label("Parts Used:"), t.text(parts_text)])
+
+        if repair.get("parts_replaced"):
+            repair_content.append([t.label("Other Parts:"), t.text(repair.get("parts_replaced", ""))])
+
+        repair_content.append([t.label("Final Amount:"), t.text(f"<b>₹{repair.get('final_amount', 0):,.2f}</b>", styles.amount_style)])
+
+        if repair.get("warranty_info"):
+            repair_content.append([t.label("Warranty:"), t.text(repair.get("warranty_info", ""))])
+
+        elements.append(t.table(repair_content, [30*mm, 144*mm], styles.repair_card_style))
+        elements.append(Spacer(1, 4*mm))
+
+    # ============ DELIVERY SECTION ============
+    if job.get("delivery"):
+        delivery = job["delivery"]
+        elements.append(t.title("delivery"))
+
+        delivery_content = [
+            [t.label("Delivered To:"), t.text(delivery.get("delivered_to", "N/A"))],
+            [t.label("Amount Received:"), t.text(f"<b>₹{delivery.get('amount_received', 0):,.2f}</b>", styles.value_style)],
+            [t.label("Payment Mode:"), t.text(delivery.get("payment_mode", "N/A").upper())],
+        ]
+        if delivery.get("payment_reference"):
+            delivery_content.append([t.label("Reference:"), t.text(delivery.get("payment_reference", ""))])
+        if delivery.get("delivery_notes"):
+            delivery_content.append([t.label("Notes:"), t.text(delivery.get("delivery_notes", ""))])
+
+        elements.append(t.table(delivery_content, [35*mm, 139*mm], styles.info_card_style))
+        elements.append(Spacer(1, 4*mm))
+
+    # ============ TERMS & CONDITIONS ============
+    elements.append(Spacer(1, 6*mm))
+    elements.append(t.terms())
+
+    # ============ SIGNATURE SECTION ============
+    elements.append(Spacer(1, 10*mm))
+    elements.append(t.signatures())
+
+    # ============ FOOTER ============
+    elements.append(Spacer(1, 8*mm))
+    elements.append(HRFlowable(width="100%", thickness=0.5, color=BORDER_COLOR, spaceBefore=0, spaceAfter=4))
+    elements.append(t.footer())
+    elements.append(Paragraph(f"Generated on {datetime.now(timezone.utc).strftime('%d %b %Y, %H:%M')} UTC", styles.generated_style))
+
+    return elements
@@ -0,0 +1,48 @@
+"""
+Resized WebP variants of job photos
+Runs on a worker thread, so it only takes paths and returns plain dicts
+"""
+import os
+from pathlib import Path
+from PIL import Image, ImageOps
+from pillow_heif import register_heif_opener
+
+# Lets Image.open read the HEIC photos iPhones upload; their variants are ordinary WebP
+register_heif_opener()
+
+# Longest edge in pixels; thumbnails cover the 120 px gallery tiles on 2x screens
+VARIANT_SIZES = {
+    "medium": int(os.environ.get('PHOTO_MEDIUM_SIZE', 1280)),
+    "thumb": int(os.environ.get('PHOTO_THUMB_SIZE', 240)),
+}
+WEBP_QUALITY = int(os.environ.get('PHOTO_WEBP_QUALITY', 80))
+
+
+def variant_filename(filename: str, name: str) -> str:
+    return f"{Path(filename).stem}_{name}.webp"
+
+
+def make_variants(source: Path, dest_dir: Path) -> dict:
+    """Write one WebP per VARIANT_SIZES into dest_dir, returning {name: {filename, size, width, height}}"""
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    largest = max(VARIANT_SIZES.values())
+    variants = {}
+    with Image.open(source) as original:
+        # JPEGs decode straight at a reduced scale instead of at full camera resolution
+        original.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+        # Largest first, so each smaller variant is resized from the previous one
+        for name, size in sorted(VARIANT_SIZES.items(), key=lambda item: -item[1]):
+            image.thumbnail((size, size), Image.LANCZOS)
+            path = dest_dir / variant_filename(source.name, name)
+            tmp_path = path.with_name(f".{path.name}.tmp")
+            image.save(tmp_path, "WEBP", quality=WEBP_QUALITY)
+            os.replace(tmp_path, path)
+            variants[name] = {
+                "filename": path.name,
+                "size": path.stat().st_size,
+                "width": image.width,
+                "height": image.height
+            }
+    return variants
@@ -1,28 +1,50 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Response, Header, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Router, Route
+from starlette.background import BackgroundTask
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import os
+import re
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from typing import Callable, List, Optional, Union
 import uuid
+import copy
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
-from io import BytesIO
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-import qrcode
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from job_sheet_pdf import render_job_sheet, render_job_sheets, job_sheet_key, tracking_payload, qr_code, QR_FORMATS
+from photo_variants import make_variants, variant_filename, VARIANT_SIZES
 import aiofiles
 import base64
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+from contextlib import asynccontextmanager
+import math
+import mimetypes
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+import tempfile
+import shutil
+import hashlib
+import json
+import zipfile
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -37,16 +59,79 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'aftersales-pro-secret-key-change-in-p
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
+# bcrypt runs on its own thread pool; this caps how many hashes run at once
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+
+# Job sheet PDFs: worker processes, how many renders may wait for one, and how long a render may take
+PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS', 2))
+PDF_RENDER_QUEUE_SIZE = int(os.environ.get('PDF_RENDER_QUEUE_SIZE', 16))
+PDF_RENDER_TIMEOUT_SECONDS = int(os.environ.get('PDF_RENDER_TIMEOUT_SECONDS', 30))
+
+# Rendered job sheets are kept on disk by content hash; least recently used files go past the size cap
+PDF_CACHE_DIR = Path(os.environ.get('PDF_CACHE_DIR', str(ROOT_DIR / "pdf_cache")))
+PDF_CACHE_MAX_MB = int(os.environ.get('PDF_CACHE_MAX_MB', 256))
+
+# Tracking QR images can also be written to disk (shared by workers, kept across restarts); empty disables
+QR_PERSIST_DIR = os.environ.get('QR_PERSIST_DIR', '')
+
+# Photo thumbnails/medium variants are made in the background, this many at a time
+PHOTO_VARIANT_WORKERS = int(os.environ.get('PHOTO_VARIANT_WORKERS', 2))
+
+# Bulk job sheet export: most jobs in one ZIP, and in one combined PDF (laid out in memory).
+# Exports running at once per worker, and the PDF workers they may keep busy between them, so
+# single job sheets always have the rest of the pool.
+BULK_EXPORT_MAX_JOBS = int(os.environ.get('BULK_EXPORT_MAX_JOBS', 5000))
+BULK_PDF_MAX_JOBS = int(os.environ.get('BULK_PDF_MAX_JOBS', 200))
+BULK_EXPORT_CONCURRENCY = int(os.environ.get('BULK_EXPORT_CONCURRENCY', 2))
+BULK_EXPORT_RENDER_SLOTS = int(os.environ.get('BULK_EXPORT_RENDER_SLOTS', max(1, PDF_RENDER_WORKERS // 2)))
+
+# In-process caches
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 60))
+PLAN_CACHE_SIZE = int(os.environ.get('PLAN_CACHE_SIZE', 10000))
+PLAN_CACHE_TTL_SECONDS = int(os.environ.get('PLAN_CACHE_TTL_SECONDS', 300))
+USAGE_CACHE_TTL_SECONDS = int(os.environ.get('USAGE_CACHE_TTL_SECONDS', 10))
+TRACKING_CACHE_SIZE = int(os.environ.get('TRACKING_CACHE_SIZE', 10000))
+TRACKING_CACHE_TTL_SECONDS = int(os.environ.get('TRACKING_CACHE_TTL_SECONDS', 30))
+
+# How often tenant_usage counters are recounted from the source collections (0 disables)
+USAGE_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('USAGE_RECONCILE_INTERVAL_SECONDS', 3600))
+
+# Super admin analytics rollups: refresh period (0 disables) and how far behind "now" a refresh
+# stops, so documents still being written are picked up by the next run
+ANALYTICS_ROLLUP_INTERVAL_SECONDS = int(os.environ.get('ANALYTICS_ROLLUP_INTERVAL_SECONDS', 300))
+ANALYTICS_ROLLUP_LAG_SECONDS = int(os.environ.get('ANALYTICS_ROLLUP_LAG_SECONDS', 60))
+
+# Rate limiting of the unauthenticated endpoints. Budgets are kept in this process unless
+# RATE_LIMIT_REDIS_URL points every worker at a shared Redis. Clients are told apart by the
+# X-Forwarded-For entry added by the last RATE_LIMIT_PROXY_HOPS proxies (0 uses the socket peer).
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', '')
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get('RATE_LIMIT_PROXY_HOPS', 1))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 100000))
+
 # Upload directory for photos
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Where uploads and variants are written before being moved into storage; keep it on the same
+# filesystem as UPLOAD_DIR so the local backend can rename instead of copy
+UPLOAD_STAGING_DIR = Path(os.environ.get('UPLOAD_STAGING_DIR', str(ROOT_DIR / "upload_staging")))
+UPLOAD_STAGING_DIR.mkdir(parents=True, exist_ok=True)
+
+# Photo storage: "local" (UPLOAD_DIR, served by this app) or "s3" (any S3-compatible store; set
+# S3_ENDPOINT_URL for MinIO and the like, credentials come from the usual AWS environment variables)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+S3_REGION = os.environ.get('S3_REGION') or None
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 32))
+S3_MULTIPART_THRESHOLD_MB = int(os.environ.get('S3_MULTIPART_THRESHOLD_MB', 8))
+S3_PRESIGN_EXPIRES_SECONDS = int(os.environ.get('S3_PRESIGN_EXPIRES_SECONDS', 3600))
+
 # Create the main app
 app = FastAPI(title="AfterSales.pro API")
 
-# Mount static files for uploads
-app.mount("/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
-
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
@@ -238,6 +323,10 @@ class JobResponse(BaseModel):
     updated_at: str
     tracking_token: Optional[str] = None  # For public tracking
 
+class JobPage(BaseModel):
+    jobs: List[JobResponse]
+    next_cursor: Optional[str] = None  # Pass back as ?cursor= for the next page; None on the last page
+
 class SettingsUpdate(BaseModel):
     company_name: Optional[str] = None
     logo_url: Optional[str] = None
@@ -503,6 +592,270 @@ We reserve the right to modify this disclaimer at any time without prior notice.
 """
 }
 
+# ==================== IN-PROCESS CACHES ====================
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire ttl seconds after being stored"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Drop every entry whose value matches predicate"""
+        for key in [k for k, (value, _) in self._data.items() if predicate(value)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0
+        }
+
+# Authenticated user documents keyed by user_id
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+# Resolved subscription plans keyed by tenant_id, stamped with plan_cache_version
+plan_cache = TTLCache(maxsize=PLAN_CACHE_SIZE, ttl=PLAN_CACHE_TTL_SECONDS)
+plan_cache_version = 0
+
+def bump_plan_version(tenant_id: Optional[str] = None):
+    """Invalidate one tenant's cached plan, or every tenant's when a plan definition changes"""
+    global plan_cache_version
+    if tenant_id:
+        plan_cache.invalidate(tenant_id)
+    else:
+        plan_cache_version += 1
+
+# tenant_usage documents keyed by tenant_id; short-lived since other workers update them too
+usage_cache = TTLCache(maxsize=PLAN_CACHE_SIZE, ttl=USAGE_CACHE_TTL_SECONDS)
+
+# Public tracking responses keyed by "job_number:tracking_token". Status, diagnosis and repair edits all
+# go through update_job_with_status, which drops the job's entry, and renaming the shop drops all of its
+# entries; other workers pick either up within the TTL
+tracking_cache = TTLCache(maxsize=TRACKING_CACHE_SIZE, ttl=TRACKING_CACHE_TTL_SECONDS)
+
+def tracking_cache_key(job_number: str, tracking_token: str) -> str:
+    return f"{job_number}:{tracking_token}"
+
+def invalidate_tenant_tracking(tenant_id: str):
+    """Drop a tenant's cached tracking responses, which all carry its company name"""
+    tracking_cache.invalidate_where(lambda entry: entry["tenant_id"] == tenant_id)
+
+# Reported by the super admin system endpoint
+CACHES = {
+    "users": user_cache,
+    "plans": plan_cache,
+    "usage": usage_cache,
+    "tracking": tracking_cache,
+}
+
+# ==================== RATE LIMITING ====================
+# Each rule gives every client IP a token bucket (per_ip requests a minute, up to burst at once)
+# and can cap the route as a whole at route requests a minute, so a scraper rotating IPs still
+# can't turn a public endpoint into a flood of MongoDB queries. Login rules also give every
+# IP+account pair its own, smaller bucket (per_account, account_burst). With failures_only, a
+# request that succeeds hands its tokens back, so only failed guesses use up a client's budget.
+
+def rate_limit_rule(name: str, per_ip: int, burst: int, route: int = 0, per_account: int = 0,
+                    account_burst: int = 0, failures_only: bool = False) -> dict:
+    prefix = f"RATE_LIMIT_{name.upper()}"
+    return {
+        "per_ip": int(os.environ.get(f"{prefix}_PER_IP", per_ip)),
+        "burst": int(os.environ.get(f"{prefix}_BURST", burst)),
+        "route": int(os.environ.get(f"{prefix}_ROUTE", route)),
+        "per_account": int(os.environ.get(f"{prefix}_PER_ACCOUNT", per_account)),
+        "account_burst": int(os.environ.get(f"{prefix}_ACCOUNT_BURST", account_burst)),
+        "failures_only": failures_only
+    }
+
+RATE_LIMITS = {
+    # Guessing one account runs out of its IP+account budget long before the IP's own, which
+    # still stops a client spraying a password across many accounts by changing the email
+    "login": rate_limit_rule("login", per_ip=60, burst=30, route=3000, per_account=20, account_burst=10,
+                             failures_only=True),
+    "super_admin_login": rate_limit_rule("super_admin_login", per_ip=10, burst=10, route=300, per_account=5,
+                                         account_burst=5, failures_only=True),
+    "track": rate_limit_rule("track", per_ip=30, burst=10, route=6000, failures_only=True),
+    "check_subdomain": rate_limit_rule("check_subdomain", per_ip=30, burst=10, route=3000),
+    "legal": rate_limit_rule("legal", per_ip=60, burst=20, route=6000),
+    "plans": rate_limit_rule("plans", per_ip=60, burst=20, route=6000),
+}
+
+class TokenBucketLimiter:
+    """Token buckets kept in this process: two numbers per key, least recently seen keys dropped past maxsize"""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+
+    async def hit(self, key: str, per_minute: int, burst: int) -> tuple:
+        """Take a token; returns (0 if allowed, otherwise the seconds until one is available, the slot to refund)"""
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * per_minute / 60)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) * 60 / per_minute
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.maxsize:
+            self.buckets.popitem(last=False)
+        return retry_after, key
+
+    async def refund(self, slot: str, burst: int):
+        if slot in self.buckets:
+            tokens, last = self.buckets[slot]
+            self.buckets[slot] = (min(burst, tokens + 1), last)
+
+class RedisWindowLimiter:
+    """Sliding windows shared by every worker through Redis. Each key has a counter for this minute and
+    the last; the estimate weights the last minute by how much of it still falls in the window."""
+    def __init__(self, client):
+        self.client = client
+
+    async def hit(self, key: str, per_minute: int, burst: int) -> tuple:
+        now = time.time()
+        window, elapsed = divmod(now, 60)
+        current_key, previous_key = f"ratelimit:{key}:{int(window)}", f"ratelimit:{key}:{int(window) - 1}"
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.incr(current_key)
+            pipe.expire(current_key, 120)
+            pipe.get(previous_key)
+            current, _, previous = await pipe.execute()
+        estimate = int(previous or 0) * (1 - elapsed / 60) + current
+        # The burst allowance lets a quiet client catch up, like a full token bucket would
+        if estimate <= per_minute + burst:
+            return 0.0, current_key
+        return 60 - elapsed, current_key
+
+    async def refund(self, slot: str, burst: int):
+        """Give back a hit in the minute it was counted in, which may already be the previous one"""
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.decr(slot)
+            pipe.expire(slot, 120)
+            await pipe.execute()
+
+local_rate_limiter = TokenBucketLimiter(RATE_LIMIT_MAX_CLIENTS)
+rate_limiter = RedisWindowLimiter(aioredis.from_url(RATE_LIMIT_REDIS_URL)) if RATE_LIMIT_REDIS_URL else local_rate_limiter
+
+# Per-rule counters for this worker, reported by the super admin system endpoint
+rate_limit_stats = {
+    name: {"allowed": 0, "refunded": 0, "rejected_ip": 0, "rejected_account": 0, "rejected_route": 0}
+    for name in RATE_LIMITS
+}
+
+def client_ip(request: Request) -> str:
+    forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+    if RATE_LIMIT_PROXY_HOPS and len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+        return forwarded[-RATE_LIMIT_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+async def rate_limit_hit(key: str, per_minute: int, burst: int) -> tuple:
+    """(seconds to wait or 0, receipt for rate_limit_refund)"""
+    try:
+        retry_after, slot = await rate_limiter.hit(key, per_minute, burst)
+        return retry_after, (rate_limiter, slot, burst)
+    except RedisError as e:
+        # Keep limiting on this worker's own buckets rather than letting everything through
+        logger.warning(f"Shared rate limiter unavailable, using in-process buckets: {e}")
+        retry_after, slot = await local_rate_limiter.hit(key, per_minute, burst)
+        return retry_after, (local_rate_limiter, slot, burst)
+
+async def rate_limit_refund(receipt: tuple):
+    limiter, slot, burst = receipt
+    try:
+        await limiter.refund(slot, burst)
+    except RedisError as e:
+        logger.warning(f"Shared rate limiter unavailable, token not refunded: {e}")
+
+async def login_account(request: Request) -> str:
+    """subdomain:email of a login attempt, from the body FastAPI has already read for the handler"""
+    try:
+        body = await request.json()
+    except ValueError:
+        return ""
+    if not isinstance(body, dict):
+        return ""
+    return f"{str(body.get('subdomain', '')).lower()}:{str(body.get('email', '')).lower()}"
+
+def rate_limit(name: str, key: Optional[Callable] = None):
+    """Dependency that rejects a request with 429 once its client or route is over the budget of rule name.
+    key(request) names the account a request is for, e.g. the one it is logging into, for the
+    rule's per-account budget."""
+    rule = RATE_LIMITS[name]
+    stats = rate_limit_stats[name]
+
+    async def check(request: Request):
+        if not RATE_LIMIT_ENABLED:
+            yield
+            return
+        client = client_ip(request)
+        # Narrowest budget last: the IP's bucket is checked before an attacker-chosen account
+        # can add one, so nobody can churn the in-process buckets faster than per_ip allows
+        budgets = [("ip", f"{name}:ip:{client}", rule["per_ip"], rule["burst"])]
+        if key and rule["per_account"]:
+            budgets.append(("account", f"{name}:account:{client}:{await key(request)}",
+                            rule["per_account"], rule["account_burst"]))
+        if rule["route"]:
+            budgets.append(("route", f"{name}:route", rule["route"], rule["route"]))
+        receipts = []
+        for scope, bucket, per_minute, burst in budgets:
+            retry_after, receipt = await rate_limit_hit(bucket, per_minute, burst)
+            if retry_after:
+                # Only the budget that ran out is charged for a rejected request
+                for taken in receipts:
+                    await rate_limit_refund(taken)
+                stats[f"rejected_{scope}"] += 1
+                raise HTTPException(status_code=429, detail="Too many requests, please retry shortly",
+                                    headers={"Retry-After": str(math.ceil(retry_after))})
+            receipts.append(receipt)
+        stats["allowed"] += 1
+        # A handler that raises (bad password, unknown token) never gets past the yield
+        yield
+        if rule["failures_only"]:
+            for receipt in receipts:
+                await rate_limit_refund(receipt)
+            stats["refunded"] += 1
+    return check
+
 # ==================== AUTH HELPERS ====================
 
 def hash_password(password: str) -> str:
@@ -511,6 +864,17 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+# A bcrypt call takes ~250ms of CPU; async handlers must not run it on the event loop
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+async def hash_password_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, hash_password, password)
+
+async def verify_password_async(password: str, hashed: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, verify_password, password, hashed)
+
 def create_token(user_id: str, tenant_id: str, role: str) -> str:
     payload = {
         "user_id": user_id,
@@ -523,10 +887,14 @@ def create_token(user_id: str, tenant_id: str, role: str) -> str:
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        user = user_cache.get(payload["user_id"])
+        if user is None:
+            user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            user_cache.set(payload["user_id"], user)
+        # Handlers get their own copy so the cached document is never mutated
+        return dict(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
@@ -537,11 +905,228 @@ async def require_admin(user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Admin access required")
     return user
 
+# ==================== TENANT USAGE ====================
+
+def usage_month(timestamp: Optional[str] = None) -> str:
+    """YYYY-MM bucket for jobs_by_month, from an ISO timestamp or the current UTC time"""
+    return timestamp[:7] if timestamp else datetime.now(timezone.utc).strftime("%Y-%m")
+
+async def stored_photo_bytes(tenant_id: str) -> int:
+    """Bytes of a tenant's photo blobs and their variants, each stored file counted once"""
+    async for row in db.photo_blobs.aggregate([
+        {"$match": {"tenant_id": tenant_id}},
+        {"$group": {"_id": None, "bytes": {"$sum": {"$add": ["$size", {"$ifNull": ["$variants_size", 0]}]}}}}
+    ]):
+        return row["bytes"]
+    return 0
+
+async def reconcile_tenant_usage(tenant_id: str) -> dict:
+    """Recount a tenant's usage from the source collections and store it; returns any drift found"""
+    previous = await db.tenant_usage.find_one({"tenant_id": tenant_id}, {"_id": 0})
+    jobs_by_month = {}
+    async for row in db.jobs.aggregate([
+        {"$match": {"tenant_id": tenant_id}},
+        {"$group": {"_id": {"$substr": ["$created_at", 0, 7]}, "count": {"$sum": 1}}}
+    ]):
+        jobs_by_month[row["_id"]] = row["count"]
+
+    usage = {
+        "users": await db.users.count_documents({"tenant_id": tenant_id}),
+        "branches": await db.branches.count_documents({"tenant_id": tenant_id}),
+        "inventory_items": await db.inventory.count_documents({"tenant_id": tenant_id}),
+        "jobs_by_month": jobs_by_month,
+        "storage_bytes": await stored_photo_bytes(tenant_id)
+    }
+
+    now = datetime.now(timezone.utc).isoformat()
+    if previous is None:
+        try:
+            await db.tenant_usage.insert_one({"tenant_id": tenant_id, **usage, "reconciled_at": now, "updated_at": now})
+        except DuplicateKeyError:
+            # A concurrent recount created it first; correct that one instead
+            return await reconcile_tenant_usage(tenant_id)
+        usage_cache.invalidate(tenant_id)
+        return {}
+
+    # The correction is applied as $inc against the snapshot read before counting, so a bump_usage
+    # that lands while the counts run is kept rather than overwritten
+    deltas, drift = {}, {}
+    for field in ("users", "branches", "inventory_items", "storage_bytes"):
+        if previous.get(field) != usage[field]:
+            deltas[field] = usage[field] - (previous.get(field) or 0)
+            drift[field] = {"stored": previous.get(field), "actual": usage[field]}
+    stored_months = previous.get("jobs_by_month", {})
+    for month in set(stored_months) | set(jobs_by_month):
+        if stored_months.get(month, 0) != jobs_by_month.get(month, 0):
+            deltas[f"jobs_by_month.{month}"] = jobs_by_month.get(month, 0) - stored_months.get(month, 0)
+    if stored_months != jobs_by_month:
+        drift["jobs_by_month"] = {"stored": stored_months, "actual": jobs_by_month}
+
+    update = {"$set": {"reconciled_at": now}}
+    if deltas:
+        update = {"$inc": deltas, "$set": {"reconciled_at": now, "updated_at": now}}
+    await db.tenant_usage.update_one({"tenant_id": tenant_id}, update)
+    usage_cache.invalidate(tenant_id)
+    return drift
+
+async def reconcile_all_tenant_usage() -> dict:
+    """Reconcile every tenant, returning the tenants whose counters had drifted"""
+    checked, drifted = 0, {}
+    async for tenant in db.tenants.find({}, {"_id": 0, "id": 1}):
+        drift = await reconcile_tenant_usage(tenant["id"])
+        checked += 1
+        if drift:
+            drifted[tenant["id"]] = drift
+    if drifted:
+        logger.warning(f"Repaired usage counter drift for {len(drifted)} of {checked} tenants")
+    return {"tenants_checked": checked, "drifted": drifted}
+
+async def usage_reconciliation_loop():
+    while True:
+        await asyncio.sleep(USAGE_RECONCILE_INTERVAL_SECONDS)
+        try:
+            # One worker recounts per interval: the lease isn't released, so it expires an interval later
+            if await acquire_lease(TASK_LEASES, "usage_reconciliation", USAGE_RECONCILE_INTERVAL_SECONDS):
+                async with holding_lease(TASK_LEASES, "usage_reconciliation", USAGE_RECONCILE_INTERVAL_SECONDS):
+                    await reconcile_all_tenant_usage()
+        except LeaseLost:
+            logger.error("Lost the usage reconciliation lease part way, leaving the rest to the new holder")
+        except PyMongoError as e:
+            logger.error(f"Usage reconciliation failed: {e}")
+
+async def bump_usage(tenant_id: str, deltas: dict):
+    """Atomically apply counter deltas, e.g. {"users": 1} or {"jobs_by_month.2025-01": 1}"""
+    result = await db.tenant_usage.update_one(
+        {"tenant_id": tenant_id},
+        {"$inc": deltas, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    if result.matched_count == 0:
+        # No document yet - a full recount already includes this change
+        await reconcile_tenant_usage(tenant_id)
+    usage_cache.invalidate(tenant_id)
+
+async def get_tenant_usage(tenant_id: str) -> dict:
+    """Current usage counters for a tenant, creating the document on first use"""
+    usage = usage_cache.get(tenant_id)
+    if usage is not None:
+        return usage
+    usage = await db.tenant_usage.find_one({"tenant_id": tenant_id}, {"_id": 0})
+    if not usage:
+        await reconcile_tenant_usage(tenant_id)
+        usage = await db.tenant_usage.find_one({"tenant_id": tenant_id}, {"_id": 0})
+    usage_cache.set(tenant_id, usage)
+    return usage
+
+# ==================== JOB DAILY STATS ====================
+# job_daily_stats holds one counter per (tenant, day the job was created, branch, current status).
+# Creating a job increments its bucket; a status change moves it from the old status to the new one.
+# Dashboards read these small documents instead of grouping over every job.
+
+JOB_STATS_FIELDS = {"_id": 0, "tenant_id": 1, "branch_id": 1, "status": 1, "created_at": 1}
+
+def job_stats_bucket(job: dict, job_status: str) -> dict:
+    return {
+        "tenant_id": job["tenant_id"],
+        "date": job["created_at"][:10],
+        "branch_id": job.get("branch_id"),
+        "status": job_status
+    }
+
+async def record_job_created(job: dict):
+    await db.job_daily_stats.update_one(job_stats_bucket(job, job["status"]), {"$inc": {"count": 1}}, upsert=True)
+
+async def record_job_transition(job: dict, new_status: str, session=None):
+    """Move a job (as it was before the update) from its old status bucket to new_status"""
+    if job.get("status") == new_status:
+        return
+    await db.job_daily_stats.bulk_write([
+        UpdateOne(job_stats_bucket(job, job["status"]), {"$inc": {"count": -1}}, upsert=True),
+        UpdateOne(job_stats_bucket(job, new_status), {"$inc": {"count": 1}}, upsert=True)
+    ], ordered=False, session=session)
+
+async def update_job_with_status(job_id: str, update: dict, session=None, fields: Optional[dict] = None) -> Optional[dict]:
+    """Apply an update that sets $set.status, reading the previous status in the same operation.
+    Returns the job as it was before the update, with any extra fields asked for."""
+    previous = await db.jobs.find_one_and_update(
+        {"id": job_id}, update, projection={**JOB_STATS_FIELDS, "job_number": 1, "tracking_token": 1, **(fields or {})},
+        session=session
+    )
+    if previous:
+        await record_job_transition(previous, update["$set"]["status"], session=session)
+        tracking_cache.invalidate(tracking_cache_key(previous["job_number"], previous.get("tracking_token", "")))
+    return previous
+
+async def job_daily_counts(match: dict, since: Optional[str] = None) -> tuple:
+    """Current status counts and per-day created counts (days >= since) in a single rollup read"""
+    by_status, by_date = {}, {}
+    async for row in db.job_daily_stats.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "status": "$status",
+                "date": {"$cond": [{"$gte": ["$date", since]}, "$date", None]} if since else None
+            },
+            "count": {"$sum": "$count"}
+        }}
+    ]):
+        job_status, date = row["_id"]["status"], row["_id"].get("date")
+        if not row["count"]:
+            continue
+        by_status[job_status] = by_status.get(job_status, 0) + row["count"]
+        if date:
+            by_date[date] = by_date.get(date, 0) + row["count"]
+    return by_status, by_date
+
+async def rebuild_job_daily_stats() -> int:
+    """Recompute job_daily_stats from the jobs collection, one tenant at a time"""
+    buckets = 0
+    async for tenant in db.tenants.find({}, {"_id": 0, "id": 1}):
+        buckets += await rebuild_tenant_job_daily_stats(tenant["id"])
+    return buckets
+
+async def rebuild_tenant_job_daily_stats(tenant_id: str) -> int:
+    """Overwrite a tenant's buckets in place, so dashboards never read an emptied collection mid-rebuild"""
+    rows = await db.jobs.aggregate([
+        {"$match": {"tenant_id": tenant_id}},
+        {"$group": {
+            "_id": {
+                "date": {"$substr": ["$created_at", 0, 10]},
+                "branch_id": "$branch_id",
+                "status": "$status"
+            },
+            "count": {"$sum": 1}
+        }}
+    ]).to_list(None)
+    counts = {
+        (row["_id"]["date"], row["_id"].get("branch_id"), row["_id"]["status"]): row["count"] for row in rows
+    }
+    writes = []
+    async for bucket in db.job_daily_stats.find({"tenant_id": tenant_id}, {"date": 1, "branch_id": 1, "status": 1, "count": 1}):
+        key = (bucket["date"], bucket.get("branch_id"), bucket["status"])
+        if key not in counts:
+            # Matching on count leaves the bucket alone if a job landed in it since the aggregation
+            writes.append(DeleteOne({"_id": bucket["_id"], "count": bucket["count"]}))
+    for (date, branch_id, job_status), count in counts.items():
+        writes.append(UpdateOne(
+            {"tenant_id": tenant_id, "date": date, "branch_id": branch_id, "status": job_status},
+            {"$set": {"count": count}},
+            upsert=True
+        ))
+    for i in range(0, len(writes), 500):
+        await db.job_daily_stats.bulk_write(writes[i:i + 500], ordered=False)
+    return len(counts)
+
 # ==================== PLAN LIMIT ENFORCEMENT ====================
 
 async def get_tenant_plan(tenant_id: str) -> dict:
-    """Get the current plan for a tenant"""
-    tenant = await db.tenants.find_one({"id": tenant_id}, {"_id": 0})
+    """Get the current plan for a tenant (served from plan_cache while its version is current)"""
+    cached = plan_cache.get(tenant_id)
+    if cached and cached["version"] == plan_cache_version:
+        # Callers get their own copy, features included, so the cached plan is never mutated
+        return copy.deepcopy(cached["plan"])
+    version = plan_cache_version
+    
+    tenant = await db.tenants.find_one({"id": tenant_id}, {"_id": 0, "id": 1, "subscription_plan": 1})
     if not tenant:
         return None
     
@@ -552,6 +1137,8 @@ async def get_tenant_plan(tenant_id: str) -> dict:
         # Fallback to free plan limits if plan not found
         plan = await db.subscription_plans.find_one({"id": "free"}, {"_id": 0})
     
+    if plan:
+        plan_cache.set(tenant_id, {"version": version, "plan": copy.deepcopy(plan)})
     return plan
 
 async def check_user_limit(tenant_id: str) -> dict:
@@ -564,7 +1151,7 @@ async def check_user_limit(tenant_id: str) -> dict:
     if max_users == -1:  # Unlimited
         return {"allowed": True}
     
-    current_users = await db.users.count_documents({"tenant_id": tenant_id})
+    current_users = (await get_tenant_usage(tenant_id)).get("users", 0)
     if current_users >= max_users:
         return {
             "allowed": False,
@@ -585,7 +1172,7 @@ async def check_branch_limit(tenant_id: str) -> dict:
     if max_branches == -1:  # Unlimited
         return {"allowed": True}
     
-    current_branches = await db.branches.count_documents({"tenant_id": tenant_id})
+    current_branches = (await get_tenant_usage(tenant_id)).get("branches", 0)
     if current_branches >= max_branches:
         return {
             "allowed": False,
@@ -606,13 +1193,8 @@ async def check_job_limit(tenant_id: str) -> dict:
     if max_jobs == -1:  # Unlimited
         return {"allowed": True}
     
-    # Count jobs created this month
-    now = datetime.now(timezone.utc)
-    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat()
-    current_jobs = await db.jobs.count_documents({
-        "tenant_id": tenant_id,
-        "created_at": {"$gte": month_start}
-    })
+    usage = await get_tenant_usage(tenant_id)
+    current_jobs = usage.get("jobs_by_month", {}).get(usage_month(), 0)
     
     if current_jobs >= max_jobs:
         return {
@@ -634,7 +1216,7 @@ async def check_inventory_limit(tenant_id: str) -> dict:
     if max_items == -1:  # Unlimited
         return {"allowed": True}
     
-    current_items = await db.inventory.count_documents({"tenant_id": tenant_id})
+    current_items = (await get_tenant_usage(tenant_id)).get("inventory_items", 0)
     if current_items >= max_items:
         return {
             "allowed": False,
@@ -670,6 +1252,28 @@ async def check_photo_limit(tenant_id: str, job_id: str) -> dict:
         }
     return {"allowed": True, "current": current_photos, "limit": max_photos}
 
+async def check_storage_limit(tenant_id: str, incoming_bytes: int) -> dict:
+    """Check if tenant has room to store incoming_bytes more"""
+    plan = await get_tenant_plan(tenant_id)
+    if not plan:
+        return {"allowed": False, "message": "Tenant not found"}
+    
+    max_storage_mb = plan.get("max_storage_mb", 100)
+    if max_storage_mb == -1:  # Unlimited
+        return {"allowed": True}
+    
+    current_bytes = (await get_tenant_usage(tenant_id)).get("storage_bytes", 0)
+    if current_bytes + incoming_bytes > max_storage_mb * 1024 * 1024:
+        current_mb = round(current_bytes / (1024 * 1024), 2)
+        return {
+            "allowed": False,
+            "message": f"Storage limit reached ({current_mb}/{max_storage_mb} MB). Upgrade your plan to upload more photos.",
+            "current": current_mb,
+            "limit": max_storage_mb,
+            "plan": plan.get("name", "Free")
+        }
+    return {"allowed": True, "current": round(current_bytes / (1024 * 1024), 2), "limit": max_storage_mb}
+
 async def check_feature_access(tenant_id: str, feature: str) -> dict:
     """Check if tenant has access to a specific feature"""
     plan = await get_tenant_plan(tenant_id)
@@ -688,10 +1292,658 @@ async def check_feature_access(tenant_id: str, feature: str) -> dict:
 
 # ==================== UTILITY FUNCTIONS ====================
 
+def job_counter_key(tenant_id: str, year: int) -> str:
+    return f"job_number:{tenant_id}:{year}"
+
+# Migration 0001 seeds the counters from existing job numbers; a counter used before that would
+# start again at 1 and hand out numbers that already exist.
+async def ensure_job_counters_seeded():
+    if not await migration_applied("0001_seed_job_counters"):
+        raise HTTPException(status_code=503, detail="Job numbering is still being set up, please retry shortly",
+                            headers={"Retry-After": "30"})
+
 async def generate_job_number(tenant_id: str) -> str:
-    year = datetime.now(timezone.utc).year
-    count = await db.jobs.count_documents({"tenant_id": tenant_id})
-    return f"JOB-{year}-{str(count + 1).zfill(6)}"
+    """Next job number from the tenant's per-year counter; the $inc is atomic so concurrent creates never collide"""
+    await ensure_job_counters_seeded()
+    return await next_job_number(tenant_id, datetime.now(timezone.utc).year)
+
+async def next_job_number(tenant_id: str, year: int) -> str:
+    counter = await db.counters.find_one_and_update(
+        {"_id": job_counter_key(tenant_id, year)},
+        {"$inc": {"seq": 1}},
+        projection={"_id": 0, "seq": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return f"JOB-{year}-{str(counter['seq']).zfill(6)}"
+
+# ==================== NORMALIZED KEYS ====================
+# Mobiles and IMEIs are stored as typed ("+91 98765 43210", "98765-43210"). Jobs also carry a
+# normalized copy so lookups are exact, indexed and insensitive to formatting.
+
+def digits_only(value: Optional[str]) -> str:
+    return re.sub(r"\D", "", value or "")
+
+def mobile_key(mobile: Optional[str]) -> Optional[str]:
+    """Last 10 digits - drops country codes and leading zeros. None for a number with no digits,
+    which identifies no customer: those jobs get no customers document or ledger postings."""
+    return digits_only(mobile)[-10:] or None
+
+def customer_key(mobile: str) -> str:
+    """mobile_key of a /customers/{mobile} path"""
+    key = mobile_key(mobile)
+    if key is None:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    return key
+
+def imei_key(serial: Optional[str]) -> Optional[str]:
+    key = re.sub(r"[^0-9A-Z]", "", (serial or "").upper())
+    return key or None
+
+def job_seq(job_number: str) -> Optional[int]:
+    """123 for JOB-2025-000123"""
+    tail = (job_number or "").rsplit("-", 1)[-1]
+    return int(tail) if tail.isdigit() else None
+
+def normalized_job_keys(job: dict) -> dict:
+    mobile = (job.get("customer") or {}).get("mobile")
+    return {
+        "mobile": digits_only(mobile),
+        "mobile_last10": mobile_key(mobile),
+        "imei": imei_key((job.get("device") or {}).get("serial_imei")),
+        "job_seq": job_seq(job.get("job_number", ""))
+    }
+
+# ==================== SEARCH KEYS ====================
+# Jobs and inventory items carry a search_keys array: lowercase words plus their prefixes, and
+# prefixes/suffixes of phone and IMEI digits. A multikey index on (tenant_id, search_keys) turns
+# universal search into index lookups with {"$all": terms} instead of unanchored regex scans.
+
+SEARCH_WORD = re.compile(r"[a-z0-9]+")
+SEARCH_MIN_PREFIX = 2
+SEARCH_MAX_PREFIX = 20
+SEARCH_MAX_TEXT_WORDS = 50
+# Candidates fetched per query before ranking
+SEARCH_CANDIDATES = 200
+# Keys only match from the start of a word, so "avi" misses "Ravi". A job list search whose keys find
+# fewer jobs than this also takes substring matches on job number, name, mobile and serial/IMEI.
+JOB_SEARCH_SUBSTRING_BELOW = int(os.environ.get('JOB_SEARCH_SUBSTRING_BELOW', 20))
+
+def word_keys(text: Optional[str], prefixes: bool = True) -> set:
+    keys = set()
+    for word in SEARCH_WORD.findall((text or "").lower()):
+        keys.add(word)
+        if prefixes:
+            keys.update(word[:n] for n in range(SEARCH_MIN_PREFIX, min(len(word), SEARCH_MAX_PREFIX + 1)))
+    return keys
+
+def text_keys(text: Optional[str]) -> set:
+    """Whole words only, for free-text fields where prefixes would bloat the index"""
+    return set(SEARCH_WORD.findall((text or "").lower())[:SEARCH_MAX_TEXT_WORDS])
+
+def digit_keys(value: Optional[str]) -> set:
+    """Prefixes and trailing digits of a phone/IMEI, ignoring spaces, dashes and country codes"""
+    digits = digits_only(value)
+    if len(digits) < 4:
+        return set()
+    keys = set()
+    for number in {digits, digits[-10:]}:
+        keys.update(number[:n] for n in range(3, len(number) + 1))
+    keys.update(digits[-n:] for n in range(4, len(digits)))
+    return keys
+
+def job_number_keys(job_number: str) -> set:
+    keys = word_keys(job_number)
+    seq = job_seq(job_number)
+    if seq is not None:
+        # JOB-2025-000123 is also found by "123"
+        keys |= word_keys(str(seq))
+    return keys
+
+def whole_values(*values: Optional[str]) -> set:
+    """Complete words and complete digit strings, used to rank exact hits above prefix hits"""
+    words = set()
+    for value in values:
+        words.update(SEARCH_WORD.findall((value or "").lower()))
+        digits = digits_only(value)
+        if digits:
+            words.update({digits, digits[-10:]})
+    return words
+
+def job_search_fields(job: dict) -> dict:
+    """Per field: (ranking weight, index keys, whole values)"""
+    customer = job.get("customer") or {}
+    device = job.get("device") or {}
+    job_number = job.get("job_number", "")
+    mobile, serial = customer.get("mobile"), device.get("serial_imei")
+    free_text = (job.get("problem_description"), job.get("technician_observation"), device.get("notes"))
+    return {
+        "job_number": (10, job_number_keys(job_number), whole_values(job_number)),
+        "mobile": (8, digit_keys(mobile), whole_values(mobile)),
+        "serial": (8, word_keys(serial) | digit_keys(serial), whole_values(serial)),
+        "name": (5, word_keys(customer.get("name")), whole_values(customer.get("name"))),
+        "email": (4, word_keys(customer.get("email")), whole_values(customer.get("email"))),
+        "device": (3, word_keys(device.get("brand")) | word_keys(device.get("model")), whole_values(device.get("brand"), device.get("model"))),
+        "text": (1, set().union(*(text_keys(t) for t in free_text)), whole_values(*free_text))
+    }
+
+def job_search_keys(job: dict) -> List[str]:
+    return sorted(set().union(*(keys for _, keys, _ in job_search_fields(job).values())))
+
+def customer_search_keys(customer: dict) -> List[str]:
+    return sorted(word_keys(customer.get("name")) | digit_keys(customer.get("mobile")) | word_keys(customer.get("email")))
+
+def inventory_search_fields(item: dict) -> dict:
+    return {
+        "sku": (5, word_keys(item.get("sku")), whole_values(item.get("sku"))),
+        "name": (3, word_keys(item.get("name")), whole_values(item.get("name"))),
+        "description": (1, text_keys(item.get("description")), whole_values(item.get("description")))
+    }
+
+def inventory_search_keys(item: dict) -> List[str]:
+    return sorted(set().union(*(keys for _, keys, _ in inventory_search_fields(item).values())))
+
+def search_terms(q: str) -> List[str]:
+    """Split a query into index terms; a query that is all digits once separators go is one number"""
+    compact = re.sub(r"[\s+\-().]", "", q)
+    if compact.isdigit():
+        return [compact] if len(compact) >= SEARCH_MIN_PREFIX else []
+    return sorted({t for t in SEARCH_WORD.findall(q.lower()) if len(t) >= SEARCH_MIN_PREFIX})
+
+def search_score(fields: dict, terms: List[str]) -> int:
+    """Every term scores its best-matching field's weight, doubled when it is a whole word there"""
+    score = 0
+    for term in terms:
+        best = 0
+        for weight, keys, whole in fields.values():
+            if term in whole:
+                best = max(best, weight * 2)
+            elif term in keys:
+                best = max(best, weight)
+        score += best
+    return score
+
+# ==================== DATABASE INDEXES ====================
+
+# Indexes the routes rely on, per collection: (keys, options)
+INDEX_SPECS = {
+    "jobs": [
+        ([("id", 1)], {"unique": True}),
+        ([("tenant_id", 1), ("created_at", -1), ("id", -1)], {}),
+        ([("tenant_id", 1), ("search_keys", 1), ("created_at", -1)], {}),
+        ([("tenant_id", 1), ("status", 1)], {}),
+        ([("tenant_id", 1), ("customer.mobile", 1)], {}),
+        ([("tenant_id", 1), ("normalized.mobile_last10", 1), ("created_at", -1)], {}),
+        ([("tenant_id", 1), ("normalized.imei", 1)], {}),
+        ([("tenant_id", 1), ("normalized.job_seq", 1)], {}),
+        ([("tenant_id", 1), ("branch_id", 1)], {}),
+        ([("tenant_id", 1), ("delivery.delivered_at", -1)], {}),
+        ([("job_number", 1), ("tracking_token", 1)], {}),
+        ([("previous_job_number", 1), ("tracking_token", 1)], {"partialFilterExpression": {"previous_job_number": {"$exists": True}}}),
+        ([("tenant_id", 1), ("job_number", 1)], {"unique": True}),
+        ([("created_at", -1)], {}),
+        ([("photos.uploaded_at", 1)], {}),
+    ],
+    "users": [
+        ([("id", 1)], {"unique": True}),
+        ([("tenant_id", 1), ("email", 1)], {}),
+        ([("tenant_id", 1), ("role", 1)], {}),
+        ([("email", 1)], {}),
+    ],
+    "tenants": [
+        ([("id", 1)], {"unique": True}),
+        ([("subdomain", 1)], {"unique": True}),
+        ([("created_at", -1)], {}),
+        ([("company_name", 1)], {}),
+        ([("subscription_plan", 1)], {}),
+        ([("subscription_status", 1), ("subscription_ends_at", 1)], {}),
+    ],
+    "branches": [
+        ([("id", 1)], {"unique": True}),
+        ([("tenant_id", 1)], {}),
+    ],
+    "inventory": [
+        ([("id", 1)], {"unique": True}),
+        ([("tenant_id", 1), ("name", 1)], {}),
+        ([("tenant_id", 1), ("category", 1)], {}),
+        ([("tenant_id", 1), ("search_keys", 1)], {}),
+    ],
+    "inventory_usage": [
+        ([("tenant_id", 1), ("inventory_id", 1), ("used_at", -1)], {}),
+    ],
+    "customer_ledger": [
+        ([("tenant_id", 1), ("customer_mobile", 1), ("created_at", -1)], {}),
+        ([("tenant_id", 1), ("customer_mobile_key", 1), ("created_at", -1)], {}),
+        ([("tenant_id", 1), ("customer_mobile_key", 1), ("seq", -1)], {"unique": True, "partialFilterExpression": {"seq": {"$exists": True}}}),
+        ([("id", 1)], {"unique": True}),
+    ],
+    "subscription_plans": [
+        ([("id", 1)], {"unique": True}),
+        ([("sort_order", 1)], {}),
+    ],
+    "payments": [
+        ([("tenant_id", 1), ("created_at", -1)], {}),
+        ([("created_at", -1)], {}),
+    ],
+    "tenant_payments": [
+        ([("tenant_id", 1), ("created_at", -1)], {}),
+        ([("created_at", -1)], {}),
+    ],
+    "admin_action_logs": [
+        ([("tenant_id", 1), ("created_at", -1)], {}),
+    ],
+    "support_tickets": [
+        ([("id", 1)], {"unique": True}),
+        ([("tenant_id", 1), ("created_at", -1)], {}),
+        ([("status", 1), ("created_at", -1)], {}),
+    ],
+    "announcements": [
+        ([("is_active", 1), ("created_at", -1)], {}),
+    ],
+    "super_admins": [
+        ([("id", 1)], {"unique": True}),
+        ([("email", 1)], {}),
+    ],
+    "migrations": [
+        ([("id", 1)], {"unique": True}),
+    ],
+    "tenant_usage": [
+        ([("tenant_id", 1)], {"unique": True}),
+    ],
+    "photo_blobs": [
+        ([("tenant_id", 1), ("sha256", 1)], {"unique": True}),
+    ],
+    "platform_rollups": [
+        ([("kind", 1), ("period", 1)], {}),
+    ],
+    "job_daily_stats": [
+        ([("tenant_id", 1), ("date", 1), ("branch_id", 1), ("status", 1)], {"unique": True}),
+        ([("date", 1)], {}),
+    ],
+    "customers": [
+        ([("id", 1)], {"unique": True}),
+        ([("tenant_id", 1), ("mobile_key", 1)], {"unique": True}),
+        ([("tenant_id", 1), ("last_visit", -1)], {}),
+        ([("tenant_id", 1), ("search_keys", 1), ("last_visit", -1)], {}),
+        ([("tenant_id", 1), ("balance", -1)], {}),
+        ([("tenant_id", 1), ("first_visit", -1)], {}),
+        ([("tenant_id", 1), ("total_jobs", 1)], {}),
+    ],
+}
+
+def index_name(keys: list) -> str:
+    """Default MongoDB name for an index key list (e.g. tenant_id_1_created_at_-1)"""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+async def ensure_indexes() -> dict:
+    """Create every declared index. Safe to run repeatedly - existing indexes are left alone."""
+    created, failed = [], []
+    for collection, specs in INDEX_SPECS.items():
+        for keys, options in specs:
+            name = index_name(keys)
+            try:
+                await db[collection].create_index(keys, name=name, **options)
+                created.append(f"{collection}.{name}")
+            except PyMongoError as e:
+                # A missing unique index means the data already breaks the rule it enforces
+                log = logger.error if options.get("unique") else logger.warning
+                log(f"Could not create index {collection}.{name}: {e}")
+                failed.append({"index": f"{collection}.{name}", "error": str(e)})
+    return {"ensured": created, "failed": failed}
+
+# ==================== LEASES & TRANSACTIONS ====================
+# A lease is a document naming the worker that holds it until expires_at. Whoever finds it expired
+# (or missing) takes it over, so a worker that dies holding one only blocks the others until then.
+
+WORKER_ID = str(uuid.uuid4())
+
+# Leases of periodic background tasks, one document per task
+TASK_LEASES = "task_leases"
+
+async def acquire_lease(collection: str, lease_id: str, seconds: int) -> bool:
+    now = datetime.now(timezone.utc)
+    try:
+        await db[collection].update_one(
+            {"_id": lease_id, "expires_at": {"$lt": now.isoformat()}},
+            {"$set": {"holder": WORKER_ID, "expires_at": (now + timedelta(seconds=seconds)).isoformat()}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease
+        return False
+
+async def renew_lease(collection: str, lease_id: str, seconds: int) -> bool:
+    """Push back the expiry of a lease this worker holds; False if it has lapsed to another worker"""
+    result = await db[collection].update_one(
+        {"_id": lease_id, "holder": WORKER_ID},
+        {"$set": {"expires_at": (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()}}
+    )
+    return result.matched_count > 0
+
+async def release_lease(collection: str, lease_id: str):
+    await db[collection].update_one(
+        {"_id": lease_id, "holder": WORKER_ID},
+        {"$set": {"expires_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def lease_held(collection: str, lease_id: str) -> bool:
+    now = datetime.now(timezone.utc).isoformat()
+    return await db[collection].count_documents({"_id": lease_id, "expires_at": {"$gte": now}}, limit=1) > 0
+
+class LeaseLost(Exception):
+    """A lease lapsed to another worker while this one was still working under it"""
+
+@asynccontextmanager
+async def holding_lease(collection: str, lease_id: str, seconds: int):
+    """Renew an acquired lease every third of its length while the block runs. If it lapses to another
+    worker anyway, the block is cancelled and LeaseLost raised, so two holders never overlap for long."""
+    owner = asyncio.current_task()
+    lost = False
+
+    async def heartbeat():
+        nonlocal lost
+        while True:
+            await asyncio.sleep(seconds / 3)
+            try:
+                renewed = await renew_lease(collection, lease_id, seconds)
+            except PyMongoError as e:
+                logger.warning(f"Could not renew lease {collection}/{lease_id}: {e}")
+                continue
+            if not renewed:
+                lost = True
+                owner.cancel()
+                return
+
+    renewing = asyncio.create_task(heartbeat())
+    try:
+        yield
+    except asyncio.CancelledError:
+        if not lost:
+            raise
+        owner.uncancel()
+        raise LeaseLost(f"{collection}/{lease_id}")
+    finally:
+        renewing.cancel()
+
+# Multi-document transactions need a replica set or a sharded cluster; checked at startup
+transactions_supported = False
+
+async def detect_transaction_support() -> bool:
+    try:
+        hello = await client.admin.command("hello")
+    except PyMongoError as e:
+        logger.warning(f"Could not check for transaction support: {e}")
+        return False
+    return bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+
+async def in_transaction(callback):
+    """Run callback(session) as one transaction where the deployment supports it, otherwise callback(None)"""
+    if not transactions_supported:
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
+# ==================== MIGRATIONS ====================
+
+async def migrate_seed_job_counters() -> dict:
+    """Seed job_number counters from the highest existing number per tenant and year"""
+    pipeline = [
+        {"$match": {"job_number": {"$regex": r"^JOB-\d{4}-\d+$"}}},
+        {"$group": {
+            "_id": {"tenant_id": "$tenant_id", "year": {"$substr": ["$job_number", 4, 4]}},
+            # Compare numerically - the zero padding stops at six digits
+            "seq": {"$max": {"$toInt": {"$substr": ["$job_number", 9, 20]}}}
+        }}
+    ]
+    seeded = 0
+    async for group in db.jobs.aggregate(pipeline):
+        key = job_counter_key(group["_id"]["tenant_id"], int(group["_id"]["year"]))
+        await db.counters.update_one({"_id": key}, {"$max": {"seq": group["seq"]}}, upsert=True)
+        seeded += 1
+    return {"counters_seeded": seeded}
+
+async def backfill_field(collection: str, field: str, build) -> int:
+    """Set a derived field on every document of a collection, in bulk batches"""
+    updated, batch = 0, []
+    async for doc in db[collection].find({}, {"_id": 0}):
+        batch.append(UpdateOne({"id": doc["id"]}, {"$set": {field: build(doc)}}))
+        if len(batch) >= 500:
+            await db[collection].bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        await db[collection].bulk_write(batch, ordered=False)
+        updated += len(batch)
+    return updated
+
+async def migrate_backfill_search_keys() -> dict:
+    """Build search_keys for jobs and inventory items created before search indexing"""
+    return {
+        "jobs": await backfill_field("jobs", "search_keys", job_search_keys),
+        "inventory": await backfill_field("inventory", "search_keys", inventory_search_keys)
+    }
+
+async def migrate_backfill_normalized_keys() -> dict:
+    """Normalized mobile/IMEI/sequence keys on jobs, and the mobile key on ledger entries"""
+    return {
+        "jobs": await backfill_field("jobs", "normalized", normalized_job_keys),
+        "customer_ledger": await backfill_field("customer_ledger", "customer_mobile_key", lambda e: mobile_key(e.get("customer_mobile")))
+    }
+
+async def migrate_build_customers() -> dict:
+    """Materialize the customers collection from existing jobs and ledger payments"""
+    rebuilt = 0
+    async for tenant in db.tenants.find({}, {"_id": 0, "id": 1}):
+        rebuilt += await rebuild_customers(tenant["id"])
+    return {"customers": rebuilt}
+
+async def migrate_build_job_daily_stats() -> dict:
+    """Count existing jobs into job_daily_stats"""
+    return {"buckets": await rebuild_job_daily_stats()}
+
+async def migrate_renumber_duplicate_jobs() -> dict:
+    """Give each job that shares its number with an older job of the same tenant the next number of its
+    year, then create the unique (tenant_id, job_number) index; failing to is this migration failing.
+    The old number is kept as previous_job_number so tracking links already sent out still work."""
+    renumbered = 0
+    async for group in db.jobs.aggregate([
+        {"$group": {"_id": {"tenant_id": "$tenant_id", "job_number": "$job_number"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True):
+        tenant_id, job_number = group["_id"]["tenant_id"], group["_id"]["job_number"]
+        jobs = await db.jobs.find(
+            {"tenant_id": tenant_id, "job_number": job_number}, {"_id": 0}
+        ).sort([("created_at", 1), ("id", 1)]).to_list(None)
+        for job in jobs[1:]:
+            year = int(job_number[4:8]) if re.match(r"^JOB-\d{4}-", job_number) else int(job["created_at"][:4])
+            job["job_number"] = await next_job_number(tenant_id, year)
+            await db.jobs.update_one({"id": job["id"]}, {"$set": {
+                "job_number": job["job_number"],
+                "previous_job_number": job_number,
+                "normalized": normalized_job_keys(job),
+                "search_keys": job_search_keys(job)
+            }})
+            for collection in ("customer_ledger", "inventory_usage"):
+                await db[collection].update_many({"job_id": job["id"]}, {"$set": {"job_number": job["job_number"]}})
+            tracking_cache.invalidate(tracking_cache_key(job_number, job.get("tracking_token", "")))
+            renumbered += 1
+    keys = [("tenant_id", 1), ("job_number", 1)]
+    await db.jobs.create_index(keys, name=index_name(keys), unique=True)
+    return {"jobs_renumbered": renumbered}
+
+async def migrate_register_photo_blobs() -> dict:
+    """Hash photos uploaded before content addressing into photo_blobs, folding duplicate files into one"""
+    registered, merged, tenants = 0, 0, set()
+    async for job in db.jobs.find(
+        {"photos": {"$elemMatch": {"sha256": {"$exists": False}}}},
+        {"_id": 0, "id": 1, "tenant_id": 1, "photos": 1}
+    ):
+        tenant_dir = UPLOAD_DIR / job["tenant_id"]
+        for photo in job["photos"]:
+            path = tenant_dir / photo["filename"]
+            if "sha256" in photo or not path.exists():
+                continue
+            digest = await asyncio.to_thread(file_sha256, path)
+            blob_fields = {"filename": photo["filename"], "size": path.stat().st_size, "created_at": photo.get("uploaded_at")}
+            if "variants" in photo:
+                blob_fields.update(variants=photo["variants"], variants_size=photo.get("variants_size", 0))
+            blob_query = {"tenant_id": job["tenant_id"], "sha256": digest}
+            try:
+                # The ref and the id of the photo it counts go in together, so a re-run after a
+                # failure further down never counts the same photo twice
+                before = await db.photo_blobs.find_one_and_update(
+                    {**blob_query, "migrated_photos": {"$ne": photo["id"]}},
+                    {"$inc": {"refs": 1}, "$push": {"migrated_photos": photo["id"]}, "$setOnInsert": blob_fields},
+                    projection={"_id": 0},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                # Counted by an earlier run that stopped before updating the job
+                before = await db.photo_blobs.find_one(blob_query, {"_id": 0})
+            update = {"$set": {"photos.$.sha256": digest}, "$unset": {"photos.$.variants_size": ""}}
+            duplicate = before and before["filename"] != photo["filename"]
+            if duplicate:
+                # Same image as a photo registered earlier: point at that file, then drop this copy
+                update["$set"].update({
+                    "photos.$.filename": before["filename"],
+                    "photos.$.url": f"/uploads/{job['tenant_id']}/{before['filename']}"
+                })
+                if "variants" in before:
+                    update["$set"]["photos.$.variants"] = before["variants"]
+                else:
+                    update["$unset"]["photos.$.variants"] = ""
+            await db.jobs.update_one({"id": job["id"], "photos.id": photo["id"]}, update)
+            if duplicate:
+                path.unlink(missing_ok=True)
+                await remove_photo_variants(job["tenant_id"], photo["filename"])
+                merged += 1
+            registered += 1
+            tenants.add(job["tenant_id"])
+    for tenant_id in tenants:
+        await db.photo_blobs.update_many({"tenant_id": tenant_id}, {"$unset": {"migrated_photos": ""}})
+        await reconcile_tenant_usage(tenant_id)
+    return {"photos": registered, "duplicates_merged": merged}
+
+async def migrate_split_keyless_customers() -> dict:
+    """Undo the single customer that every job whose mobile has no digits was filed under.
+    Its job postings are rebuilt from the jobs anyway; its payments stay on record, unnumbered."""
+    jobs = await db.jobs.update_many({"normalized.mobile_last10": ""}, {"$set": {"normalized.mobile_last10": None}})
+    customers = await db.customers.delete_many({"mobile_key": ""})
+    postings = await db.customer_ledger.delete_many({"customer_mobile_key": "", "type": {"$in": LEDGER_JOB_TYPES}})
+    payments = await db.customer_ledger.update_many(
+        {"customer_mobile_key": ""},
+        {"$set": {"customer_mobile_key": None}, "$unset": {"seq": "", "balance_after": ""}}
+    )
+    return {
+        "jobs": jobs.modified_count,
+        "customers": customers.deleted_count,
+        "postings": postings.deleted_count,
+        "payments": payments.modified_count
+    }
+
+async def migrate_build_customer_ledger() -> dict:
+    """Post job entries for past deliveries and number every customer's ledger"""
+    entries = 0
+    async for tenant in db.tenants.find({}, {"_id": 0, "id": 1}):
+        entries += await rebuild_customer_ledger(tenant["id"])
+    return {"entries": entries}
+
+# Applied once each, in order; every migration must be safe to re-run
+MIGRATION_LEASE_SECONDS = int(os.environ.get('MIGRATION_LEASE_SECONDS', 1800))
+
+MIGRATIONS = [
+    ("0001_seed_job_counters", migrate_seed_job_counters),
+    ("0002_backfill_search_keys", migrate_backfill_search_keys),
+    ("0003_backfill_normalized_keys", migrate_backfill_normalized_keys),
+    ("0004_build_customers", migrate_build_customers),
+    ("0005_build_customer_ledger", migrate_build_customer_ledger),
+    ("0006_build_job_daily_stats", migrate_build_job_daily_stats),
+    ("0007_register_photo_blobs", migrate_register_photo_blobs),
+    ("0008_renumber_duplicate_jobs", migrate_renumber_duplicate_jobs),
+    ("0009_split_keyless_customers", migrate_split_keyless_customers),
+]
+
+MIGRATION_RETRY_SECONDS = 30
+
+# Migrations this worker has seen applied. Features that read a backfilled field or collection
+# check theirs first and answer 503 (or fall back) until it exists, instead of returning partial data.
+applied_migrations = set()
+
+async def migration_applied(migration_id: str) -> bool:
+    if migration_id not in applied_migrations:
+        if await db.migrations.count_documents({"id": migration_id}, limit=1):
+            applied_migrations.add(migration_id)
+    return migration_id in applied_migrations
+
+def requires_migrations(*migration_ids: str):
+    """Dependency that answers 503 until the given migrations have been applied"""
+    async def check():
+        for migration_id in migration_ids:
+            if not await migration_applied(migration_id):
+                raise HTTPException(status_code=503, detail="This data is still being prepared after an upgrade, please retry shortly",
+                                    headers={"Retry-After": str(MIGRATION_RETRY_SECONDS)})
+    return check
+
+# What each backfill serves
+search_ready = requires_migrations("0002_backfill_search_keys", "0003_backfill_normalized_keys", "0004_build_customers")
+device_history_ready = requires_migrations("0003_backfill_normalized_keys")
+customers_ready = requires_migrations("0004_build_customers", "0009_split_keyless_customers")
+ledger_ready = requires_migrations("0004_build_customers", "0005_build_customer_ledger", "0009_split_keyless_customers")
+job_stats_ready = requires_migrations("0006_build_job_daily_stats")
+
+async def migration_loop():
+    """Apply pending migrations in the background, so no worker waits on them to start serving. A worker
+    that finds the lease taken keeps checking, and takes over if its holder dies part way."""
+    while True:
+        try:
+            if await run_migrations():
+                return
+        except PyMongoError as e:
+            logger.error(f"Could not run migrations: {e}")
+        await asyncio.sleep(MIGRATION_RETRY_SECONDS)
+
+async def run_migrations() -> bool:
+    """Apply pending migrations under the lease and record them in the migrations collection. Returns False
+    while another worker holds the lease, True once this one has been through them; a migration that
+    failed is retried on the next startup."""
+    if not await acquire_lease("migrations", "lease", MIGRATION_LEASE_SECONDS):
+        return all([await migration_applied(migration_id) for migration_id, _ in MIGRATIONS])
+    try:
+        async with holding_lease("migrations", "lease", MIGRATION_LEASE_SECONDS):
+            await apply_pending_migrations()
+        return True
+    except LeaseLost:
+        logger.error("Lost the migrations lease part way, leaving the rest to the new holder")
+        return False
+    finally:
+        await release_lease("migrations", "lease")
+
+async def apply_pending_migrations():
+    applied = {m["id"] async for m in db.migrations.find({"id": {"$exists": True}}, {"_id": 0, "id": 1})}
+    applied_migrations.update(applied)
+    for migration_id, migrate in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        started = time.monotonic()
+        try:
+            result = await migrate()
+            await db.migrations.update_one(
+                {"id": migration_id},
+                {"$setOnInsert": {
+                    "id": migration_id,
+                    "result": result,
+                    "duration_ms": round((time.monotonic() - started) * 1000),
+                    "applied_at": datetime.now(timezone.utc).isoformat()
+                }},
+                upsert=True
+            )
+            applied_migrations.add(migration_id)
+            logger.info(f"Applied migration {migration_id}: {result}")
+        except Exception:
+            # Later migrations may depend on this one, so stop here and retry on next startup
+            logger.exception(f"Migration {migration_id} failed")
+            break
 
 # ==================== ROUTES ====================
 
@@ -747,7 +1999,7 @@ async def signup_tenant(data: TenantCreate):
         "tenant_id": tenant_id,
         "name": data.admin_name,
         "email": data.admin_email.lower(),
-        "password": hash_password(data.admin_password),
+        "password": await hash_password_async(data.admin_password),
         "role": "admin",
         "branch_id": None,
         "phone": data.phone or "",
@@ -766,6 +2018,7 @@ async def signup_tenant(data: TenantCreate):
         "created_at": now
     }
     await db.branches.insert_one(branch)
+    await reconcile_tenant_usage(tenant_id)
     
     token = create_token(user_id, tenant_id, "admin")
     
@@ -774,7 +2027,7 @@ async def signup_tenant(data: TenantCreate):
     
     return LoginResponse(token=token, user=UserResponse(**user_response), tenant=TenantResponse(**tenant_response))
 
-@api_router.get("/tenants/check-subdomain/{subdomain}")
+@api_router.get("/tenants/check-subdomain/{subdomain}", dependencies=[Depends(rate_limit("check_subdomain"))])
 async def check_subdomain(subdomain: str):
     existing = await db.tenants.find_one({"subdomain": subdomain.lower()})
     return {"available": existing is None}
@@ -795,18 +2048,11 @@ async def get_plan_usage(user: dict = Depends(get_current_user)):
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
     
-    # Get current month start for job count
-    now = datetime.now(timezone.utc)
-    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat()
-    
-    # Get all usage counts
-    user_count = await db.users.count_documents({"tenant_id": tenant_id})
-    branch_count = await db.branches.count_documents({"tenant_id": tenant_id})
-    jobs_this_month = await db.jobs.count_documents({
-        "tenant_id": tenant_id,
-        "created_at": {"$gte": month_start}
-    })
-    inventory_count = await db.inventory.count_documents({"tenant_id": tenant_id})
+    usage = await get_tenant_usage(tenant_id)
+    user_count = usage.get("users", 0)
+    branch_count = usage.get("branches", 0)
+    jobs_this_month = usage.get("jobs_by_month", {}).get(usage_month(), 0)
+    inventory_count = usage.get("inventory_items", 0)
     
     return {
         "plan": {
@@ -840,6 +2086,7 @@ async def get_plan_usage(user: dict = Depends(get_current_user)):
                 "unlimited": plan.get("max_photos_per_job", 3) == -1
             },
             "storage_mb": {
+                "current": round(usage.get("storage_bytes", 0) / (1024 * 1024), 2),
                 "limit": plan.get("max_storage_mb", 100),
                 "unlimited": plan.get("max_storage_mb", 100) == -1
             }
@@ -856,6 +2103,7 @@ async def update_tenant_settings(settings: SettingsUpdate, user: dict = Depends(
             {"id": user["tenant_id"]},
             {"$set": {"company_name": update_data.pop("company_name")}}
         )
+        invalidate_tenant_tracking(user["tenant_id"])
     
     if update_data:
         settings_update = {f"settings.{k}": v for k, v in update_data.items()}
@@ -866,7 +2114,7 @@ async def update_tenant_settings(settings: SettingsUpdate, user: dict = Depends(
 
 # ==================== LEGAL PAGES ROUTES ====================
 
-@api_router.get("/legal/{page_type}")
+@api_router.get("/legal/{page_type}", dependencies=[Depends(rate_limit("legal"))])
 async def get_legal_page(page_type: str, subdomain: Optional[str] = None):
     """Get a legal page content (public endpoint)"""
     valid_pages = ["privacy_policy", "terms_of_service", "refund_policy", "disclaimer"]
@@ -984,7 +2232,7 @@ async def reset_legal_page_to_default(
 
 # ==================== AUTH ROUTES ====================
 
-@api_router.post("/auth/login", response_model=LoginResponse)
+@api_router.post("/auth/login", response_model=LoginResponse, dependencies=[Depends(rate_limit("login", key=login_account))])
 async def login(data: LoginRequest):
     # Find tenant by subdomain
     tenant = await db.tenants.find_one({"subdomain": data.subdomain.lower()}, {"_id": 0})
@@ -997,7 +2245,7 @@ async def login(data: LoginRequest):
         "tenant_id": tenant["id"]
     })
     
-    if not user or not verify_password(data.password, user["password"]):
+    if not user or not await verify_password_async(data.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = create_token(user["id"], user["tenant_id"], user["role"])
@@ -1025,7 +2273,7 @@ async def change_password(data: ChangePasswordRequest, user: dict = Depends(get_
         raise HTTPException(status_code=404, detail="User not found")
     
     # Verify current password
-    if not verify_password(data.current_password, db_user["password"]):
+    if not await verify_password_async(data.current_password, db_user["password"]):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
     
     # Validate new password
@@ -1036,11 +2284,12 @@ async def change_password(data: ChangePasswordRequest, user: dict = Depends(get_
         raise HTTPException(status_code=400, detail="New password must be different from current password")
     
     # Update password
-    new_hash = hash_password(data.new_password)
+    new_hash = await hash_password_async(data.new_password)
     await db.users.update_one(
         {"id": user["id"]},
         {"$set": {"password": new_hash}}
     )
+    user_cache.invalidate(user["id"])
     
     return {"message": "Password changed successfully"}
 
@@ -1068,12 +2317,13 @@ async def create_user(data: UserCreate, admin: dict = Depends(require_admin)):
         "tenant_id": admin["tenant_id"],
         "name": data.name,
         "email": data.email.lower(),
-        "password": hash_password(data.password),
+        "password": await hash_password_async(data.password),
         "role": data.role,
         "branch_id": data.branch_id,
         "created_at": now
     }
     await db.users.insert_one(user)
+    await bump_usage(admin["tenant_id"], {"users": 1})
     
     user_response = {k: v for k, v in user.items() if k != "password"}
     return UserResponse(**user_response)
@@ -1124,6 +2374,7 @@ async def update_user(user_id: str, data: UserUpdate, admin: dict = Depends(requ
             {"id": user_id, "tenant_id": admin["tenant_id"]},
             {"$set": update_data}
         )
+        user_cache.invalidate(user_id)
     
     updated = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
     return UserResponse(**updated)
@@ -1140,6 +2391,8 @@ async def delete_user(user_id: str, admin: dict = Depends(require_admin)):
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    user_cache.invalidate(user_id)
+    await bump_usage(admin["tenant_id"], {"users": -1})
     
     return {"message": "User deleted"}
 
@@ -1154,7 +2407,7 @@ async def create_branch(data: BranchCreate, admin: dict = Depends(require_admin)
     
     # Check feature access
     feature_check = await check_feature_access(admin["tenant_id"], "multi_branch")
-    current_branches = await db.branches.count_documents({"tenant_id": admin["tenant_id"]})
+    current_branches = (await get_tenant_usage(admin["tenant_id"])).get("branches", 0)
     if current_branches >= 1 and not feature_check["allowed"]:
         raise HTTPException(status_code=403, detail="Multi-branch feature is not available in your current plan. Please upgrade to add more branches.")
     
@@ -1170,6 +2423,7 @@ async def create_branch(data: BranchCreate, admin: dict = Depends(require_admin)
         "created_at": now
     }
     await db.branches.insert_one(branch)
+    await bump_usage(admin["tenant_id"], {"branches": 1})
     return BranchResponse(**branch)
 
 @api_router.get("/branches", response_model=List[BranchResponse])
@@ -1197,6 +2451,7 @@ async def delete_branch(branch_id: str, admin: dict = Depends(require_admin)):
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Branch not found")
+    await bump_usage(admin["tenant_id"], {"branches": -1})
     
     return {"message": "Branch deleted"}
 
@@ -1243,34 +2498,65 @@ async def create_job(data: JobCreate, user: dict = Depends(get_current_user)):
         "created_at": now,
         "updated_at": now
     }
+    job["normalized"] = normalized_job_keys(job)
+    job["search_keys"] = job_search_keys(job)
     await db.jobs.insert_one(job)
+    await bump_usage(user["tenant_id"], {f"jobs_by_month.{usage_month(now)}": 1})
+    await record_customer_visit(job)
+    await record_job_created(job)
     
     return JobResponse(**job)
 
-@api_router.get("/jobs", response_model=List[JobResponse])
-async def list_jobs(
+def encode_job_cursor(job: dict) -> str:
+    """Opaque keyset cursor for the (created_at, id) position of a job"""
+    raw = json.dumps([job["created_at"], job["id"]], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_job_cursor(cursor: str) -> tuple:
+    try:
+        created_at, job_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(created_at, str) or not isinstance(job_id, str):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return created_at, job_id
+
+def job_list_query(
+    tenant_id: str,
     status_filter: Optional[str] = None,
     branch_id: Optional[str] = None,
     search: Optional[str] = None,
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
-    limit: int = 100,
-    skip: int = 0,
-    user: dict = Depends(get_current_user)
-):
-    query = {"tenant_id": user["tenant_id"]}
+    indexed_search: bool = True,
+    substring_search: bool = False
+) -> dict:
+    """Mongo filter for the job list filters, shared by list_jobs and the bulk export.
+    Until migration 0002 has built search_keys, pass indexed_search=False to search with regexes;
+    substring_search=True takes regex matches as well as key matches."""
+    query = {"tenant_id": tenant_id}
     
     if status_filter:
         query["status"] = status_filter
     if branch_id:
         query["branch_id"] = branch_id
     if search:
-        query["$or"] = [
-            {"job_number": {"$regex": search, "$options": "i"}},
-            {"customer.name": {"$regex": search, "$options": "i"}},
-            {"customer.mobile": {"$regex": search, "$options": "i"}},
-            {"device.serial_imei": {"$regex": search, "$options": "i"}}
+        pattern = re.escape(search)
+        substring = [
+            {"job_number": {"$regex": pattern, "$options": "i"}},
+            {"customer.name": {"$regex": pattern, "$options": "i"}},
+            {"customer.mobile": {"$regex": pattern, "$options": "i"}},
+            {"device.serial_imei": {"$regex": pattern, "$options": "i"}}
         ]
+        terms = search_terms(search)
+        # {"$in": []} matches nothing, which is what a search with no usable terms should return
+        indexed = {"search_keys": {"$all": terms} if terms else {"$in": []}}
+        if not indexed_search:
+            query["$or"] = substring
+        elif substring_search:
+            query["$or"] = [indexed, *substring]
+        else:
+            query.update(indexed)
     
     # Date range filter
     if date_from or date_to:
@@ -1281,13 +2567,227 @@ async def list_jobs(
             # Add time to include the entire end day
             date_query["$lte"] = date_to + "T23:59:59"
         query["created_at"] = date_query
+    return query
+
+async def job_list_filter(
+    tenant_id: str,
+    status_filter: Optional[str] = None,
+    branch_id: Optional[str] = None,
+    search: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None
+) -> dict:
+    """job_list_query for a request. The substring fallback is decided once for the whole filter,
+    not per page, so cursor pages of the same search stay consistent."""
+    indexed_search = await migration_applied("0002_backfill_search_keys")
+    query = job_list_query(tenant_id, status_filter, branch_id, search, date_from, date_to, indexed_search)
+    if search and indexed_search:
+        if await db.jobs.count_documents(query, limit=JOB_SEARCH_SUBSTRING_BELOW) < JOB_SEARCH_SUBSTRING_BELOW:
+            query = job_list_query(tenant_id, status_filter, branch_id, search, date_from, date_to, substring_search=True)
+    return query
+
+@api_router.get("/jobs", response_model=Union[List[JobResponse], JobPage])
+async def list_jobs(
+    status_filter: Optional[str] = None,
+    branch_id: Optional[str] = None,
+    search: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: int = 100,
+    skip: int = 0,
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """
+    List jobs, newest first.
+    Without `cursor` this returns a plain list paged by skip/limit. Pass `cursor=` (empty for the
+    first page) to get {"jobs", "next_cursor"} pages instead - they stay stable while new jobs
+    arrive and cost the same at any depth.
+    """
+    query = await job_list_filter(user["tenant_id"], status_filter, branch_id, search, date_from, date_to)
+    
+    sort = [("created_at", -1), ("id", -1)]
+    if cursor is None:
+        jobs = await db.jobs.find(query, {"_id": 0}).sort(sort).skip(skip).limit(limit).to_list(limit)
+        return [JobResponse(**j) for j in jobs]
+    
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    if cursor:
+        created_at, job_id = decode_job_cursor(cursor)
+        query = {"$and": [query, {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": job_id}}
+        ]}]}
+    
+    # Fetch one extra row to learn whether another page exists
+    jobs = await db.jobs.find(query, {"_id": 0}).sort(sort).limit(limit + 1).to_list(limit + 1)
+    has_more = len(jobs) > limit
+    jobs = jobs[:limit]
+    return JobPage(
+        jobs=[JobResponse(**j) for j in jobs],
+        next_cursor=encode_job_cursor(jobs[-1]) if has_more else None
+    )
+
+# ==================== BULK JOB SHEET EXPORT ====================
+
+BULK_EXPORT_FORMATS = {"zip", "pdf"}
+
+class ZipStream:
+    """Write-only file object for zipfile; the bytes written so far are drained after every entry"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+exports_running = 0
+export_render_slots = asyncio.Semaphore(BULK_EXPORT_RENDER_SLOTS)
+
+def reserve_export_slot():
+    """Check for and take an export slot in one step, with no await in between; returns its release.
+    Release is idempotent, so the stream's finally and the response's background task can both call it."""
+    global exports_running
+    if exports_running >= BULK_EXPORT_CONCURRENCY:
+        raise HTTPException(status_code=429, detail="Too many exports running, please retry shortly",
+                            headers={"Retry-After": "10"})
+    exports_running += 1
+    released = False
+    
+    def release():
+        global exports_running
+        nonlocal released
+        if not released:
+            released = True
+            exports_running -= 1
+    return release
+
+async def cached_job_sheet(job: dict, tenant: dict) -> bytes:
+    key = job_sheet_key(job, tenant)
+    pdf = await pdf_cache.get(key)
+    if pdf is None:
+        # Only exports come through here; their renders share the export slots
+        async with export_render_slots:
+            pdf = await run_pdf_render(render_job_sheet, job, tenant)
+        await pdf_cache.set(key, pdf)
+    return pdf
+
+async def job_sheets_as_completed(query: dict, limit: int, tenant: dict):
+    """Yield (job, pdf, error) as sheets finish, keeping at most one render per export slot in flight.
+    A sheet that fails to render comes back with pdf None and the reason, instead of ending the export."""
+    pending = set()
+    
+    async def render(job: dict) -> tuple:
+        try:
+            return job, await cached_job_sheet(job, tenant), None
+        except HTTPException as e:
+            return job, None, e.detail
+        except Exception:
+            logger.exception(f"Job sheet for {job['job_number']} failed to render")
+            return job, None, "The job sheet could not be rendered"
+    
+    try:
+        async for job in db.jobs.find(query, {"_id": 0}).sort([("created_at", -1), ("id", -1)]).limit(limit):
+            pending.add(asyncio.create_task(render(job)))
+            if len(pending) >= BULK_EXPORT_RENDER_SLOTS:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def stream_job_sheets_zip(query: dict, limit: int, tenant: dict, release_slot):
+    stream = ZipStream()
+    # PDFs are already compressed, so entries are stored as-is
+    archive = zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED)
+    try:
+        async for job, pdf, error in job_sheets_as_completed(query, limit, tenant):
+            if pdf is None:
+                archive.writestr(f"job-{job['job_number']}.error.txt", f"{job['job_number']}: {error}\n")
+            else:
+                archive.writestr(f"job-{job['job_number']}.pdf", pdf)
+            yield stream.drain()
+    except PyMongoError as e:
+        # The headers are long gone, so the only place left to report this is the archive itself
+        logger.error(f"Job sheet export stopped early: {e}")
+        archive.writestr("export-error.txt", "The export stopped early; the job sheets above are complete.\n")
+    finally:
+        # Writes the central directory, so whatever was sent is still a readable archive
+        archive.close()
+        release_slot()
+    yield stream.drain()
+
+@api_router.get("/jobs/export")
+async def export_job_sheets(
+    format: str = "zip",
+    status_filter: Optional[str] = None,
+    branch_id: Optional[str] = None,
+    search: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: Optional[int] = None,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Job sheets for every job matching the list_jobs filters, newest first.
+    format=zip streams one PDF per job as each finishes rendering. format=pdf returns a single
+    print-ready document; a PDF can only be written once all of its pages are laid out, so it is
+    capped at BULK_PDF_MAX_JOBS.
+    """
+    if format not in BULK_EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {sorted(BULK_EXPORT_FORMATS)}")
+    max_jobs = BULK_PDF_MAX_JOBS if format == "pdf" else BULK_EXPORT_MAX_JOBS
+    limit = min(limit or max_jobs, max_jobs)
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    
+    query = await job_list_filter(user["tenant_id"], status_filter, branch_id, search, date_from, date_to)
+    tenant = await db.tenants.find_one({"id": user["tenant_id"]}, {"_id": 0, "company_name": 1, "settings": 1})
+    filename = f"job-sheets-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}"
+    check_pdf_capacity()
+    release_slot = reserve_export_slot()
+    
+    if format == "pdf":
+        try:
+            jobs = await db.jobs.find(query, {"_id": 0}).sort([("created_at", -1), ("id", -1)]).limit(limit).to_list(limit)
+            if not jobs:
+                raise HTTPException(status_code=404, detail="No jobs match these filters")
+            async with export_render_slots:
+                pdf = await run_pdf_render(render_job_sheets, jobs, tenant, timeout=PDF_RENDER_TIMEOUT_SECONDS + len(jobs))
+        finally:
+            release_slot()
+        return Response(
+            content=pdf,
+            media_type="application/pdf",
+            headers={"Content-Disposition": f"attachment; filename={filename}.pdf"}
+        )
     
-    jobs = await db.jobs.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-    return [JobResponse(**j) for j in jobs]
+    # The stream releases the slot when it ends; the background task covers a client gone before it starts
+    return StreamingResponse(
+        stream_job_sheets_zip(query, limit, tenant, release_slot),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}.zip"},
+        background=BackgroundTask(release_slot)
+    )
 
 # ==================== UNIVERSAL SEARCH ====================
 
-@api_router.get("/search")
+@api_router.get("/search", dependencies=[Depends(search_ready)])
 async def universal_search(
     q: str,
     limit: int = 20,
@@ -1305,28 +2805,13 @@ async def universal_search(
     if not q or len(q) < 2:
         return {"results": [], "total": 0}
     
-    # Build comprehensive search query
-    search_regex = {"$regex": q, "$options": "i"}
-    
-    query = {
-        "tenant_id": tenant_id,
-        "$or": [
-            {"job_number": search_regex},
-            {"customer.name": search_regex},
-            {"customer.mobile": search_regex},
-            {"customer.email": search_regex},
-            {"device.brand": search_regex},
-            {"device.model": search_regex},
-            {"device.serial_imei": search_regex},
-            {"problem_description": search_regex},
-            {"technician_observation": search_regex},
-            {"device.notes": search_regex},
-        ]
-    }
+    terms = search_terms(q)
+    if not terms:
+        return {"results": [], "total": 0, "query": q}
     
-    # Get matching jobs
-    jobs = await db.jobs.find(
-        query,
+    # Newest candidates matching every term, ranked by field weight; recency breaks ties
+    candidates = await db.jobs.find(
+        {"tenant_id": tenant_id, "search_keys": {"$all": terms}},
         {
             "_id": 0,
             "id": 1,
@@ -1335,9 +2820,27 @@ async def universal_search(
             "device": 1,
             "status": 1,
             "problem_description": 1,
+            "technician_observation": 1,
             "created_at": 1
         }
-    ).sort("created_at", -1).limit(limit).to_list(limit)
+    ).sort("created_at", -1).limit(SEARCH_CANDIDATES).to_list(SEARCH_CANDIDATES)
+    
+    ranked = sorted(
+        candidates,
+        key=lambda job: (search_score(job_search_fields(job), terms), job["created_at"]),
+        reverse=True
+    )
+    
+    # A job number (or its bare sequence) goes straight to that job
+    seq = job_seq(q.strip()) if re.fullmatch(r"(JOB-\d{4}-)?\d+", q.strip(), re.IGNORECASE) else None
+    if seq is not None:
+        exact = await db.jobs.find(
+            {"tenant_id": tenant_id, "normalized.job_seq": seq},
+            {"_id": 0, "id": 1, "job_number": 1, "customer": 1, "device": 1, "status": 1, "problem_description": 1, "technician_observation": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(5).to_list(5)
+        exact_ids = {job["id"] for job in exact}
+        ranked = exact + [job for job in ranked if job["id"] not in exact_ids]
+    jobs = ranked[:limit]
     
     # Format results for easy display
     results = []
@@ -1348,34 +2851,18 @@ async def universal_search(
             "customer_name": job["customer"]["name"],
             "customer_mobile": job["customer"]["mobile"],
             "device": f"{job['device']['brand']} {job['device']['model']}",
-            "device_serial": job["device"]["serial_imei"],
+            "device_serial": job["device"].get("serial_imei"),
             "status": job["status"],
             "problem": job["problem_description"][:100] + "..." if len(job["problem_description"]) > 100 else job["problem_description"],
             "created_at": job["created_at"],
             "type": "job"
         })
     
-    # Also search customers (unique by mobile)
-    customer_pipeline = [
-        {"$match": {
-            "tenant_id": tenant_id,
-            "$or": [
-                {"customer.name": search_regex},
-                {"customer.mobile": search_regex},
-                {"customer.email": search_regex},
-            ]
-        }},
-        {"$group": {
-            "_id": "$customer.mobile",
-            "name": {"$first": "$customer.name"},
-            "mobile": {"$first": "$customer.mobile"},
-            "email": {"$first": "$customer.email"},
-            "job_count": {"$sum": 1}
-        }},
-        {"$limit": 5}
-    ]
-    
-    customers = await db.jobs.aggregate(customer_pipeline).to_list(5)
+    # Also search customers
+    customers = await db.customers.find(
+        {"tenant_id": tenant_id, "search_keys": {"$all": terms}},
+        {"_id": 0, "name": 1, "mobile": 1, "email": 1, "total_jobs": 1}
+    ).sort("last_visit", -1).limit(5).to_list(5)
     
     for cust in customers:
         results.append({
@@ -1383,24 +2870,18 @@ async def universal_search(
             "customer_name": cust["name"],
             "customer_mobile": cust["mobile"],
             "customer_email": cust.get("email"),
-            "job_count": cust["job_count"],
+            "job_count": cust["total_jobs"],
             "type": "customer"
         })
     
     # Also search inventory
     inventory_items = await db.inventory.find(
-        {
-            "tenant_id": tenant_id,
-            "$or": [
-                {"name": search_regex},
-                {"sku": search_regex},
-                {"description": search_regex},
-            ]
-        },
-        {"_id": 0, "id": 1, "name": 1, "sku": 1, "quantity": 1, "category": 1}
-    ).limit(5).to_list(5)
+        {"tenant_id": tenant_id, "search_keys": {"$all": terms}},
+        {"_id": 0, "id": 1, "name": 1, "sku": 1, "description": 1, "quantity": 1, "category": 1}
+    ).limit(SEARCH_CANDIDATES).to_list(SEARCH_CANDIDATES)
+    inventory_items.sort(key=lambda item: search_score(inventory_search_fields(item), terms), reverse=True)
     
-    for item in inventory_items:
+    for item in inventory_items[:5]:
         results.append({
             "id": item["id"],
             "name": item["name"],
@@ -1416,26 +2897,15 @@ async def universal_search(
         "query": q
     }
 
-@api_router.get("/jobs/stats")
+@api_router.get("/jobs/stats", dependencies=[Depends(job_stats_ready)])
 async def get_job_stats(user: dict = Depends(get_current_user)):
     tenant_id = user["tenant_id"]
     
-    pipeline = [
-        {"$match": {"tenant_id": tenant_id}},
-        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
-    ]
-    
-    status_counts = await db.jobs.aggregate(pipeline).to_list(10)
-    stats = {item["_id"]: item["count"] for item in status_counts}
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    stats, by_date = await job_daily_counts({"tenant_id": tenant_id}, today)
     
     total = sum(stats.values())
-    
-    # Get today's jobs
-    today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    today_count = await db.jobs.count_documents({
-        "tenant_id": tenant_id,
-        "created_at": {"$gte": today_start.isoformat()}
-    })
+    today_count = by_date.get(today, 0)
     
     return {
         "total": total,
@@ -1487,8 +2957,8 @@ async def update_diagnosis(job_id: str, data: DiagnosisUpdate, user: dict = Depe
         "notes": f"Diagnosis complete. Estimated cost: ₹{data.estimated_cost}"
     }
     
-    await db.jobs.update_one(
-        {"id": job_id},
+    await update_job_with_status(
+        job_id,
         {
             "$set": {
                 "diagnosis": diagnosis,
@@ -1530,8 +3000,8 @@ async def approve_job(job_id: str, data: ApprovalUpdate, user: dict = Depends(ge
         "notes": f"Approved by {data.approved_by}. Amount: ₹{data.approved_amount}"
     }
     
-    await db.jobs.update_one(
-        {"id": job_id},
+    await update_job_with_status(
+        job_id,
         {
             "$set": {
                 "approval": approval,
@@ -1565,8 +3035,8 @@ async def mark_pending_parts(job_id: str, notes: Optional[str] = None, user: dic
         "notes": notes or "Waiting for parts"
     }
     
-    await db.jobs.update_one(
-        {"id": job_id},
+    await update_job_with_status(
+        job_id,
         {
             "$set": {"status": "pending_parts", "updated_at": now},
             "$push": {"status_history": status_entry}
@@ -1587,6 +3057,8 @@ async def update_repair(job_id: str, data: RepairUpdate, user: dict = Depends(ge
     
     if job["status"] == "closed":
         raise HTTPException(status_code=400, detail="Cannot update closed job")
+    if job.get("delivery"):
+        await ensure_ledger_writable(tenant_id)
     
     # Process parts from inventory
     parts_used_data = []
@@ -1661,17 +3133,24 @@ async def update_repair(job_id: str, data: RepairUpdate, user: dict = Depends(ge
         "notes": f"Repair complete. Final amount: ₹{data.final_amount}"
     }
     
-    await db.jobs.update_one(
-        {"id": job_id},
-        {
-            "$set": {
-                "repair": repair,
-                "status": "repaired",
-                "updated_at": now
+    async def apply_repair(session):
+        before = await update_job_with_status(
+            job_id,
+            {
+                "$set": {
+                    "repair": repair,
+                    "status": "repaired",
+                    "updated_at": now
+                },
+                "$push": {"status_history": status_entry}
             },
-            "$push": {"status_history": status_entry}
-        }
-    )
+            session=session,
+            fields=LEDGER_JOB_FIELDS
+        )
+        # Re-pricing a delivered job changes what the customer was billed
+        if before:
+            await record_customer_delivery(before, {**before, "repair": repair}, session=session)
+    await in_transaction(apply_repair)
     
     updated_job = await db.jobs.find_one({"id": job_id}, {"_id": 0})
     return JobResponse(**updated_job)
@@ -1687,6 +3166,7 @@ async def deliver_job(job_id: str, data: DeliveryUpdate, user: dict = Depends(ge
     
     if job["status"] == "closed":
         raise HTTPException(status_code=400, detail="Job already closed")
+    await ensure_ledger_writable(user["tenant_id"])
     
     delivery = {
         "delivered_to": data.delivered_to,
@@ -1708,17 +3188,26 @@ async def deliver_job(job_id: str, data: DeliveryUpdate, user: dict = Depends(ge
         "notes": f"Delivered to {data.delivered_to}. Received ₹{data.amount_received} via {data.payment_mode}"
     }
     
-    await db.jobs.update_one(
-        {"id": job_id},
-        {
-            "$set": {
-                "delivery": delivery,
-                "status": "delivered",
-                "updated_at": now
+    # The job and its ledger posting commit together where transactions are available
+    # The ledger delta comes from the job as this update found it, so a second delivery of the
+    # same job (a double click) sees the first one and posts only what changed
+    async def apply_delivery(session):
+        before = await update_job_with_status(
+            job_id,
+            {
+                "$set": {
+                    "delivery": delivery,
+                    "status": "delivered",
+                    "updated_at": now
+                },
+                "$push": {"status_history": status_entry}
             },
-            "$push": {"status_history": status_entry}
-        }
-    )
+            session=session,
+            fields=LEDGER_JOB_FIELDS
+        )
+        if before:
+            await record_customer_delivery(before, {**before, "delivery": delivery}, session=session)
+    await in_transaction(apply_delivery)
     
     updated_job = await db.jobs.find_one({"id": job_id}, {"_id": 0})
     return JobResponse(**updated_job)
@@ -1748,8 +3237,8 @@ async def close_job(job_id: str, user: dict = Depends(get_current_user)):
         "notes": "Job closed"
     }
     
-    await db.jobs.update_one(
-        {"id": job_id},
+    await update_job_with_status(
+        job_id,
         {
             "$set": {
                 "closure": closure,
@@ -1786,8 +3275,8 @@ async def update_job_status(job_id: str, data: StatusUpdate, user: dict = Depend
         "notes": data.notes or f"Status changed to {data.status}"
     }
     
-    await db.jobs.update_one(
-        {"id": job_id},
+    await update_job_with_status(
+        job_id,
         {
             "$set": {"status": data.status, "updated_at": now},
             "$push": {"status_history": status_entry}
@@ -1799,470 +3288,418 @@ async def update_job_status(job_id: str, data: StatusUpdate, user: dict = Depend
 
 # ==================== PDF GENERATION ====================
 
-def generate_qr_code(data: str) -> BytesIO:
-    """Generate QR code as bytes"""
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=8,
-        border=2,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    return buffer
-
-def draw_rounded_rect(canvas, x, y, width, height, radius, fill_color=None, stroke_color=None, stroke_width=1):
-    """Draw a rounded rectangle on the canvas"""
-    from reportlab.lib.colors import Color
-    path = canvas.beginPath()
-    path.moveTo(x + radius, y)
-    path.lineTo(x + width - radius, y)
-    path.arcTo(x + width - radius, y, x + width, y + radius, -90, 90)
-    path.lineTo(x + width, y + height - radius)
-    path.arcTo(x + width - radius, y + height - radius, x + width, y + height, 0, 90)
-    path.lineTo(x + radius, y + height)
-    path.arcTo(x, y + height - radius, x + radius, y + height, 90, 90)
-    path.lineTo(x, y + radius)
-    path.arcTo(x, y, x + radius, y + radius, 180, 90)
-    path.close()
-    
-    if fill_color:
-        canvas.setFillColor(fill_color)
-        canvas.drawPath(path, fill=1, stroke=0)
-    if stroke_color:
-        canvas.setStrokeColor(stroke_color)
-        canvas.setLineWidth(stroke_width)
-        canvas.drawPath(path, fill=0, stroke=1)
+# ReportLab rendering is CPU-bound, so it runs in a small process pool instead of on the event loop.
+# Requests beyond the workers plus PDF_RENDER_QUEUE_SIZE waiting renders are turned away with a 429.
+pdf_executor = None
+pdf_renders_pending = 0
+
+def get_pdf_executor() -> ProcessPoolExecutor:
+    global pdf_executor
+    if pdf_executor is None:
+        # spawn: forking a process that already runs the event loop and driver threads is unsafe
+        pdf_executor = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return pdf_executor
+
+def pdf_render_done(_):
+    global pdf_renders_pending
+    pdf_renders_pending -= 1
+
+def check_pdf_capacity():
+    if pdf_renders_pending >= PDF_RENDER_WORKERS + PDF_RENDER_QUEUE_SIZE:
+        raise HTTPException(status_code=429, detail="Too many PDFs being generated, please retry shortly",
+                            headers={"Retry-After": "2"})
+
+async def render_pdf(render, *args) -> bytes:
+    """Run a PDF render function in the worker pool with backpressure and a timeout"""
+    check_pdf_capacity()
+    return await run_pdf_render(render, *args)
+
+async def run_pdf_render(render, *args, timeout: int = PDF_RENDER_TIMEOUT_SECONDS) -> bytes:
+    """Submit a render to the worker pool without the queue check (callers bound their own concurrency)"""
+    global pdf_executor, pdf_renders_pending
+    try:
+        future = asyncio.wrap_future(get_pdf_executor().submit(render, *args))
+    except BrokenProcessPool:
+        pdf_executor = None
+        future = asyncio.wrap_future(get_pdf_executor().submit(render, *args))
+    pdf_renders_pending += 1
+    # Counted until the worker actually finishes, even if this request times out first
+    future.add_done_callback(pdf_render_done)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="PDF generation timed out")
+    except BrokenProcessPool:
+        pdf_executor = None
+        raise HTTPException(status_code=503, detail="PDF generation is unavailable, please retry")
+
+class PdfCache:
+    """Size-bounded LRU of rendered PDFs in a directory, one file per content hash.
+    The index is per process; files another worker evicted are simply treated as misses."""
+    
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = None  # key -> size, least recently used first
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def scan(self) -> OrderedDict:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = sorted((p.stat().st_mtime, p.stem, p.stat().st_size) for p in self.directory.glob("*.pdf"))
+        return OrderedDict((key, size) for _, key, size in files)
+    
+    async def load(self):
+        """Index the directory once; the scan runs in a thread since a full cache holds thousands of files"""
+        if self.entries is not None:
+            return
+        entries = await asyncio.to_thread(self.scan)
+        # Another caller may have finished loading while this scan ran
+        if self.entries is None:
+            self.entries = entries
+            self.total = sum(entries.values())
+    
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.pdf"
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        await self.load()
+        try:
+            async with aiofiles.open(self.path(key), 'rb') as f:
+                data = await f.read()
+        except FileNotFoundError:
+            self.total -= self.entries.pop(key, 0)
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(self.path(key))
+        # The file may be one another worker wrote after this index was loaded
+        self.total += len(data) - self.entries.pop(key, 0)
+        self.entries[key] = len(data)
+        self.evict()
+        return data
+    
+    async def set(self, key: str, data: bytes):
+        await self.load()
+        tmp_path = self.directory / f"{key}.{uuid.uuid4().hex}.tmp"
+        async with aiofiles.open(tmp_path, 'wb') as f:
+            await f.write(data)
+        os.replace(tmp_path, self.path(key))
+        self.total += len(data) - self.entries.pop(key, 0)
+        self.entries[key] = len(data)
+        self.evict()
+    
+    def evict(self):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            old_key, size = self.entries.popitem(last=False)
+            self.total -= size
+            self.evictions += 1
+            self.path(old_key).unlink(missing_ok=True)
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries or ()),
+            "bytes": self.total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0
+        }
+
+pdf_cache = PdfCache(PDF_CACHE_DIR, PDF_CACHE_MAX_MB * 1024 * 1024)
+CACHES["pdf"] = pdf_cache
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(","))
 
 @api_router.get("/jobs/{job_id}/pdf")
-async def generate_job_pdf(job_id: str, user: dict = Depends(get_current_user)):
-    from reportlab.lib.colors import HexColor, Color, black, white, lightgrey
-    from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
-    from reportlab.platypus import HRFlowable
-    
+async def generate_job_pdf(
+    job_id: str,
+    if_none_match: Optional[str] = Header(None),
+    user: dict = Depends(get_current_user)
+):
     job = await db.jobs.find_one({"id": job_id, "tenant_id": user["tenant_id"]}, {"_id": 0})
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    tenant = await db.tenants.find_one({"id": user["tenant_id"]}, {"_id": 0})
-    settings = tenant.get("settings", {})
-    
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(
-        buffer, 
-        pagesize=A4, 
-        rightMargin=15*mm, 
-        leftMargin=15*mm, 
-        topMargin=15*mm, 
-        bottomMargin=15*mm
-    )
-    
-    # Define colors
-    primary_color = HexColor("#2563eb")  # Blue
-    dark_color = HexColor("#1e293b")  # Dark slate
-    muted_color = HexColor("#64748b")  # Slate
-    light_bg = HexColor("#f8fafc")  # Light background
-    border_color = HexColor("#e2e8f0")  # Border
-    success_color = HexColor("#22c55e")  # Green
-    
-    # Define styles
-    styles = getSampleStyleSheet()
-    
-    company_style = ParagraphStyle(
-        'CompanyName',
-        parent=styles['Heading1'],
-        fontSize=22,
-        textColor=dark_color,
-        spaceAfter=2,
-        fontName='Helvetica-Bold'
-    )
-    
-    job_number_style = ParagraphStyle(
-        'JobNumber',
-        parent=styles['Normal'],
-        fontSize=11,
-        textColor=white,
-        alignment=TA_CENTER,
-        fontName='Helvetica-Bold'
-    )
-    
-    section_title_style = ParagraphStyle(
-        'SectionTitle',
-        parent=styles['Heading2'],
-        fontSize=11,
-        textColor=primary_color,
-        spaceBefore=12,
-        spaceAfter=6,
-        fontName='Helvetica-Bold',
-        borderPadding=5
-    )
-    
-    label_style = ParagraphStyle(
-        'Label',
-        parent=styles['Normal'],
-        fontSize=9,
-        textColor=muted_color,
-        fontName='Helvetica'
-    )
+    tenant = await db.tenants.find_one({"id": user["tenant_id"]}, {"_id": 0, "company_name": 1, "settings": 1})
     
-    value_style = ParagraphStyle(
-        'Value',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=dark_color,
-        fontName='Helvetica-Bold'
-    )
-    
-    normal_style = ParagraphStyle(
-        'NormalText',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=dark_color,
-        fontName='Helvetica'
-    )
+    # Any change to the job or the shop settings yields a new key, so stale sheets are never served
+    key = job_sheet_key(job, tenant)
+    headers = {"ETag": f'"{key}"', "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
     
-    small_style = ParagraphStyle(
-        'SmallText',
-        parent=styles['Normal'],
-        fontSize=8,
-        textColor=muted_color,
-        fontName='Helvetica'
-    )
+    pdf = await pdf_cache.get(key)
+    if pdf is None:
+        pdf = await render_pdf(render_job_sheet, job, tenant)
+        await pdf_cache.set(key, pdf)
     
-    footer_style = ParagraphStyle(
-        'Footer',
-        parent=styles['Normal'],
-        fontSize=9,
-        textColor=muted_color,
-        alignment=TA_CENTER,
-        fontName='Helvetica-Oblique'
+    return Response(
+        content=pdf,
+        media_type="application/pdf",
+        headers={**headers, "Content-Disposition": f"attachment; filename=job-{job['job_number']}.pdf"}
     )
-    
-    elements = []
-    
-    # ============ HEADER SECTION ============
-    # Generate QR code for public tracking
-    tracking_token = job.get("tracking_token", "")
-    job_number = job['job_number']
-    tracking_url = f"{job_number}|{tracking_token}"
-    qr_buffer = generate_qr_code(tracking_url)
-    qr_image = Image(qr_buffer, width=22*mm, height=22*mm)
-    
-    # Shop details
-    shop_name = tenant["company_name"]
-    shop_address = settings.get("address", "")
-    shop_phone = settings.get("phone", "")
-    shop_email = settings.get("email", "")
-    
-    shop_details_parts = []
-    if shop_address:
-        shop_details_parts.append(shop_address)
-    if shop_phone:
-        shop_details_parts.append(f"📞 {shop_phone}")
-    if shop_email:
-        shop_details_parts.append(f"✉ {shop_email}")
-    shop_details = " | ".join(shop_details_parts) if shop_details_parts else ""
-    
-    # Header layout: Shop info on left, QR + Job number on right
-    header_left = [
-        [Paragraph(shop_name, company_style)],
-        [Paragraph(shop_details, small_style)] if shop_details else [Spacer(1, 1)],
-    ]
-    header_left_table = Table(header_left, colWidths=[120*mm])
-    
-    # Job number badge
-    job_badge_style = ParagraphStyle(
-        'JobBadge',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=white,
-        alignment=TA_CENTER,
-        fontName='Helvetica-Bold',
-        leading=14
+
+# ==================== TRACKING QR CODES ====================
+# The QR on a job sheet encodes the job's tracking payload, which never changes, so the image is
+# generated once per payload (memoized in job_sheet_pdf.qr_code) and served with immutable headers.
+
+async def load_qr_code(payload: str, format: str) -> bytes:
+    if not QR_PERSIST_DIR:
+        return await asyncio.to_thread(qr_code, payload, format)
+    path = Path(QR_PERSIST_DIR) / f"{hashlib.sha256(payload.encode()).hexdigest()}.{format}"
+    try:
+        async with aiofiles.open(path, 'rb') as f:
+            return await f.read()
+    except FileNotFoundError:
+        pass
+    image = await asyncio.to_thread(qr_code, payload, format)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    async with aiofiles.open(tmp_path, 'wb') as f:
+        await f.write(image)
+    os.replace(tmp_path, path)
+    return image
+
+@api_router.get("/jobs/{job_id}/qr")
+async def get_job_qr(
+    job_id: str,
+    format: str = "png",
+    if_none_match: Optional[str] = Header(None),
+    user: dict = Depends(get_current_user)
+):
+    """The job's tracking QR code, the same image printed on its job sheet"""
+    if format not in QR_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {sorted(QR_FORMATS)}")
+    job = await db.jobs.find_one(
+        {"id": job_id, "tenant_id": user["tenant_id"]},
+        {"_id": 0, "job_number": 1, "tracking_token": 1}
     )
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
     
-    # Create job number and date display
-    job_date = job['created_at'][:10] if job.get('created_at') else ""
-    
-    header_right_content = [
-        [qr_image],
-        [Paragraph(f"<b>{job_number}</b>", ParagraphStyle('JN', fontSize=9, textColor=dark_color, alignment=TA_CENTER, fontName='Helvetica-Bold'))],
-        [Paragraph(f"{job_date}", ParagraphStyle('JD', fontSize=8, textColor=muted_color, alignment=TA_CENTER))]
-    ]
-    header_right_table = Table(header_right_content, colWidths=[28*mm])
-    header_right_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
-    
-    # Combine header
-    main_header = Table(
-        [[header_left_table, header_right_table]],
-        colWidths=[145*mm, 30*mm]
-    )
-    main_header.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-    ]))
-    elements.append(main_header)
-    
-    # Divider line
-    elements.append(Spacer(1, 3*mm))
-    elements.append(HRFlowable(width="100%", thickness=1, color=border_color, spaceBefore=0, spaceAfter=8))
-    
-    # ============ STATUS BADGE ============
-    status_map = {
-        "received": ("📥 RECEIVED", "#3b82f6"),
-        "diagnosed": ("🔍 DIAGNOSED", "#8b5cf6"),
-        "waiting_for_approval": ("⏳ AWAITING APPROVAL", "#f59e0b"),
-        "in_progress": ("🔧 IN PROGRESS", "#06b6d4"),
-        "repaired": ("✅ REPAIRED", "#22c55e"),
-        "delivered": ("📦 DELIVERED", "#10b981"),
-        "closed": ("✔️ CLOSED", "#6b7280"),
-        "cancelled": ("❌ CANCELLED", "#ef4444"),
+    payload = tracking_payload(job)
+    headers = {
+        "ETag": f'"{hashlib.sha256(f"{format}:{payload}".encode()).hexdigest()[:32]}"',
+        "Cache-Control": "private, max-age=31536000, immutable"
     }
-    status_text, status_color = status_map.get(job.get("status", "received"), ("RECEIVED", "#3b82f6"))
-    
-    status_style = ParagraphStyle(
-        'Status',
-        fontSize=10,
-        textColor=HexColor(status_color),
-        fontName='Helvetica-Bold',
-        alignment=TA_RIGHT
-    )
-    
-    # ============ CUSTOMER & DEVICE SECTION (Side by Side) ============
-    customer = job["customer"]
-    device = job["device"]
-    
-    # Customer info card
-    customer_rows = [
-        [Paragraph("👤 CUSTOMER DETAILS", section_title_style)],
-        [Paragraph(f"<b>{customer['name']}</b>", value_style)],
-        [Paragraph(f"📱 {customer['mobile']}", normal_style)],
-    ]
-    if customer.get("email"):
-        customer_rows.append([Paragraph(f"✉ {customer['email']}", normal_style)])
-    if customer.get("address"):
-        customer_rows.append([Paragraph(f"📍 {customer['address']}", small_style)])
-    
-    customer_table = Table(customer_rows, colWidths=[85*mm])
-    customer_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), light_bg),
-        ('BOX', (0, 0), (-1, -1), 0.5, border_color),
-        ('TOPPADDING', (0, 0), (-1, -1), 4),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-    ]))
-    
-    # Device info card
-    device_rows = [
-        [Paragraph("📱 DEVICE DETAILS", section_title_style)],
-        [Paragraph(f"<b>{device['brand']} {device['model']}</b>", value_style)],
-        [Paragraph(f"Type: {device['device_type']}", normal_style)],
-    ]
-    if device.get("serial_imei"):
-        device_rows.append([Paragraph(f"IMEI/Serial: {device['serial_imei']}", small_style)])
-    if device.get("condition"):
-        device_rows.append([Paragraph(f"Condition: {device['condition']}", small_style)])
-    if device.get("password"):
-        device_rows.append([Paragraph(f"🔐 Password: {device['password']}", small_style)])
-    if device.get("unlock_pattern"):
-        device_rows.append([Paragraph(f"🔓 Pattern: {device['unlock_pattern']}", small_style)])
-    
-    device_table = Table(device_rows, colWidths=[85*mm])
-    device_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), light_bg),
-        ('BOX', (0, 0), (-1, -1), 0.5, border_color),
-        ('TOPPADDING', (0, 0), (-1, -1), 4),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-    ]))
-    
-    # Side by side layout
-    side_by_side = Table(
-        [[customer_table, device_table]],
-        colWidths=[87*mm, 87*mm],
-        hAlign='LEFT'
-    )
-    side_by_side.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-    ]))
-    elements.append(side_by_side)
-    elements.append(Spacer(1, 4*mm))
-    
-    # ============ ACCESSORIES SECTION ============
-    checked_accessories = [a["name"] for a in job.get("accessories", []) if a.get("checked")]
-    if checked_accessories:
-        elements.append(Paragraph("🎒 ACCESSORIES RECEIVED", section_title_style))
-        acc_text = " • ".join(checked_accessories)
-        acc_table = Table([[Paragraph(acc_text, normal_style)]], colWidths=[174*mm])
-        acc_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), light_bg),
-            ('BOX', (0, 0), (-1, -1), 0.5, border_color),
-            ('TOPPADDING', (0, 0), (-1, -1), 6),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ('LEFTPADDING', (0, 0), (-1, -1), 8),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-        ]))
-        elements.append(acc_table)
-        elements.append(Spacer(1, 4*mm))
-    
-    # ============ PROBLEM DESCRIPTION ============
-    elements.append(Paragraph("⚠️ PROBLEM DESCRIPTION", section_title_style))
-    problem_table = Table([[Paragraph(job.get("problem_description", "N/A"), normal_style)]], colWidths=[174*mm])
-    problem_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), HexColor("#fef3c7")),  # Amber light
-        ('BOX', (0, 0), (-1, -1), 0.5, HexColor("#f59e0b")),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('LEFTPADDING', (0, 0), (-1, -1), 10),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 10),
-    ]))
-    elements.append(problem_table)
-    elements.append(Spacer(1, 4*mm))
-    
-    # ============ DIAGNOSIS SECTION ============
-    if job.get("diagnosis"):
-        diag = job["diagnosis"]
-        elements.append(Paragraph("🔍 DIAGNOSIS", section_title_style))
-        
-        diag_content = [
-            [Paragraph("Findings:", label_style), Paragraph(diag.get("diagnosis", "N/A"), normal_style)],
-            [Paragraph("Est. Cost:", label_style), Paragraph(f"<b>₹{diag.get('estimated_cost', 0):,.2f}</b>", value_style)],
-            [Paragraph("Timeline:", label_style), Paragraph(diag.get("estimated_timeline", "N/A"), normal_style)],
-        ]
-        if diag.get("parts_required"):
-            diag_content.append([Paragraph("Parts Needed:", label_style), Paragraph(diag.get("parts_required", ""), normal_style)])
-        
-        diag_table = Table(diag_content, colWidths=[30*mm, 144*mm])
-        diag_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), light_bg),
-            ('BOX', (0, 0), (-1, -1), 0.5, border_color),
-            ('TOPPADDING', (0, 0), (-1, -1), 4),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-            ('LEFTPADDING', (0, 0), (-1, -1), 8),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ]))
-        elements.append(diag_table)
-        elements.append(Spacer(1, 4*mm))
-    
-    # ============ REPAIR SECTION ============
-    if job.get("repair"):
-        repair = job["repair"]
-        elements.append(Paragraph("🔧 REPAIR DETAILS", section_title_style))
-        
-        repair_content = [
-            [Paragraph("Work Done:", label_style), Paragraph(repair.get("work_done", "N/A"), normal_style)],
-        ]
-        
-        # Parts used from inventory
-        if repair.get("parts_used") and len(repair["parts_used"]) > 0:
-            parts_text = ", ".join([f"{p.get('item_name', 'Part')} (×{p.get('quantity', 1)})" for p in repair["parts_used"]])
-            repair_content.append([Paragraph("Parts Used:", label_style), Paragraph(parts_text, normal_style)])
-        
-        if repair.get("parts_replaced"):
-            repair_content.append([Paragraph("Other Parts:", label_style), Paragraph(repair.get("parts_replaced", ""), normal_style)])
-        
-        repair_content.append([Paragraph("Final Amount:", label_style), Paragraph(f"<b>₹{repair.get('final_amount', 0):,.2f}</b>", ParagraphStyle('Amount', fontSize=12, textColor=success_color, fontName='Helvetica-Bold'))])
-        
-        if repair.get("warranty_info"):
-            repair_content.append([Paragraph("Warranty:", label_style), Paragraph(repair.get("warranty_info", ""), normal_style)])
-        
-        repair_table = Table(repair_content, colWidths=[30*mm, 144*mm])
-        repair_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), HexColor("#dcfce7")),  # Green light
-            ('BOX', (0, 0), (-1, -1), 0.5, success_color),
-            ('TOPPADDING', (0, 0), (-1, -1), 4),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-            ('LEFTPADDING', (0, 0), (-1, -1), 8),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ]))
-        elements.append(repair_table)
-        elements.append(Spacer(1, 4*mm))
-    
-    # ============ DELIVERY SECTION ============
-    if job.get("delivery"):
-        delivery = job["delivery"]
-        elements.append(Paragraph("📦 DELIVERY DETAILS", section_title_style))
-        
-        delivery_content = [
-            [Paragraph("Delivered To:", label_style), Paragraph(delivery.get("delivered_to", "N/A"), normal_style)],
-            [Paragraph("Amount Received:", label_style), Paragraph(f"<b>₹{delivery.get('amount_received', 0):,.2f}</b>", value_style)],
-            [Paragraph("Payment Mode:", label_style), Paragraph(delivery.get("payment_mode", "N/A").upper(), normal_style)],
-        ]
-        if delivery.get("payment_reference"):
-            delivery_content.append([Paragraph("Reference:", label_style), Paragraph(delivery.get("payment_reference", ""), normal_style)])
-        if delivery.get("delivery_notes"):
-            delivery_content.append([Paragraph("Notes:", label_style), Paragraph(delivery.get("delivery_notes", ""), normal_style)])
-        
-        delivery_table = Table(delivery_content, colWidths=[35*mm, 139*mm])
-        delivery_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), light_bg),
-            ('BOX', (0, 0), (-1, -1), 0.5, border_color),
-            ('TOPPADDING', (0, 0), (-1, -1), 4),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-            ('LEFTPADDING', (0, 0), (-1, -1), 8),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ]))
-        elements.append(delivery_table)
-        elements.append(Spacer(1, 4*mm))
-    
-    # ============ TERMS & CONDITIONS ============
-    elements.append(Spacer(1, 6*mm))
-    terms_style = ParagraphStyle('Terms', fontSize=7, textColor=muted_color, fontName='Helvetica', leading=9)
-    terms_text = """
-    <b>Terms & Conditions:</b> 1. Please collect your device within 30 days of repair completion. 
-    2. Warranty covers only the specific repair performed. 3. Data backup is the customer's responsibility. 
-    4. We are not responsible for any pre-existing damage or defects. 5. Payment is due upon delivery.
-    """
-    elements.append(Paragraph(terms_text.strip(), terms_style))
-    
-    # ============ SIGNATURE SECTION ============
-    elements.append(Spacer(1, 10*mm))
-    
-    sig_label_style = ParagraphStyle('SigLabel', fontSize=8, textColor=muted_color, alignment=TA_CENTER)
-    sig_line_style = ParagraphStyle('SigLine', fontSize=10, textColor=dark_color, alignment=TA_CENTER)
-    
-    sig_data = [
-        [Paragraph("_" * 30, sig_line_style), Paragraph("_" * 30, sig_line_style)],
-        [Paragraph("Customer Signature", sig_label_style), Paragraph("Authorized Signature", sig_label_style)],
-    ]
-    sig_table = Table(sig_data, colWidths=[87*mm, 87*mm])
-    sig_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('TOPPADDING', (0, 0), (-1, -1), 2),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-    ]))
-    elements.append(sig_table)
-    
-    # ============ FOOTER ============
-    elements.append(Spacer(1, 8*mm))
-    elements.append(HRFlowable(width="100%", thickness=0.5, color=border_color, spaceBefore=0, spaceAfter=4))
-    
-    footer_text = settings.get("footer_text", "Thank you for choosing us!")
-    elements.append(Paragraph(footer_text, footer_style))
-    elements.append(Paragraph(f"Generated on {datetime.now(timezone.utc).strftime('%d %b %Y, %H:%M')} UTC", ParagraphStyle('GenDate', fontSize=7, textColor=lightgrey, alignment=TA_CENTER)))
-    
-    doc.build(elements)
-    buffer.seek(0)
-    
-    return StreamingResponse(
-        buffer,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename=job-{job['job_number']}.pdf"}
-    )
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=await load_qr_code(payload, format), media_type=QR_FORMATS[format], headers=headers)
+
+# ==================== PHOTO STORAGE ====================
+# Photo files and their variants are addressed by key ("<tenant_id>/<file>") and always linked as
+# /uploads/<key>, whichever backend holds them. Local disk serves that path itself; with S3 it
+# redirects to a presigned URL so image bytes never pass through the API.
+
+class UploadFiles(StaticFiles):
+    """Stored files are named by content hash and never rewritten, so browsers may keep them for good"""
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+class LocalStorage:
+    """Files under UPLOAD_DIR, only usable while a single server owns that disk"""
+    def __init__(self, root: Path):
+        self.root = root
+
+    async def put_file(self, key: str, path: Path):
+        """Move a staged file into storage; it is consumed"""
+        target = self.root / key
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # UPLOAD_STAGING_DIR may be another filesystem, where a rename fails with EXDEV. Moving next to
+        # the target first (a copy only in that case) keeps the final rename atomic.
+        staged = target.with_name(f".{uuid.uuid4().hex}.tmp")
+        try:
+            await asyncio.to_thread(shutil.move, path, staged)
+            os.replace(staged, target)
+        except BaseException:
+            staged.unlink(missing_ok=True)
+            raise
+
+    async def exists(self, key: str) -> bool:
+        return (self.root / key).exists()
+
+    async def delete(self, key: str):
+        (self.root / key).unlink(missing_ok=True)
+
+    @asynccontextmanager
+    async def local_copy(self, key: str, directory: Path):
+        """A readable local path for the file; the stored file itself"""
+        yield self.root / key
+
+    def asgi_app(self):
+        return UploadFiles(directory=str(self.root))
+
+class S3Storage:
+    """An S3-compatible bucket shared by every server. One client (thread-safe, with its own connection
+    pool) serves all calls, which run on worker threads; large files go up in multipart chunks."""
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            region_name=S3_REGION,
+            config=BotoConfig(max_pool_connections=S3_MAX_POOL_CONNECTIONS, retries={"mode": "standard"})
+        )
+        # S3 refuses multipart parts under 5 MB, other than the last one
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+            multipart_chunksize=max(S3_MULTIPART_THRESHOLD_MB, 5) * 1024 * 1024
+        )
+        # Handing out the same URL for a while lets browsers cache the image behind it
+        self.presigned_urls = TTLCache(maxsize=USER_CACHE_SIZE, ttl=S3_PRESIGN_EXPIRES_SECONDS // 2)
+
+    async def put_file(self, key: str, path: Path):
+        """Upload a staged file; it is consumed"""
+        extra_args = {
+            "ContentType": mimetypes.guess_type(key)[0] or "application/octet-stream",
+            "CacheControl": "public, max-age=31536000, immutable"
+        }
+        try:
+            await asyncio.to_thread(
+                self.client.upload_file, str(path), self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config
+            )
+        finally:
+            path.unlink(missing_ok=True)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self.client.head_object, Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=key)
+        self.presigned_urls.invalidate(key)
+
+    @asynccontextmanager
+    async def local_copy(self, key: str, directory: Path):
+        """A readable local path for the file; a download into directory, removed afterwards"""
+        path = directory / Path(key).name
+        await asyncio.to_thread(self.client.download_file, self.bucket, key, str(path))
+        try:
+            yield path
+        finally:
+            path.unlink(missing_ok=True)
+
+    def presigned_url(self, key: str) -> str:
+        url = self.presigned_urls.get(key)
+        if url is None:
+            url = self.client.generate_presigned_url(
+                "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=S3_PRESIGN_EXPIRES_SECONDS
+            )
+            self.presigned_urls.set(key, url)
+        return url
+
+    def asgi_app(self):
+        async def redirect(request):
+            return RedirectResponse(
+                self.presigned_url(request.path_params["key"]),
+                status_code=307,
+                # Never let a browser follow a cached redirect to an expired URL
+                headers={"Cache-Control": f"private, max-age={S3_PRESIGN_EXPIRES_SECONDS // 2}"}
+            )
+        return Router(routes=[Route("/{key:path}", redirect)])
+
+if STORAGE_BACKEND == "s3":
+    if not S3_BUCKET:
+        raise RuntimeError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+    storage = S3Storage(S3_BUCKET)
+    CACHES["presigned_urls"] = storage.presigned_urls
+else:
+    storage = LocalStorage(UPLOAD_DIR)
+
+app.mount("/uploads", storage.asgi_app(), name="uploads")
 
 # ==================== PHOTO UPLOAD ====================
 
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.heic'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 256 * 1024))
+# Room for the multipart boundaries and the other form fields around the file itself
+MAX_UPLOAD_REQUEST_SIZE = MAX_FILE_SIZE + 64 * 1024
+PHOTO_UPLOAD_PATH = re.compile(r"^/api/jobs/[^/]+/photos$")
+
+def upload_too_large() -> JSONResponse:
+    return JSONResponse(status_code=413, content={"detail": "File too large. Maximum 10MB allowed"},
+                        headers={"Connection": "close"})
+
+class UploadSizeLimitMiddleware:
+    """Turn away photo uploads over the limit with a 413: before the body is read when the declared
+    Content-Length is too big, otherwise (chunked uploads) as soon as the bytes received pass it"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not (scope["type"] == "http" and scope["method"] == "POST" and PHOTO_UPLOAD_PATH.match(scope["path"])):
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_REQUEST_SIZE:
+            await upload_too_large()(scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_UPLOAD_REQUEST_SIZE:
+                    rejected = True
+                    if not response_started:
+                        await upload_too_large()(scope, receive, send)
+                    # The handler sees a client that went away and stops reading
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if rejected:
+                # The 413 has already gone out in place of whatever the handler answers
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+async def save_upload(file: UploadFile, directory: Path) -> tuple:
+    """Copy an upload to a temp file in directory in chunks, hashing it and giving up as soon as it
+    passes MAX_FILE_SIZE. Returns (temp path, size, sha256); the caller renames it into place, so a
+    partial photo is never visible."""
+    tmp_path = directory / f".{uuid.uuid4().hex}.tmp"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise HTTPException(status_code=413, detail="File too large. Maximum 10MB allowed")
+                digest.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return tmp_path, size, digest.hexdigest()
 
 @api_router.post("/jobs/{job_id}/photos")
 async def upload_job_photo(
@@ -2291,34 +3728,27 @@ async def upload_job_photo(
     if file_ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(status_code=400, detail=f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}")
     
-    # Read and check file size
-    contents = await file.read()
-    if len(contents) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=400, detail="File too large. Maximum 10MB allowed")
-    
-    # Create tenant-specific directory
-    tenant_dir = UPLOAD_DIR / user["tenant_id"]
-    tenant_dir.mkdir(exist_ok=True)
-    
-    # Generate unique filename
-    photo_id = str(uuid.uuid4())
-    filename = f"{job_id}_{photo_id}{file_ext}"
-    file_path = tenant_dir / filename
-    
-    # Save file
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(contents)
+    # Stream to disk, checking the size as we go, then store it under its content hash
+    tmp_path, size, digest = await save_upload(file, UPLOAD_STAGING_DIR)
+    try:
+        blob = await add_photo_blob(user["tenant_id"], tmp_path, size, digest, file_ext)
+    finally:
+        tmp_path.unlink(missing_ok=True)
     
     # Create photo record
     now = datetime.now(timezone.utc).isoformat()
     photo = {
-        "id": photo_id,
-        "filename": filename,
-        "url": f"/uploads/{user['tenant_id']}/{filename}",
+        "id": str(uuid.uuid4()),
+        "filename": blob["filename"],
+        "url": f"/uploads/{user['tenant_id']}/{blob['filename']}",
+        "sha256": digest,
         "type": photo_type,
+        "size": size,
         "uploaded_by": user["id"],
         "uploaded_at": now
     }
+    if "variants" in blob:
+        photo["variants"] = blob["variants"]
     
     # Update job with photo
     await db.jobs.update_one(
@@ -2329,6 +3759,16 @@ async def upload_job_photo(
         }
     )
     
+    # Variants finished after the blob was read copied themselves onto every photo but this one
+    if "variants" not in photo:
+        blob = await db.photo_blobs.find_one({"tenant_id": user["tenant_id"], "sha256": digest}, {"_id": 0, "variants": 1})
+        if blob and "variants" in blob:
+            photo["variants"] = blob["variants"]
+            await db.jobs.update_one(
+                {"id": job_id, "photos.id": photo["id"]},
+                {"$set": {"photos.$.variants": blob["variants"]}}
+            )
+    
     return {"message": "Photo uploaded successfully", "photo": photo}
 
 @api_router.delete("/jobs/{job_id}/photos/{photo_id}")
@@ -2347,23 +3787,189 @@ async def delete_job_photo(
     if not photo:
         raise HTTPException(status_code=404, detail="Photo not found")
     
-    # Delete file from disk
-    file_path = UPLOAD_DIR / user["tenant_id"] / photo["filename"]
-    if file_path.exists():
-        file_path.unlink()
-    
     # Remove from database
     now = datetime.now(timezone.utc).isoformat()
-    await db.jobs.update_one(
-        {"id": job_id},
+    result = await db.jobs.update_one(
+        {"id": job_id, "photos.id": photo_id},
         {
             "$pull": {"photos": {"id": photo_id}},
             "$set": {"updated_at": now}
         }
     )
     
+    # The file goes with the last photo that references it
+    if result.modified_count and photo.get("sha256"):
+        await release_photo_blob(user["tenant_id"], photo["sha256"])
+    elif result.modified_count:
+        # Stored before content addressing and not found on disk by the migration
+        await storage.delete(f"{user['tenant_id']}/{photo['filename']}")
+    
     return {"message": "Photo deleted successfully"}
 
+# ==================== PHOTO BLOBS ====================
+# Photo files are stored once per tenant under their SHA-256 (key <tenant>/<sha256><ext>) and
+# counted in photo_blobs, one reference per job photo. Uploading the same image again only adds a
+# reference; the file and its variants go when the last photo using it is deleted. storage_bytes
+# counts each blob once and is adjusted as blobs come and go, never by walking the disk.
+
+async def add_photo_blob(tenant_id: str, tmp_path: Path, size: int, digest: str, ext: str) -> dict:
+    """Take a reference on the blob with this content, moving the uploaded temp file into storage if it's new"""
+    existing = await db.photo_blobs.find_one({"tenant_id": tenant_id, "sha256": digest}, {"_id": 1})
+    if not existing:
+        storage_check = await check_storage_limit(tenant_id, size)
+        if not storage_check["allowed"]:
+            raise HTTPException(status_code=403, detail=storage_check["message"])
+    
+    update = {
+        "$inc": {"refs": 1},
+        "$setOnInsert": {"filename": f"{digest}{ext}", "size": size, "created_at": datetime.now(timezone.utc).isoformat()}
+    }
+    try:
+        before = await db.photo_blobs.find_one_and_update(
+            {"tenant_id": tenant_id, "sha256": digest}, update, projection={"_id": 0}, upsert=True
+        )
+    except DuplicateKeyError:
+        # Lost an insert race with an identical upload; take a reference on the winner's blob
+        before = await db.photo_blobs.find_one_and_update(
+            {"tenant_id": tenant_id, "sha256": digest}, update, projection={"_id": 0}
+        )
+    
+    blob = before or {"tenant_id": tenant_id, "sha256": digest, "filename": f"{digest}{ext}", "size": size}
+    key = f"{tenant_id}/{blob['filename']}"
+    if before is None or not await storage.exists(key):
+        await storage.put_file(key, tmp_path)
+    if before is None:
+        await bump_usage(tenant_id, {"storage_bytes": size})
+        schedule_photo_variants(tenant_id, blob)
+    return blob
+
+async def release_photo_blob(tenant_id: str, digest: str):
+    """Drop one reference; the last one removes the file, its variants and their storage"""
+    blob = await db.photo_blobs.find_one_and_update(
+        {"tenant_id": tenant_id, "sha256": digest},
+        {"$inc": {"refs": -1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not blob or blob["refs"] > 0:
+        return
+    # Only if nobody took a new reference in the meantime
+    result = await db.photo_blobs.delete_one({"tenant_id": tenant_id, "sha256": digest, "refs": {"$lte": 0}})
+    if result.deleted_count:
+        await storage.delete(f"{tenant_id}/{blob['filename']}")
+        await remove_photo_variants(tenant_id, blob["filename"])
+        await bump_usage(tenant_id, {"storage_bytes": -(blob["size"] + blob.get("variants_size", 0))})
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ==================== PHOTO VARIANTS ====================
+# Galleries show 120 px tiles, so each new blob gets WebP thumb/medium variants (HEIC included) on a
+# worker thread. Their URLs are kept on the blob and copied to its photos as "variants"; until then,
+# or if the image can't be decoded, clients fall back to the original "url".
+
+photo_variant_slots = asyncio.Semaphore(PHOTO_VARIANT_WORKERS)
+# Keeps a reference to in-flight variant tasks so they aren't garbage collected mid-run
+photo_variant_tasks = set()
+
+async def remove_photo_variants(tenant_id: str, filename: str):
+    for name in VARIANT_SIZES:
+        await storage.delete(f"{tenant_id}/variants/{variant_filename(filename, name)}")
+
+async def set_photo_variants(tenant_id: str, digest: str, variants: dict):
+    """Copy a blob's variant URLs onto every job photo that uses it"""
+    updates = []
+    async for job in db.jobs.find(
+        {"tenant_id": tenant_id, "photos.sha256": digest},
+        {"_id": 0, "id": 1, "photos.id": 1, "photos.sha256": 1}
+    ):
+        for index, photo in enumerate(job["photos"]):
+            if photo.get("sha256") == digest:
+                # Matching the id keeps the positional path safe if photos were added or removed since
+                updates.append(UpdateOne(
+                    {"id": job["id"], f"photos.{index}.id": photo["id"]},
+                    {"$set": {f"photos.{index}.variants": variants}}
+                ))
+    if updates:
+        await db.jobs.bulk_write(updates, ordered=False)
+
+async def build_photo_variants(tenant_id: str, blob: dict):
+    """Make a blob's variants and record their URLs on it and its photos"""
+    async with photo_variant_slots:
+        with tempfile.TemporaryDirectory(dir=UPLOAD_STAGING_DIR) as work_dir:
+            try:
+                async with storage.local_copy(f"{tenant_id}/{blob['filename']}", Path(work_dir)) as source:
+                    made = await asyncio.to_thread(make_variants, source, Path(work_dir))
+                for v in made.values():
+                    await storage.put_file(f"{tenant_id}/variants/{v['filename']}", Path(work_dir) / v["filename"])
+            except Exception as e:
+                logger.warning(f"Could not make variants of photo {blob['filename']}: {e}")
+                made = {}
+    
+    variants = {name: f"/uploads/{tenant_id}/variants/{v['filename']}" for name, v in made.items()}
+    variants_size = sum(v["size"] for v in made.values())
+    result = await db.photo_blobs.update_one(
+        {"tenant_id": tenant_id, "sha256": blob["sha256"], "variants": {"$exists": False}},
+        {"$set": {"variants": variants, "variants_size": variants_size}}
+    )
+    if not result.matched_count:
+        if not await db.photo_blobs.find_one({"tenant_id": tenant_id, "sha256": blob["sha256"]}, {"_id": 1}):
+            # Its last photo was deleted while we were resizing it
+            await remove_photo_variants(tenant_id, blob["filename"])
+        return
+    if variants_size:
+        await bump_usage(tenant_id, {"storage_bytes": variants_size})
+    await set_photo_variants(tenant_id, blob["sha256"], variants)
+
+def schedule_photo_variants(tenant_id: str, blob: dict):
+    task = asyncio.create_task(build_photo_variants(tenant_id, blob))
+    photo_variant_tasks.add(task)
+    task.add_done_callback(photo_variant_tasks.discard)
+
+VARIANT_BACKFILL_LEASE_SECONDS = int(os.environ.get('VARIANT_BACKFILL_LEASE_SECONDS', 600))
+
+async def backfill_photo_variants():
+    """Blobs whose pipeline run was cut short by a restart, and photos added while their blob's ran.
+    One worker does it under a lease; the rest skip it."""
+    if not await acquire_lease(TASK_LEASES, "variant_backfill", VARIANT_BACKFILL_LEASE_SECONDS):
+        logger.info("Another worker is backfilling photo variants")
+        return
+    try:
+        async with holding_lease(TASK_LEASES, "variant_backfill", VARIANT_BACKFILL_LEASE_SECONDS):
+            await backfill_pending_variants()
+    except LeaseLost:
+        logger.error("Lost the photo variant backfill lease, leaving it to the new holder")
+    finally:
+        await release_lease(TASK_LEASES, "variant_backfill")
+
+async def backfill_pending_variants():
+    # The lease document remembers when the last complete sweep started; photos uploaded before
+    # then were already checked, so the job scan only walks the photos.uploaded_at index past it
+    lease = await db[TASK_LEASES].find_one({"_id": "variant_backfill"}, {"swept_from": 1})
+    swept_from = (lease or {}).get("swept_from", "")
+    started = datetime.now(timezone.utc).isoformat()
+    
+    async for blob in db.photo_blobs.find({"variants": {"$exists": False}}, {"_id": 0}):
+        await build_photo_variants(blob["tenant_id"], blob)
+    
+    pending = set()
+    async for job in db.jobs.find(
+        {"photos": {"$elemMatch": {
+            "uploaded_at": {"$gte": swept_from}, "sha256": {"$exists": True}, "variants": {"$exists": False}
+        }}},
+        {"_id": 0, "tenant_id": 1, "photos": 1}
+    ):
+        pending.update((job["tenant_id"], p["sha256"]) for p in job["photos"] if p.get("sha256") and "variants" not in p)
+    for tenant_id, digest in pending:
+        blob = await db.photo_blobs.find_one({"tenant_id": tenant_id, "sha256": digest}, {"_id": 0, "variants": 1})
+        if blob and "variants" in blob:
+            await set_photo_variants(tenant_id, digest, blob["variants"])
+    await db[TASK_LEASES].update_one({"_id": "variant_backfill"}, {"$set": {"swept_from": started}})
+
 # ==================== PUBLIC TRACKING ====================
 
 class PublicJobStatus(BaseModel):
@@ -2379,7 +3985,7 @@ class PublicJobStatus(BaseModel):
     repair_summary: Optional[str] = None
     company_name: str
 
-@api_router.get("/public/plans")
+@api_router.get("/public/plans", dependencies=[Depends(rate_limit("plans"))])
 async def get_public_plans():
     """Public endpoint to get available subscription plans for pricing page (no auth required)"""
     # Use subscription_plans collection (same as super admin)
@@ -2397,19 +4003,17 @@ async def get_public_plans():
     
     return visible_plans
 
-@api_router.get("/public/track/{job_number}/{tracking_token}", response_model=PublicJobStatus)
-async def public_track_job(job_number: str, tracking_token: str):
-    """Public endpoint for customers to track their job status (no auth required)"""
-    job = await db.jobs.find_one({
-        "job_number": job_number,
-        "tracking_token": tracking_token
-    }, {"_id": 0})
-    
-    if not job:
-        raise HTTPException(status_code=404, detail="Job not found. Please check your job number and tracking token.")
-    
+# Only what the tracking page shows; photos, customer details and the rest of the job stay in the database
+PUBLIC_TRACKING_FIELDS = {
+    "_id": 0, "tenant_id": 1, "job_number": 1, "status": 1, "device.brand": 1, "device.model": 1,
+    "created_at": 1, "updated_at": 1, "status_history.status": 1, "status_history.timestamp": 1,
+    "status_history.notes": 1, "diagnosis.diagnosis": 1, "repair.work_done": 1
+}
+
+async def build_public_job_status(job: dict) -> PublicJobStatus:
+    """Sanitized tracking view of a job read with PUBLIC_TRACKING_FIELDS"""
     # Get company name
-    tenant = await db.tenants.find_one({"id": job["tenant_id"]}, {"_id": 0})
+    tenant = await db.tenants.find_one({"id": job["tenant_id"]}, {"_id": 0, "company_name": 1})
     company_name = tenant["company_name"] if tenant else "Unknown"
     
     # Sanitize status history (remove user_id)
@@ -2435,6 +4039,40 @@ async def public_track_job(job_number: str, tracking_token: str):
         company_name=company_name
     )
 
+async def public_job_status(job_number: str, tracking_token: str) -> Optional[dict]:
+    """The serialized PublicJobStatus of a job and its ETag, or None if there is no such job"""
+    key = tracking_cache_key(job_number, tracking_token)
+    cached = tracking_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    job = await db.jobs.find_one({"job_number": job_number, "tracking_token": tracking_token}, PUBLIC_TRACKING_FIELDS)
+    if not job:
+        # A link sent out before migration 0008 gave the job a new number
+        job = await db.jobs.find_one({"previous_job_number": job_number, "tracking_token": tracking_token}, PUBLIC_TRACKING_FIELDS)
+        if not job:
+            return None
+    body = (await build_public_job_status(job)).model_dump_json().encode()
+    cached = {"body": body, "etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"', "tenant_id": job["tenant_id"]}
+    # Writers invalidate the entry under the job's current number, so an old number isn't cached
+    if job["job_number"] == job_number:
+        tracking_cache.set(key, cached)
+    return cached
+
+@api_router.get("/public/track/{job_number}/{tracking_token}", response_model=PublicJobStatus,
+                dependencies=[Depends(rate_limit("track"))])
+async def public_track_job(job_number: str, tracking_token: str, if_none_match: Optional[str] = Header(None)):
+    """Public endpoint for customers to track their job status (no auth required)"""
+    status_entry = await public_job_status(job_number, tracking_token)
+    if not status_entry:
+        raise HTTPException(status_code=404, detail="Job not found. Please check your job number and tracking token.")
+    
+    # Customers keep refreshing this page; unchanged polls get an empty 304
+    headers = {"ETag": status_entry["etag"], "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, status_entry["etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=status_entry["body"], media_type="application/json", headers=headers)
+
 @api_router.get("/jobs/{job_id}/tracking-link")
 async def get_tracking_link(job_id: str, user: dict = Depends(get_current_user)):
     """Get the public tracking link for a job"""
@@ -2962,11 +4600,11 @@ async def get_super_admin(credentials: HTTPAuthorizationCredentials = Depends(se
 
 # ==================== SUPER ADMIN ROUTES ====================
 
-@api_router.post("/super-admin/login", response_model=SuperAdminLoginResponse)
+@api_router.post("/super-admin/login", response_model=SuperAdminLoginResponse, dependencies=[Depends(rate_limit("super_admin_login", key=login_account))])
 async def super_admin_login(data: SuperAdminLogin):
     user = await db.super_admins.find_one({"email": data.email.lower()})
     
-    if not user or not verify_password(data.password, user["password"]):
+    if not user or not await verify_password_async(data.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = create_super_admin_token(user["id"], user["role"])
@@ -2987,7 +4625,7 @@ async def change_super_admin_password(data: ChangePasswordRequest, admin: dict =
         raise HTTPException(status_code=404, detail="Admin not found")
     
     # Verify current password
-    if not verify_password(data.current_password, db_admin["password"]):
+    if not await verify_password_async(data.current_password, db_admin["password"]):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
     
     # Validate new password
@@ -2998,7 +4636,7 @@ async def change_super_admin_password(data: ChangePasswordRequest, admin: dict =
         raise HTTPException(status_code=400, detail="New password must be different from current password")
     
     # Update password
-    new_hash = hash_password(data.new_password)
+    new_hash = await hash_password_async(data.new_password)
     await db.super_admins.update_one(
         {"id": admin["id"]},
         {"$set": {"password": new_hash}}
@@ -3006,19 +4644,15 @@ async def change_super_admin_password(data: ChangePasswordRequest, admin: dict =
     
     return {"message": "Password changed successfully"}
 
-@api_router.get("/super-admin/stats")
+@api_router.get("/super-admin/stats", dependencies=[Depends(job_stats_ready)])
 async def get_platform_stats(admin: dict = Depends(get_super_admin)):
     total_tenants = await db.tenants.count_documents({})
     active_tenants = await db.tenants.count_documents({"is_active": {"$ne": False}})
     total_users = await db.users.count_documents({})
-    total_jobs = await db.jobs.count_documents({})
     
     # Jobs by status
-    pipeline = [
-        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
-    ]
-    status_counts = await db.jobs.aggregate(pipeline).to_list(10)
-    jobs_by_status = {item["_id"]: item["count"] for item in status_counts}
+    jobs_by_status, _ = await job_daily_counts({})
+    total_jobs = sum(jobs_by_status.values())
     
     # Recent signups (last 7 days)
     week_ago = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
@@ -3040,12 +4674,51 @@ async def get_platform_stats(admin: dict = Depends(get_super_admin)):
         "recent_signups": recent_signups
     }
 
+# Tenant fields the super admin list can be sorted by
+TENANT_SORT_FIELDS = {"created_at", "company_name", "subdomain", "subscription_status", "subscription_ends_at"}
+
+async def tenant_list_counts(tenant_ids: List[str]) -> dict:
+    """Job and user totals for a page of tenants: tenant_usage first, grouped counts for any without one"""
+    counts = {}
+    async for usage in db.tenant_usage.find(
+        {"tenant_id": {"$in": tenant_ids}},
+        {"_id": 0, "tenant_id": 1, "users": 1, "jobs_by_month": 1}
+    ):
+        counts[usage["tenant_id"]] = {
+            "total_users": usage.get("users", 0),
+            "total_jobs": sum((usage.get("jobs_by_month") or {}).values())
+        }
+    
+    missing = [tid for tid in tenant_ids if tid not in counts]
+    if missing:
+        for tid in missing:
+            counts[tid] = {"total_users": 0, "total_jobs": 0}
+        for collection, field in (("users", "total_users"), ("jobs", "total_jobs")):
+            async for row in db[collection].aggregate([
+                {"$match": {"tenant_id": {"$in": missing}}},
+                {"$group": {"_id": "$tenant_id", "count": {"$sum": 1}}}
+            ]):
+                counts[row["_id"]][field] = row["count"]
+    return counts
+
 @api_router.get("/super-admin/tenants", response_model=List[TenantAdminResponse])
 async def get_all_tenants(
+    response: Response,
     search: Optional[str] = None,
     status_filter: Optional[str] = None,
+    sort_by: str = "created_at",
+    sort_order: str = "desc",
+    skip: int = 0,
+    limit: int = 1000,
     admin: dict = Depends(get_super_admin)
 ):
+    """Tenant list for the super admin; the unpaged total is returned in X-Total-Count"""
+    if sort_by not in TENANT_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort_by must be one of: {', '.join(sorted(TENANT_SORT_FIELDS))}")
+    if sort_order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="sort_order must be asc or desc")
+    limit = max(1, min(limit, 1000))
+    
     query = {}
     
     if search:
@@ -3063,30 +4736,31 @@ async def get_all_tenants(
     elif status_filter == "paid":
         query["subscription_status"] = "paid"
     
-    tenants = await db.tenants.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    direction = 1 if sort_order == "asc" else -1
+    tenants = await db.tenants.find(query, {"_id": 0}).sort([(sort_by, direction), ("id", direction)]).skip(skip).limit(limit).to_list(limit)
+    response.headers["X-Total-Count"] = str(await db.tenants.count_documents(query))
+    
+    # Enrich the whole page at once instead of three queries per tenant
+    tenant_ids = [t["id"] for t in tenants]
+    counts = await tenant_list_counts(tenant_ids)
+    admin_emails = {}
+    async for row in db.users.aggregate([
+        {"$match": {"tenant_id": {"$in": tenant_ids}, "role": "admin"}},
+        {"$sort": {"created_at": 1}},
+        {"$group": {"_id": "$tenant_id", "email": {"$first": "$email"}}}
+    ]):
+        admin_emails[row["_id"]] = row["email"]
     
-    # Enrich with additional data
     result = []
     for tenant in tenants:
-        # Get admin email
-        admin_user = await db.users.find_one(
-            {"tenant_id": tenant["id"], "role": "admin"},
-            {"email": 1, "_id": 0}
-        )
-        
-        # Get counts
-        total_jobs = await db.jobs.count_documents({"tenant_id": tenant["id"]})
-        total_users = await db.users.count_documents({"tenant_id": tenant["id"]})
-        
         tenant_data = {
             **tenant,
             "is_active": tenant.get("is_active", True),
             "subscription_status": tenant.get("subscription_status", "trial"),
             "subscription_plan": tenant.get("subscription_plan", "free"),
             "subscription_ends_at": tenant.get("subscription_ends_at"),
-            "admin_email": admin_user["email"] if admin_user else None,
-            "total_jobs": total_jobs,
-            "total_users": total_users
+            "admin_email": admin_emails.get(tenant["id"]),
+            **counts[tenant["id"]]
         }
         result.append(TenantAdminResponse(**tenant_data))
     
@@ -3198,6 +4872,7 @@ async def update_tenant_by_admin(
     
     if update_data:
         await db.tenants.update_one({"id": tenant_id}, {"$set": update_data})
+        bump_plan_version(tenant_id)
     
     updated_tenant = await db.tenants.find_one({"id": tenant_id}, {"_id": 0})
     return {
@@ -3256,7 +4931,7 @@ async def create_tenant_by_admin(
         "tenant_id": tenant_id,
         "name": data.admin_name,
         "email": data.admin_email.lower(),
-        "password": hash_password(data.admin_password),
+        "password": await hash_password_async(data.admin_password),
         "role": "admin",
         "branch_id": None,
         "created_at": now
@@ -3274,6 +4949,7 @@ async def create_tenant_by_admin(
         "created_at": now
     }
     await db.branches.insert_one(branch)
+    await reconcile_tenant_usage(tenant_id)
     
     # Log the action
     await db.admin_action_logs.insert_one({
@@ -3291,26 +4967,165 @@ async def create_tenant_by_admin(
         "created_at": now
     })
     
-    return {
-        "message": "Shop created successfully",
-        "tenant": {
-            "id": tenant_id,
-            "company_name": data.company_name,
-            "subdomain": data.subdomain,
-            "admin_email": data.admin_email
-        }
-    }
+    return {
+        "message": "Shop created successfully",
+        "tenant": {
+            "id": tenant_id,
+            "company_name": data.company_name,
+            "subdomain": data.subdomain,
+            "admin_email": data.admin_email
+        }
+    }
+
+# ==================== PLATFORM ANALYTICS ROLLUPS ====================
+# platform_rollups holds small pre-aggregated documents behind /super-admin/analytics:
+#   revenue_month  revenue and payment count per month and payment mode
+#   signups_day    new tenants per day
+#   jobs_day       jobs created per day, per tenant and for "all"
+#   summary        plan/status distributions and top tenants, recomputed on every refresh
+#   state          watermark - created_at up to which the sources have been folded in
+# A background task folds in whatever was created since the watermark; a lease document keeps
+# several workers from refreshing at the same time.
+
+ROLLUP_KINDS = ["revenue_month", "signups_day", "jobs_day"]
+ROLLUP_LEASE_SECONDS = 600
+
+async def acquire_rollup_lease() -> bool:
+    return await acquire_lease("platform_rollups", "lease", ROLLUP_LEASE_SECONDS)
+
+async def release_rollup_lease():
+    await release_lease("platform_rollups", "lease")
+
+async def add_tenant_names(rows: List[dict], id_field: str):
+    """Attach company_name/subdomain to rows with a single tenants lookup"""
+    ids = list({r.get(id_field) for r in rows if r.get(id_field)})
+    tenants = {t["id"]: t for t in await db.tenants.find(
+        {"id": {"$in": ids}}, {"_id": 0, "id": 1, "company_name": 1, "subdomain": 1}
+    ).to_list(len(ids) or 1)}
+    for row in rows:
+        tenant = tenants.get(row.get(id_field), {})
+        row["company_name"] = tenant.get("company_name", "Unknown")
+        row["subdomain"] = tenant.get("subdomain", "unknown")
+
+async def analytics_recent_activity(now: datetime) -> tuple:
+    """Latest payments and subscriptions expiring in the next 30 days - small indexed reads, always live"""
+    recent_payments = await db.tenant_payments.find(
+        {},
+        {"_id": 0}
+    ).sort("created_at", -1).limit(10).to_list(10)
+    await add_tenant_names(recent_payments, "tenant_id")
+    for payment in recent_payments:
+        payment.pop("subdomain", None)
+    
+    next_30_days = (now + timedelta(days=30)).isoformat()
+    expiring_soon = await db.tenants.find(
+        {
+            "subscription_status": "paid",
+            "subscription_ends_at": {"$lte": next_30_days, "$gte": now.isoformat()}
+        },
+        {"_id": 0, "id": 1, "company_name": 1, "subdomain": 1, "subscription_ends_at": 1, "subscription_plan": 1}
+    ).sort("subscription_ends_at", 1).limit(10).to_list(10)
+    return recent_payments, expiring_soon
+
+async def refresh_platform_rollups(rebuild: bool = False) -> dict:
+    """Fold documents created since the watermark into the rollups (all of them when rebuilding)"""
+    state = await db.platform_rollups.find_one({"_id": "state"}) or {}
+    rebuild = rebuild or not state.get("watermark")
+    if rebuild:
+        await db.platform_rollups.delete_many({"kind": {"$in": ROLLUP_KINDS}})
+    watermark = "" if rebuild else state["watermark"]
+    now = datetime.now(timezone.utc)
+    upper = (now - timedelta(seconds=ANALYTICS_ROLLUP_LAG_SECONDS)).isoformat()
+    window = {"created_at": {"$gt": watermark, "$lte": upper}}
+    
+    writes = []
+    def bump(key: str, fields: dict, inc: dict):
+        writes.append(UpdateOne({"_id": key}, {"$set": fields, "$inc": inc}, upsert=True))
+    
+    async for row in db.tenant_payments.aggregate([
+        {"$match": window},
+        {"$group": {
+            "_id": {"month": {"$substr": ["$created_at", 0, 7]}, "mode": "$payment_mode"},
+            "revenue": {"$sum": "$amount"},
+            "count": {"$sum": 1}
+        }}
+    ]):
+        month, mode = row["_id"]["month"], row["_id"].get("mode")
+        bump(f"revenue_month:{month}:{mode}", {"kind": "revenue_month", "period": month, "payment_mode": mode},
+             {"revenue": row["revenue"], "count": row["count"]})
+    
+    async for row in db.tenants.aggregate([
+        {"$match": window},
+        {"$group": {"_id": {"$substr": ["$created_at", 0, 10]}, "count": {"$sum": 1}}}
+    ]):
+        bump(f"signups_day:{row['_id']}", {"kind": "signups_day", "period": row["_id"]}, {"count": row["count"]})
+    
+    day_totals = {}
+    async for row in db.jobs.aggregate([
+        {"$match": window},
+        {"$group": {
+            "_id": {"day": {"$substr": ["$created_at", 0, 10]}, "tenant_id": "$tenant_id"},
+            "count": {"$sum": 1}
+        }}
+    ]):
+        day, tenant_id = row["_id"]["day"], row["_id"]["tenant_id"]
+        bump(f"jobs_day:{day}:{tenant_id}", {"kind": "jobs_day", "period": day, "tenant_id": tenant_id}, {"count": row["count"]})
+        day_totals[day] = day_totals.get(day, 0) + row["count"]
+    for day, count in day_totals.items():
+        bump(f"jobs_day:{day}:all", {"kind": "jobs_day", "period": day, "tenant_id": "all"}, {"count": count})
+    
+    for i in range(0, len(writes), 500):
+        await db.platform_rollups.bulk_write(writes[i:i + 500], ordered=False)
+    
+    # Distributions and the top-tenant list are small enough to recompute whole
+    plan_distribution = await db.tenants.aggregate([
+        {"$group": {"_id": {"$ifNull": ["$subscription_plan", "free"]}, "count": {"$sum": 1}}}
+    ]).to_list(10)
+    status_distribution = await db.tenants.aggregate([
+        {"$group": {"_id": {"$ifNull": ["$subscription_status", "trial"]}, "count": {"$sum": 1}}}
+    ]).to_list(10)
+    job_totals = [
+        {"_id": usage["tenant_id"], "job_count": sum((usage.get("jobs_by_month") or {}).values())}
+        async for usage in db.tenant_usage.find({}, {"_id": 0, "tenant_id": 1, "jobs_by_month": 1})
+    ]
+    top_by_jobs = sorted((t for t in job_totals if t["job_count"]), key=lambda t: t["job_count"], reverse=True)[:10]
+    await add_tenant_names(top_by_jobs, "_id")
+    
+    await db.platform_rollups.update_one(
+        {"_id": "summary"},
+        {"$set": {
+            "kind": "summary",
+            "plan_distribution": plan_distribution,
+            "status_distribution": status_distribution,
+            "top_by_jobs": top_by_jobs
+        }},
+        upsert=True
+    )
+    await db.platform_rollups.update_one(
+        {"_id": "state"},
+        {"$set": {"kind": "state", "watermark": upper, "refreshed_at": now.isoformat()}},
+        upsert=True
+    )
+    return {"watermark": upper, "rollups_updated": len(writes), "rebuilt": rebuild}
 
-@api_router.get("/super-admin/analytics")
-async def get_super_admin_analytics(admin: dict = Depends(get_super_admin)):
-    """Get platform-wide analytics including revenue and billing"""
+async def analytics_rollup_loop():
+    while True:
+        try:
+            if await acquire_rollup_lease():
+                try:
+                    await refresh_platform_rollups()
+                finally:
+                    await release_rollup_lease()
+        except PyMongoError as e:
+            logger.error(f"Analytics rollup refresh failed: {e}")
+        await asyncio.sleep(ANALYTICS_ROLLUP_INTERVAL_SECONDS)
+
+async def live_platform_analytics() -> dict:
+    """Compute the analytics payload straight from the source collections"""
     now = datetime.now(timezone.utc)
     
     # Time periods
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-    week_start = (now - timedelta(days=7)).isoformat()
     month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat()
-    year_start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0).isoformat()
     
     # Revenue calculations from payments
     total_revenue_pipeline = [
@@ -3411,35 +5226,12 @@ async def get_super_admin_analytics(admin: dict = Depends(get_super_admin)):
     ]
     top_tenants_by_jobs = await db.jobs.aggregate(top_tenants_pipeline).to_list(10)
     
-    # Enrich top tenants with names
-    for t in top_tenants_by_jobs:
-        tenant = await db.tenants.find_one({"id": t["_id"]}, {"company_name": 1, "subdomain": 1, "_id": 0})
-        if tenant:
-            t["company_name"] = tenant.get("company_name", "Unknown")
-            t["subdomain"] = tenant.get("subdomain", "unknown")
-    
-    # Recent payments
-    recent_payments = await db.tenant_payments.find(
-        {},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(10).to_list(10)
-    
-    # Enrich recent payments with tenant info
-    for payment in recent_payments:
-        tenant = await db.tenants.find_one({"id": payment.get("tenant_id")}, {"company_name": 1, "_id": 0})
-        payment["company_name"] = tenant.get("company_name", "Unknown") if tenant else "Unknown"
+    await add_tenant_names(top_tenants_by_jobs, "_id")
     
-    # Expiring subscriptions (next 30 days)
-    next_30_days = (now + timedelta(days=30)).isoformat()
-    expiring_soon = await db.tenants.find(
-        {
-            "subscription_status": "paid",
-            "subscription_ends_at": {"$lte": next_30_days, "$gte": now.isoformat()}
-        },
-        {"_id": 0, "id": 1, "company_name": 1, "subdomain": 1, "subscription_ends_at": 1, "subscription_plan": 1}
-    ).sort("subscription_ends_at", 1).limit(10).to_list(10)
+    recent_payments, expiring_soon = await analytics_recent_activity(now)
     
     return {
+        "as_of": now.isoformat(),
         "revenue": {
             "total": total_revenue,
             "monthly": monthly_revenue,
@@ -3459,6 +5251,80 @@ async def get_super_admin_analytics(admin: dict = Depends(get_super_admin)):
         "recent_payments": recent_payments
     }
 
+async def rollup_platform_analytics() -> Optional[dict]:
+    """Assemble the analytics payload from platform_rollups; None until the first refresh has run"""
+    state = await db.platform_rollups.find_one({"_id": "state"})
+    summary = await db.platform_rollups.find_one({"_id": "summary"})
+    if not state or not summary:
+        return None
+    
+    now = datetime.now(timezone.utc)
+    current_month = now.strftime("%Y-%m")
+    first_month = (now - timedelta(days=365)).strftime("%Y-%m")
+    thirty_days_ago = (now - timedelta(days=30)).strftime("%Y-%m-%d")
+    
+    revenue_rows = await db.platform_rollups.find({"kind": "revenue_month"}, {"_id": 0}).to_list(None)
+    by_month, by_mode = {}, {}
+    for row in revenue_rows:
+        if row["period"] >= first_month:
+            month = by_month.setdefault(row["period"], {"_id": row["period"], "revenue": 0, "count": 0})
+            month["revenue"] += row["revenue"]
+            month["count"] += row["count"]
+        mode = by_mode.setdefault(row.get("payment_mode"), {"_id": row.get("payment_mode"), "total": 0, "count": 0})
+        mode["total"] += row["revenue"]
+        mode["count"] += row["count"]
+    
+    signups_trend = await db.platform_rollups.find(
+        {"kind": "signups_day", "period": {"$gte": thirty_days_ago}},
+        {"_id": 0, "period": 1, "count": 1}
+    ).sort("period", 1).to_list(31)
+    jobs_trend = await db.platform_rollups.find(
+        {"kind": "jobs_day", "tenant_id": "all", "period": {"$gte": thirty_days_ago}},
+        {"_id": 0, "period": 1, "count": 1}
+    ).sort("period", 1).to_list(31)
+    
+    recent_payments, expiring_soon = await analytics_recent_activity(now)
+    
+    return {
+        "as_of": state["watermark"],
+        "revenue": {
+            "total": sum(r["revenue"] for r in revenue_rows),
+            "monthly": sum(r["revenue"] for r in revenue_rows if r["period"] == current_month),
+            "by_month": sorted(by_month.values(), key=lambda m: m["_id"])[-12:],
+            "by_payment_mode": list(by_mode.values())
+        },
+        "tenants": {
+            "plan_distribution": summary["plan_distribution"],
+            "status_distribution": summary["status_distribution"],
+            "signups_trend": [{"_id": d["period"], "count": d["count"]} for d in signups_trend],
+            "top_by_jobs": summary["top_by_jobs"],
+            "expiring_soon": expiring_soon
+        },
+        "jobs": {
+            "trend": [{"_id": d["period"], "count": d["count"]} for d in jobs_trend]
+        },
+        "recent_payments": recent_payments
+    }
+
+@api_router.get("/super-admin/analytics")
+async def get_super_admin_analytics(fresh: bool = False, admin: dict = Depends(get_super_admin)):
+    """Get platform-wide analytics including revenue and billing (from the rollups unless fresh=true)"""
+    if not fresh:
+        analytics = await rollup_platform_analytics()
+        if analytics:
+            return analytics
+    return await live_platform_analytics()
+
+@api_router.post("/super-admin/system/analytics/refresh")
+async def refresh_analytics_rollups(rebuild: bool = False, admin: dict = Depends(get_super_admin)):
+    """Refresh the analytics rollups now; rebuild=true recomputes them from scratch"""
+    if not await acquire_rollup_lease():
+        raise HTTPException(status_code=409, detail="An analytics refresh is already running")
+    try:
+        return await refresh_platform_rollups(rebuild=rebuild)
+    finally:
+        await release_rollup_lease()
+
 # ==================== LOGIN AS SHOP (IMPERSONATION) ====================
 
 @api_router.post("/super-admin/tenants/{tenant_id}/impersonate")
@@ -3538,6 +5404,7 @@ async def suspend_tenant(
             "suspended_by": admin["id"]
         }}
     )
+    user_cache.invalidate_where(lambda u: u.get("tenant_id") == tenant_id)
     
     # Log the action
     await db.admin_action_logs.insert_one({
@@ -3571,6 +5438,7 @@ async def unsuspend_tenant(
             "$unset": {"suspended_at": "", "suspension_reason": "", "suspended_by": ""}
         }
     )
+    user_cache.invalidate_where(lambda u: u.get("tenant_id") == tenant_id)
     
     # Log the action
     await db.admin_action_logs.insert_one({
@@ -3613,11 +5481,12 @@ async def reset_user_password(
         raise HTTPException(status_code=400, detail="Password must be at least 6 characters")
     
     # Update password
-    new_hash = hash_password(data.new_password)
+    new_hash = await hash_password_async(data.new_password)
     await db.users.update_one(
         {"id": user_id},
         {"$set": {"password": new_hash}}
     )
+    user_cache.invalidate(user_id)
     
     now = datetime.now(timezone.utc).isoformat()
     
@@ -4033,6 +5902,7 @@ async def update_subscription_plan(
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
     
     await db.subscription_plans.update_one({"id": plan_id}, {"$set": update_data})
+    bump_plan_version()
     
     # Log the action
     action_log = {
@@ -4075,6 +5945,7 @@ async def delete_subscription_plan(
         {"id": plan_id}, 
         {"$set": {"is_active": False, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    bump_plan_version()
     
     # Log the action
     action_log = {
@@ -4210,6 +6081,7 @@ async def assign_plan_to_tenant(
     }
     
     await db.tenants.update_one({"id": tenant_id}, {"$set": update_data})
+    bump_plan_version(tenant_id)
     
     # Log the action
     action_log = {
@@ -4370,6 +6242,7 @@ async def record_offline_payment(
                     "updated_at": now.isoformat()
                 }}
             )
+            bump_plan_version(tenant_id)
     
     # Log the action
     action_log = {
@@ -4482,7 +6355,7 @@ async def setup_super_admin():
         "id": admin_id,
         "name": "Super Admin",
         "email": "superadmin@aftersales.pro",
-        "password": hash_password("SuperAdmin@123"),
+        "password": await hash_password_async("SuperAdmin@123"),
         "role": "super_admin",
         "created_at": now
     }
@@ -4496,83 +6369,453 @@ async def setup_super_admin():
         "note": "Please change the password after first login"
     }
 
+# ==================== SUPER ADMIN SYSTEM ROUTES ====================
+
+@api_router.get("/super-admin/system/indexes")
+async def get_index_report(admin: dict = Depends(get_super_admin)):
+    """Compare declared indexes with what exists in MongoDB, including usage counters"""
+    report = []
+    for collection, specs in INDEX_SPECS.items():
+        existing = await db[collection].index_information()
+        declared = [index_name(keys) for keys, _ in specs]
+
+        # $indexStats is unavailable on some deployments; report usage as unknown then
+        usage = {}
+        try:
+            stats = await db[collection].aggregate([{"$indexStats": {}}]).to_list(100)
+            usage = {s["name"]: s.get("accesses", {}).get("ops", 0) for s in stats}
+        except PyMongoError:
+            pass
+
+        indexes = []
+        for name in sorted(set(declared) | set(existing.keys())):
+            indexes.append({
+                "name": name,
+                "declared": name in declared,
+                "exists": name in existing,
+                "ops": usage.get(name)
+            })
+
+        report.append({
+            "collection": collection,
+            "missing": [name for name in declared if name not in existing],
+            "undeclared": [name for name in existing if name not in declared and name != "_id_"],
+            "unused": [i["name"] for i in indexes if i["exists"] and i["ops"] == 0 and i["name"] != "_id_"],
+            "indexes": indexes
+        })
+
+    return {
+        "collections": report,
+        "missing_total": sum(len(c["missing"]) for c in report)
+    }
+
+@api_router.post("/super-admin/system/indexes/sync")
+async def sync_indexes(admin: dict = Depends(get_super_admin)):
+    """Create any declared index that is missing"""
+    return await ensure_indexes()
+
+@api_router.get("/super-admin/system/caches")
+async def get_cache_stats(admin: dict = Depends(get_super_admin)):
+    """Hit/miss counters for this worker's in-process caches"""
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+@api_router.get("/super-admin/system/rate-limits")
+async def get_rate_limit_stats(admin: dict = Depends(get_super_admin)):
+    """Rate limit budgets and this worker's allowed/rejected counters"""
+    return {
+        "enabled": RATE_LIMIT_ENABLED,
+        "backend": "redis" if RATE_LIMIT_REDIS_URL else "memory",
+        "tracked_clients": len(local_rate_limiter.buckets),
+        "rules": RATE_LIMITS,
+        "counters": rate_limit_stats
+    }
+
+@api_router.post("/super-admin/system/usage/reconcile")
+async def reconcile_usage(tenant_id: Optional[str] = None, admin: dict = Depends(get_super_admin)):
+    """Recount tenant_usage for one tenant (or all of them) and report any drift that was repaired"""
+    if tenant_id:
+        tenant = await db.tenants.find_one({"id": tenant_id}, {"_id": 0, "id": 1})
+        if not tenant:
+            raise HTTPException(status_code=404, detail="Tenant not found")
+        drift = await reconcile_tenant_usage(tenant_id)
+        return {"tenants_checked": 1, "drifted": {tenant_id: drift} if drift else {}}
+    return await reconcile_all_tenant_usage()
+
+@api_router.post("/super-admin/tenants/{tenant_id}/ledger/rebuild")
+async def rebuild_tenant_ledger(tenant_id: str, admin: dict = Depends(get_super_admin)):
+    """Regenerate a shop's customer ledger from its jobs and payments; the shop's postings wait meanwhile"""
+    tenant = await db.tenants.find_one({"id": tenant_id}, {"_id": 0, "id": 1})
+    if not tenant:
+        raise HTTPException(status_code=404, detail="Tenant not found")
+    
+    started = time.monotonic()
+    entries = await rebuild_customer_ledger(tenant_id)
+    
+    await db.admin_action_logs.insert_one({
+        "id": str(uuid.uuid4()),
+        "admin_id": admin["id"],
+        "admin_email": admin["email"],
+        "tenant_id": tenant_id,
+        "action": "rebuild_ledger",
+        "details": {"entries": entries},
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
+    
+    return {"entries": entries, "duration_ms": round((time.monotonic() - started) * 1000)}
+
+# ==================== CUSTOMER RECORDS ====================
+# One customers document per tenant + mobile_key, kept current by create_job, deliver_job and
+# record_customer_payment. balance = total_billed - total_received; outstanding is max(0, balance).
+
+CUSTOMER_FIELDS = {
+    "_id": 0, "name": 1, "mobile": 1, "email": 1, "total_jobs": 1, "device_count": 1,
+    "last_visit": 1, "first_visit": 1, "total_billed": 1, "total_received": 1, "balance": 1
+}
+
+def device_key(device: dict) -> str:
+    """Serial/IMEI when known, otherwise brand|model"""
+    return imei_key(device.get("serial_imei")) or f"{device.get('brand', '')}|{device.get('model', '')}".lower()
+
+def job_billed_amount(job: dict) -> float:
+    """What a delivered job bills the customer; undelivered jobs bill nothing yet"""
+    delivery = job.get("delivery")
+    if not delivery:
+        return 0
+    if delivery.get("final_amount") is not None:
+        return delivery["final_amount"]
+    return (job.get("repair") or {}).get("final_amount") or 0
+
+def customer_response(customer: dict) -> dict:
+    customer = dict(customer)
+    customer["outstanding_balance"] = max(0, customer.pop("balance", 0))
+    return customer
+
+async def record_customer_visit(job: dict):
+    """Upsert the job's customer and count the visit and device"""
+    if job["normalized"]["mobile_last10"] is None:
+        return
+    customer = job["customer"]
+    customer_doc = await db.customers.find_one_and_update(
+        {"tenant_id": job["tenant_id"], "mobile_key": job["normalized"]["mobile_last10"]},
+        {
+            "$setOnInsert": {
+                "id": str(uuid.uuid4()),
+                "total_billed": 0,
+                "total_received": 0,
+                "balance": 0,
+                "ledger_seq": 0,
+                "created_at": job["created_at"]
+            },
+            "$set": {
+                "name": customer["name"],
+                "mobile": customer["mobile"],
+                "email": customer.get("email"),
+                "search_keys": customer_search_keys(customer),
+                "updated_at": job["created_at"]
+            },
+            "$inc": {"total_jobs": 1},
+            "$addToSet": {"device_keys": device_key(job["device"])},
+            "$min": {"first_visit": job["created_at"]},
+            "$max": {"last_visit": job["created_at"]}
+        },
+        projection={"_id": 0, "id": 1, "device_keys": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    # Devices are only ever added, so $max keeps concurrent visits from undercounting
+    await db.customers.update_one(
+        {"id": customer_doc["id"]},
+        {"$max": {"device_count": len(customer_doc["device_keys"])}}
+    )
+
+async def rebuild_customers(tenant_id: str) -> int:
+    """Recompute every customers document of a tenant from its jobs and ledger payments"""
+    customers = {}
+    async for job in db.jobs.find(
+        {"tenant_id": tenant_id},
+        {"_id": 0, "id": 1, "customer": 1, "device": 1, "repair": 1, "delivery": 1, "created_at": 1}
+    ).sort("created_at", 1):
+        key = mobile_key(job["customer"]["mobile"])
+        if key is None:
+            continue
+        c = customers.setdefault(key, {
+            "total_jobs": 0, "device_keys": set(), "total_billed": 0, "total_received": 0,
+            "first_visit": job["created_at"], "delivered_at": {}
+        })
+        c.update({"name": job["customer"]["name"], "mobile": job["customer"]["mobile"], "email": job["customer"].get("email")})
+        c["total_jobs"] += 1
+        c["device_keys"].add(device_key(job["device"]))
+        c["last_visit"] = job["created_at"]
+        c["total_billed"] += job_billed_amount(job)
+        if job.get("delivery"):
+            c["total_received"] += job["delivery"].get("amount_received", 0)
+            c["delivered_at"][job["id"]] = job["delivery"].get("delivered_at") or ""
+
+    async for payment in db.customer_ledger.find({"tenant_id": tenant_id, "type": "payment"}, {"_id": 0}):
+        c = customers.get(payment.get("customer_mobile_key") or mobile_key(payment.get("customer_mobile")))
+        if not c:
+            continue
+        # Payments linked to an already delivered job were also added to its delivery.amount_received
+        delivered_at = c["delivered_at"].get(payment.get("job_id"))
+        if delivered_at is not None and delivered_at <= payment["created_at"]:
+            continue
+        c["total_received"] += payment["amount"]
+
+    now = datetime.now(timezone.utc).isoformat()
+    writes = []
+    for key, c in customers.items():
+        writes.append(UpdateOne(
+            {"tenant_id": tenant_id, "mobile_key": key},
+            {
+                "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": c["first_visit"]},
+                "$set": {
+                    "name": c["name"],
+                    "mobile": c["mobile"],
+                    "email": c["email"],
+                    "search_keys": customer_search_keys(c),
+                    "total_jobs": c["total_jobs"],
+                    "device_keys": sorted(c["device_keys"]),
+                    "device_count": len(c["device_keys"]),
+                    "first_visit": c["first_visit"],
+                    "last_visit": c["last_visit"],
+                    "total_billed": c["total_billed"],
+                    "total_received": c["total_received"],
+                    "balance": c["total_billed"] - c["total_received"],
+                    "updated_at": now
+                }
+            },
+            upsert=True
+        ))
+    for i in range(0, len(writes), 500):
+        await db.customers.bulk_write(writes[i:i + 500], ordered=False)
+    return len(writes)
+
+# ==================== CUSTOMER LEDGER ====================
+# customer_ledger is an append-only stream per customer: "job" postings when a job is delivered,
+# "job_adjustment" when a delivered job is re-delivered or re-priced, and "payment" entries.
+# Each entry carries its per-customer seq and the balance after it; the customers document holds
+# the running snapshot (total_billed, total_received, balance, ledger_seq).
+#
+# The entry is the record of truth. A posting takes the seq after the customer's latest entry -
+# the unique (tenant_id, customer_mobile_key, seq) index turns a concurrent posting into a retry -
+# and then rolls the snapshot forward from ledger_seq - 1. A snapshot left behind by a failed write
+# is recomputed from the entries, and re-posting an entry id that already exists does nothing.
+# Handlers still run their job update and posting in one transaction where the deployment allows.
+#
+# rebuild_customer_ledger() regenerates a tenant's job postings from its jobs and renumbers the
+# stream. It holds the tenant's ledger lease, and postings are refused while it does.
+
+LEDGER_LOCKS = "ledger_locks"
+LEDGER_REBUILD_LEASE_SECONDS = 600
+LEDGER_REBUILD_ATTEMPTS = 3
+
+LEDGER_JOB_TYPES = ["job", "job_adjustment"]
+
+# What ledger_job_entry() and job_billed_amount() read from a job
+LEDGER_JOB_FIELDS = {
+    "_id": 0, "id": 1, "tenant_id": 1, "job_number": 1, "customer": 1, "device": 1,
+    "problem_description": 1, "repair": 1, "delivery": 1, "updated_at": 1
+}
+
+def ledger_job_entry(job: dict, entry_type: str, created_at: str) -> dict:
+    problem = job.get("problem_description", "")
+    return {
+        "id": str(uuid.uuid4()),
+        "tenant_id": job["tenant_id"],
+        "customer_mobile": job["customer"]["mobile"],
+        "customer_mobile_key": mobile_key(job["customer"]["mobile"]),
+        "customer_name": job["customer"]["name"],
+        "type": entry_type,
+        "job_id": job["id"],
+        "job_number": job["job_number"],
+        "device_info": f"{job['device']['brand']} {job['device']['model']}",
+        "notes": problem[:50] + "..." if len(problem) > 50 else problem,
+        "created_at": created_at
+    }
+
+def ledger_lock_id(tenant_id: str) -> str:
+    return f"rebuild:{tenant_id}"
+
+async def ensure_ledger_writable(tenant_id: str):
+    """Refuse a posting while the tenant's ledger is being rebuilt"""
+    if await lease_held(LEDGER_LOCKS, ledger_lock_id(tenant_id)):
+        raise HTTPException(status_code=503, detail="Customer ledger is being rebuilt, please retry shortly",
+                            headers={"Retry-After": "5"})
+
+async def sync_ledger_snapshot(entry: dict, session=None):
+    """Recompute a customer's snapshot from their entries; never moves it back to an older seq"""
+    query = {"tenant_id": entry["tenant_id"], "customer_mobile_key": entry["customer_mobile_key"], "seq": {"$exists": True}}
+    totals = {"seq": 0, "billed": 0, "received": 0}
+    async for row in db.customer_ledger.aggregate([
+        {"$match": query},
+        {"$group": {"_id": None, "seq": {"$max": "$seq"}, "billed": {"$sum": "$billed"}, "received": {"$sum": "$received"}}}
+    ], session=session):
+        totals = row
+    customer = {"tenant_id": entry["tenant_id"], "mobile_key": entry["customer_mobile_key"]}
+    await db.customers.update_one(
+        customer,
+        {"$setOnInsert": {
+            "id": str(uuid.uuid4()),
+            "name": entry["customer_name"],
+            "mobile": entry["customer_mobile"],
+            "created_at": entry["created_at"]
+        }},
+        upsert=True,
+        session=session
+    )
+    await db.customers.update_one(
+        {**customer, "$or": [{"ledger_seq": {"$lt": totals["seq"]}}, {"ledger_seq": {"$exists": False}}]},
+        {"$set": {
+            "ledger_seq": totals["seq"],
+            "total_billed": totals["billed"],
+            "total_received": totals["received"],
+            "balance": totals["billed"] - totals["received"],
+            "updated_at": entry["created_at"]
+        }},
+        session=session
+    )
+
+async def post_ledger_entry(entry: dict, billed: float, received: float, session=None) -> dict:
+    """Append the entry after the customer's latest one, then roll their balance snapshot forward to it"""
+    query = {"tenant_id": entry["tenant_id"], "customer_mobile_key": entry["customer_mobile_key"], "seq": {"$exists": True}}
+    entry.update({"billed": billed, "received": received})
+    while True:
+        latest = await db.customer_ledger.find_one(
+            query, {"_id": 0, "seq": 1, "balance_after": 1}, sort=[("seq", -1)], session=session
+        ) or {"seq": 0, "balance_after": 0}
+        entry.update({"seq": latest["seq"] + 1, "balance_after": latest["balance_after"] + billed - received})
+        try:
+            await db.customer_ledger.insert_one(entry, session=session)
+            break
+        except DuplicateKeyError:
+            entry.pop("_id", None)
+            existing = await db.customer_ledger.find_one({"id": entry["id"]}, {"_id": 0}, session=session)
+            if existing:
+                # Already posted by an earlier attempt
+                return existing
+            if session is not None:
+                # A failed write aborts the transaction; with_transaction retries the whole callback
+                raise
+            # Another posting took this seq first
+    entry.pop("_id", None)
+
+    result = await db.customers.update_one(
+        {"tenant_id": entry["tenant_id"], "mobile_key": entry["customer_mobile_key"], "ledger_seq": entry["seq"] - 1},
+        {
+            "$inc": {"total_billed": billed, "total_received": received},
+            "$set": {"ledger_seq": entry["seq"], "balance": entry["balance_after"], "updated_at": entry["created_at"]}
+        },
+        session=session
+    )
+    if not result.matched_count:
+        # New customer, a concurrent posting not yet applied, or a snapshot an earlier failure left behind
+        await sync_ledger_snapshot(entry, session=session)
+    return entry
+
+async def record_customer_delivery(before: dict, after: dict, session=None):
+    """Post the change in billed/received amounts when a job is delivered, re-delivered or re-priced"""
+    billed = job_billed_amount(after) - job_billed_amount(before)
+    received = (after.get("delivery") or {}).get("amount_received", 0) - (before.get("delivery") or {}).get("amount_received", 0)
+    if (not billed and not received) or mobile_key(after["customer"]["mobile"]) is None:
+        return
+    entry_type = "job_adjustment" if before.get("delivery") else "job"
+    await post_ledger_entry(
+        ledger_job_entry(after, entry_type, datetime.now(timezone.utc).isoformat()),
+        billed,
+        received,
+        session=session
+    )
+
+async def rebuild_customer_ledger(tenant_id: str) -> int:
+    """Rebuild a tenant's ledger under its lease, refusing postings meanwhile. A posting that was already
+    under way when the lease was taken makes the renumbering collide or miss it, so that pass is redone."""
+    if not await acquire_lease(LEDGER_LOCKS, ledger_lock_id(tenant_id), LEDGER_REBUILD_LEASE_SECONDS):
+        raise HTTPException(status_code=409, detail="This tenant's ledger is already being rebuilt")
+    try:
+        for _ in range(LEDGER_REBUILD_ATTEMPTS):
+            try:
+                entries = await renumber_customer_ledger(tenant_id)
+            except BulkWriteError as e:
+                logger.warning(f"Ledger rebuild for {tenant_id} collided with a posting, retrying: {e}")
+                continue
+            if await db.customer_ledger.count_documents({"tenant_id": tenant_id, "customer_mobile_key": {"$ne": None}}) == entries:
+                return entries
+        raise HTTPException(status_code=409, detail="Ledger kept changing during the rebuild, please retry")
+    finally:
+        await release_lease(LEDGER_LOCKS, ledger_lock_id(tenant_id))
+
+async def renumber_customer_ledger(tenant_id: str) -> int:
+    """Regenerate job postings from delivered jobs, renumber every entry and reset the snapshots"""
+    await db.customer_ledger.delete_many({"tenant_id": tenant_id, "type": {"$in": LEDGER_JOB_TYPES}})
+    payments = await db.customer_ledger.find({"tenant_id": tenant_id, "type": "payment"}, {"_id": 0}).to_list(None)
+
+    entries = []
+    async for job in db.jobs.find({"tenant_id": tenant_id, "delivery": {"$ne": None}}, LEDGER_JOB_FIELDS):
+        delivered_at = job["delivery"].get("delivered_at") or job["updated_at"]
+        # Payments linked to the job after delivery were added onto delivery.amount_received
+        absorbed = sum(p["amount"] for p in payments if p.get("job_id") == job["id"] and p["created_at"] >= delivered_at)
+        entry = ledger_job_entry(job, "job", delivered_at)
+        if entry["customer_mobile_key"] is None:
+            continue
+        entry.update({"billed": job_billed_amount(job), "received": job["delivery"].get("amount_received", 0) - absorbed})
+        entries.append(entry)
+    for payment in payments:
+        key = payment.get("customer_mobile_key") or mobile_key(payment.get("customer_mobile"))
+        if key is None:
+            continue
+        payment.update({
+            "customer_mobile_key": key,
+            "billed": 0,
+            "received": payment["amount"]
+        })
+        entries.append(payment)
+
+    entries.sort(key=lambda e: (e["customer_mobile_key"], e["created_at"]))
+    snapshots = {}
+    writes = []
+    for entry in entries:
+        snap = snapshots.setdefault(entry["customer_mobile_key"], {"ledger_seq": 0, "total_billed": 0, "total_received": 0, "balance": 0})
+        snap["ledger_seq"] += 1
+        snap["total_billed"] += entry["billed"]
+        snap["total_received"] += entry["received"]
+        snap["balance"] += entry["billed"] - entry["received"]
+        entry.update({"seq": snap["ledger_seq"], "balance_after": snap["balance"]})
+        if entry["type"] == "payment":
+            writes.append(UpdateOne({"id": entry["id"]}, {"$set": {k: entry[k] for k in ("customer_mobile_key", "billed", "received", "seq", "balance_after")}}))
+        else:
+            writes.append(InsertOne(entry))
+    for i in range(0, len(writes), 500):
+        await db.customer_ledger.bulk_write(writes[i:i + 500], ordered=False)
+
+    await db.customers.update_many(
+        {"tenant_id": tenant_id},
+        {"$set": {"ledger_seq": 0, "total_billed": 0, "total_received": 0, "balance": 0}}
+    )
+    for key, snap in snapshots.items():
+        await db.customers.update_one({"tenant_id": tenant_id, "mobile_key": key}, {"$set": snap})
+    return len(entries)
+
 # ==================== CUSTOMER ROUTES ====================
 
-@api_router.get("/customers")
+@api_router.get("/customers", dependencies=[Depends(customers_ready)])
 async def get_customers(
     search: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 1000,
     user: dict = Depends(get_current_user)
 ):
     """Get unique customers with their device count, last visit, and outstanding balance"""
-    tenant_id = user["tenant_id"]
-    
-    # Aggregate to get unique customers by mobile number with financial info
-    pipeline = [
-        {"$match": {"tenant_id": tenant_id}},
-        {"$sort": {"created_at": -1}},
-        {"$group": {
-            "_id": "$customer.mobile",
-            "name": {"$first": "$customer.name"},
-            "mobile": {"$first": "$customer.mobile"},
-            "email": {"$first": "$customer.email"},
-            "total_jobs": {"$sum": 1},
-            "devices": {"$addToSet": {
-                "device_type": "$device.device_type",
-                "brand": "$device.brand",
-                "model": "$device.model",
-                "serial_imei": "$device.serial_imei"
-            }},
-            "last_visit": {"$first": "$created_at"},
-            "first_visit": {"$last": "$created_at"},
-            "total_billed": {"$sum": {"$ifNull": [
-                "$delivery.final_amount", 
-                {"$cond": {
-                    "if": {"$and": [{"$ifNull": ["$repair.final_amount", False]}, {"$ifNull": ["$delivery", False]}]},
-                    "then": "$repair.final_amount",
-                    "else": 0
-                }}
-            ]}},
-            "total_received": {"$sum": {"$ifNull": ["$delivery.amount_received", 0]}}
-        }},
-        {"$project": {
-            "_id": 0,
-            "name": 1,
-            "mobile": 1,
-            "email": 1,
-            "total_jobs": 1,
-            "device_count": {"$size": "$devices"},
-            "last_visit": 1,
-            "first_visit": 1,
-            "total_billed": 1,
-            "total_received": 1,
-            "outstanding_balance": {"$max": [0, {"$subtract": ["$total_billed", "$total_received"]}]}
-        }},
-        {"$sort": {"last_visit": -1}}
-    ]
-    
-    # Add search filter if provided
+    query = {"tenant_id": user["tenant_id"]}
     if search:
-        pipeline[0]["$match"]["$or"] = [
-            {"customer.name": {"$regex": search, "$options": "i"}},
-            {"customer.mobile": {"$regex": search, "$options": "i"}},
-            {"customer.email": {"$regex": search, "$options": "i"}}
-        ]
+        terms = search_terms(search)
+        query["search_keys"] = {"$all": terms} if terms else {"$in": []}
     
-    customers = await db.jobs.aggregate(pipeline).to_list(1000)
+    customers = await db.customers.find(query, CUSTOMER_FIELDS).sort("last_visit", -1).skip(skip).limit(limit).to_list(limit)
+    total = await db.customers.count_documents(query)
     
-    # Also adjust for direct payments in customer_ledger
-    for customer in customers:
-        payments = await db.customer_ledger.find(
-            {"tenant_id": tenant_id, "customer_mobile": customer["mobile"], "type": "payment"},
-            {"_id": 0, "amount": 1}
-        ).to_list(100)
-        total_direct_payments = sum(p["amount"] for p in payments)
-        customer["total_received"] += total_direct_payments
-        customer["outstanding_balance"] = max(0, customer["total_billed"] - customer["total_received"])
-    
-    return {"customers": customers}
+    return {"customers": [customer_response(c) for c in customers], "total": total}
 
-@api_router.get("/customers/{mobile}/devices")
+@api_router.get("/customers/{mobile}/devices", dependencies=[Depends(device_history_ready)])
 async def get_customer_devices(
     mobile: str,
     user: dict = Depends(get_current_user)
@@ -4582,10 +6825,10 @@ async def get_customer_devices(
     
     # Aggregate to get unique devices for this customer
     pipeline = [
-        {"$match": {"tenant_id": tenant_id, "customer.mobile": mobile}},
+        {"$match": {"tenant_id": tenant_id, "normalized.mobile_last10": customer_key(mobile)}},
         {"$sort": {"created_at": -1}},
         {"$group": {
-            "_id": "$device.serial_imei",
+            "_id": "$normalized.imei",
             "device_type": {"$first": "$device.device_type"},
             "brand": {"$first": "$device.brand"},
             "model": {"$first": "$device.model"},
@@ -4619,8 +6862,9 @@ async def get_customer_devices(
     
     # Also get customer info
     customer_job = await db.jobs.find_one(
-        {"tenant_id": tenant_id, "customer.mobile": mobile},
-        {"_id": 0, "customer": 1}
+        {"tenant_id": tenant_id, "normalized.mobile_last10": customer_key(mobile)},
+        {"_id": 0, "customer": 1},
+        sort=[("created_at", -1)]
     )
     customer = customer_job["customer"] if customer_job else {}
     
@@ -4629,7 +6873,7 @@ async def get_customer_devices(
         "devices": devices
     }
 
-@api_router.get("/customers/{mobile}/devices/{serial_imei}/history")
+@api_router.get("/customers/{mobile}/devices/{serial_imei}/history", dependencies=[Depends(device_history_ready)])
 async def get_device_history(
     mobile: str,
     serial_imei: str,
@@ -4642,8 +6886,8 @@ async def get_device_history(
     jobs = await db.jobs.find(
         {
             "tenant_id": tenant_id,
-            "customer.mobile": mobile,
-            "device.serial_imei": serial_imei
+            "normalized.mobile_last10": customer_key(mobile),
+            "normalized.imei": imei_key(serial_imei)
         },
         {"_id": 0}
     ).sort("created_at", -1).to_list(100)
@@ -4674,60 +6918,19 @@ async def get_device_history(
         "total_repairs": len(history)
     }
 
-@api_router.get("/customers/stats")
+@api_router.get("/customers/stats", dependencies=[Depends(customers_ready)])
 async def get_customer_stats(user: dict = Depends(get_current_user)):
     """Get customer statistics"""
     tenant_id = user["tenant_id"]
-    
-    # Total unique customers
-    pipeline = [
-        {"$match": {"tenant_id": tenant_id}},
-        {"$group": {"_id": "$customer.mobile"}},
-        {"$count": "total"}
-    ]
-    total_result = await db.jobs.aggregate(pipeline).to_list(1)
-    total_customers = total_result[0]["total"] if total_result else 0
-    
-    # Repeat customers (more than 1 job)
-    pipeline = [
-        {"$match": {"tenant_id": tenant_id}},
-        {"$group": {"_id": "$customer.mobile", "count": {"$sum": 1}}},
-        {"$match": {"count": {"$gt": 1}}},
-        {"$count": "total"}
-    ]
-    repeat_result = await db.jobs.aggregate(pipeline).to_list(1)
-    repeat_customers = repeat_result[0]["total"] if repeat_result else 0
-    
-    # New customers this month
     month_start = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    pipeline = [
-        {"$match": {"tenant_id": tenant_id}},
-        {"$group": {"_id": "$customer.mobile", "first_visit": {"$min": "$created_at"}}},
-        {"$match": {"first_visit": {"$gte": month_start.isoformat()}}},
-        {"$count": "total"}
-    ]
-    new_result = await db.jobs.aggregate(pipeline).to_list(1)
-    new_customers_this_month = new_result[0]["total"] if new_result else 0
     
-    # Customers with outstanding credit
-    credit_pipeline = [
-        {"$match": {"tenant_id": tenant_id, "delivery": {"$exists": True}}},
-        {"$group": {
-            "_id": "$customer.mobile",
-            "total_billed": {"$sum": {"$ifNull": [
-                "$delivery.final_amount", 
-                {"$ifNull": ["$repair.final_amount", 0]}
-            ]}},
-            "total_received": {"$sum": {"$ifNull": ["$delivery.amount_received", 0]}}
-        }},
-        {"$project": {
-            "outstanding": {"$subtract": ["$total_billed", "$total_received"]}
-        }},
-        {"$match": {"outstanding": {"$gt": 0}}},
-        {"$count": "total"}
-    ]
-    credit_result = await db.jobs.aggregate(credit_pipeline).to_list(1)
-    customers_with_credit = credit_result[0]["total"] if credit_result else 0
+    total_customers = await db.customers.count_documents({"tenant_id": tenant_id})
+    repeat_customers = await db.customers.count_documents({"tenant_id": tenant_id, "total_jobs": {"$gt": 1}})
+    new_customers_this_month = await db.customers.count_documents({
+        "tenant_id": tenant_id,
+        "first_visit": {"$gte": month_start.isoformat()}
+    })
+    customers_with_credit = await db.customers.count_documents({"tenant_id": tenant_id, "balance": {"$gt": 0}})
     
     return {
         "total_customers": total_customers,
@@ -4739,63 +6942,80 @@ async def get_customer_stats(user: dict = Depends(get_current_user)):
 
 # ==================== CUSTOMER LEDGER ROUTES ====================
 
-@api_router.get("/customers/{mobile}/ledger")
-async def get_customer_ledger(mobile: str, user: dict = Depends(get_current_user)):
-    """Get customer ledger showing all transactions and outstanding balance"""
+def ledger_transaction(entry: dict) -> dict:
+    """Shape a ledger entry the way the ledger view lists transactions"""
+    if entry["type"] == "payment":
+        return {
+            "id": entry["id"],
+            "type": "payment",
+            "date": entry["created_at"],
+            "job_number": entry.get("job_number"),
+            "device": entry.get("device_info") or "-",
+            "problem": entry.get("notes") or "Direct payment received",
+            "billed_amount": 0,
+            "received_amount": entry["amount"],
+            "credit_amount": 0,
+            "payment_mode": entry.get("payment_mode"),
+            "status": "payment_received",
+            "balance_after": entry.get("balance_after")
+        }
+    billed, received = entry["billed"], entry["received"]
+    return {
+        "id": entry["id"],
+        "job_id": entry.get("job_id"),
+        "type": entry["type"],
+        "date": entry["created_at"],
+        "job_number": entry.get("job_number"),
+        "device": entry.get("device_info") or "-",
+        "problem": entry.get("notes"),
+        "billed_amount": billed,
+        "received_amount": received,
+        "credit_amount": billed - received if billed > received else 0,
+        "status": "paid" if received >= billed else "credit",
+        "balance_after": entry.get("balance_after")
+    }
+
+@api_router.get("/customers/{mobile}/ledger", dependencies=[Depends(ledger_ready)])
+async def get_customer_ledger(
+    mobile: str,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Customer statement: balance snapshot plus ledger entries, newest first.
+    Pages by `cursor` (the next_cursor of the previous page); jobs repaired but not yet
+    delivered are listed on the first page as "job_pending".
+    """
     tenant_id = user["tenant_id"]
+    key = customer_key(mobile)
     
-    # Get all jobs for this customer
-    jobs = await db.jobs.find(
-        {"tenant_id": tenant_id, "customer.mobile": mobile},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
-    
-    # Get all payments from ledger
-    payments = await db.customer_ledger.find(
-        {"tenant_id": tenant_id, "customer_mobile": mobile},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
+    customer = await db.customers.find_one({"tenant_id": tenant_id, "mobile_key": key}, {"_id": 0}) or {}
     
-    # Calculate totals
-    total_billed = 0
-    total_received = 0
-    total_credit = 0
+    query = {"tenant_id": tenant_id, "customer_mobile_key": key}
+    if cursor:
+        if not cursor.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["seq"] = {"$lt": int(cursor)}
+    limit = max(1, limit)
+    entries = await db.customer_ledger.find(query, {"_id": 0}).sort("seq", -1).limit(limit + 1).to_list(limit + 1)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
     
     transactions = []
-    
-    # Add job transactions
-    for job in jobs:
-        final_amount = 0
-        amount_received = 0
-        
-        if job.get("delivery"):
-            final_amount = job["delivery"].get("final_amount") or job["repair"].get("final_amount", 0) if job.get("repair") else 0
-            amount_received = job["delivery"].get("amount_received", 0)
-            is_credit = job["delivery"].get("is_credit", False)
-            
+    if not cursor:
+        pending_jobs = await db.jobs.find(
+            {
+                "tenant_id": tenant_id,
+                "normalized.mobile_last10": key,
+                "delivery": None,
+                "status": {"$in": ["repaired", "ready_for_delivery"]}
+            },
+            {"_id": 0, "id": 1, "job_number": 1, "device": 1, "problem_description": 1, "repair": 1, "updated_at": 1}
+        ).sort("updated_at", -1).to_list(100)
+        for job in pending_jobs:
+            final_amount = (job.get("repair") or {}).get("final_amount", 0)
             if final_amount > 0:
-                total_billed += final_amount
-                total_received += amount_received
-                
-                if is_credit or amount_received < final_amount:
-                    credit_amt = final_amount - amount_received
-                    total_credit += credit_amt
-                
-                transactions.append({
-                    "id": job["id"],
-                    "type": "job",
-                    "date": job["delivery"].get("delivered_at") or job.get("updated_at"),
-                    "job_number": job["job_number"],
-                    "device": f"{job['device']['brand']} {job['device']['model']}",
-                    "problem": job["problem_description"][:50] + "..." if len(job["problem_description"]) > 50 else job["problem_description"],
-                    "billed_amount": final_amount,
-                    "received_amount": amount_received,
-                    "credit_amount": final_amount - amount_received if final_amount > amount_received else 0,
-                    "status": "paid" if amount_received >= final_amount else "credit"
-                })
-        elif job.get("repair"):
-            final_amount = job["repair"].get("final_amount", 0)
-            if final_amount > 0 and job.get("status") in ["repaired", "ready_for_delivery"]:
                 transactions.append({
                     "id": job["id"],
                     "type": "job_pending",
@@ -4808,39 +7028,19 @@ async def get_customer_ledger(mobile: str, user: dict = Depends(get_current_user
                     "credit_amount": 0,
                     "status": "pending_delivery"
                 })
-    
-    # Add direct payments
-    for payment in payments:
-        if payment.get("type") == "payment":
-            total_received += payment["amount"]
-            total_credit -= payment["amount"]
-            transactions.append({
-                "id": payment["id"],
-                "type": "payment",
-                "date": payment["created_at"],
-                "job_number": payment.get("job_number"),
-                "device": payment.get("device_info", "-"),
-                "problem": payment.get("notes", "Direct payment received"),
-                "billed_amount": 0,
-                "received_amount": payment["amount"],
-                "credit_amount": 0,
-                "payment_mode": payment.get("payment_mode"),
-                "status": "payment_received"
-            })
-    
-    # Sort transactions by date
-    transactions.sort(key=lambda x: x["date"] if x["date"] else "", reverse=True)
+    transactions.extend(ledger_transaction(e) for e in entries)
     
     return {
         "customer_mobile": mobile,
-        "customer_name": jobs[0]["customer"]["name"] if jobs else "Unknown",
-        "total_billed": total_billed,
-        "total_received": total_received,
-        "outstanding_balance": max(0, total_credit),
-        "transactions": transactions
+        "customer_name": customer.get("name", "Unknown"),
+        "total_billed": customer.get("total_billed", 0),
+        "total_received": customer.get("total_received", 0),
+        "outstanding_balance": max(0, customer.get("balance", 0)),
+        "transactions": transactions,
+        "next_cursor": str(entries[-1]["seq"]) if has_more else None
     }
 
-@api_router.post("/customers/{mobile}/payment")
+@api_router.post("/customers/{mobile}/payment", dependencies=[Depends(ledger_ready)])
 async def record_customer_payment(mobile: str, data: CustomerPayment, user: dict = Depends(get_current_user)):
     """Record a payment from customer (full or partial)"""
     tenant_id = user["tenant_id"]
@@ -4848,12 +7048,14 @@ async def record_customer_payment(mobile: str, data: CustomerPayment, user: dict
     
     # Get customer info from latest job
     latest_job = await db.jobs.find_one(
-        {"tenant_id": tenant_id, "customer.mobile": mobile},
-        {"_id": 0, "customer": 1, "device": 1, "job_number": 1}
+        {"tenant_id": tenant_id, "normalized.mobile_last10": customer_key(mobile)},
+        {"_id": 0, "customer": 1, "device": 1, "job_number": 1},
+        sort=[("created_at", -1)]
     )
     
     if not latest_job:
         raise HTTPException(status_code=404, detail="Customer not found")
+    await ensure_ledger_writable(tenant_id)
     
     payment_id = str(uuid.uuid4())
     
@@ -4861,6 +7063,7 @@ async def record_customer_payment(mobile: str, data: CustomerPayment, user: dict
         "id": payment_id,
         "tenant_id": tenant_id,
         "customer_mobile": mobile,
+        "customer_mobile_key": customer_key(mobile),
         "customer_name": latest_job["customer"]["name"],
         "amount": data.amount,
         "payment_mode": data.payment_mode,
@@ -4875,74 +7078,66 @@ async def record_customer_payment(mobile: str, data: CustomerPayment, user: dict
     }
     
     # If linked to a job, get job details
+    job = None
     if data.job_id:
         job = await db.jobs.find_one({"id": data.job_id, "tenant_id": tenant_id}, {"_id": 0})
         if job:
             payment_record["job_number"] = job["job_number"]
             payment_record["device_info"] = f"{job['device']['brand']} {job['device']['model']}"
-            
-            # Update job's delivery record if exists
-            if job.get("delivery"):
-                new_received = job["delivery"].get("amount_received", 0) + data.amount
-                await db.jobs.update_one(
-                    {"id": data.job_id},
-                    {"$set": {"delivery.amount_received": new_received, "updated_at": now}}
-                )
     
-    await db.customer_ledger.insert_one(payment_record)
+    # The payment entry goes first: without a transaction, a failure after it still leaves the money recorded
+    async def apply_payment(session):
+        entry = await post_ledger_entry(dict(payment_record), 0, data.amount, session=session)
+        # Update job's delivery record if exists
+        if job and job.get("delivery"):
+            await db.jobs.update_one(
+                {"id": data.job_id},
+                {"$inc": {"delivery.amount_received": data.amount}, "$set": {"updated_at": now}},
+                session=session
+            )
+        return entry
+    entry = await in_transaction(apply_payment)
     
     return {
         "message": "Payment recorded successfully",
         "payment_id": payment_id,
-        "amount": data.amount
+        "amount": data.amount,
+        "balance": entry["balance_after"]
     }
 
-@api_router.get("/customers/with-outstanding")
-async def get_customers_with_outstanding(user: dict = Depends(get_current_user)):
+@api_router.get("/customers/with-outstanding", dependencies=[Depends(ledger_ready)])
+async def get_customers_with_outstanding(
+    skip: int = 0,
+    limit: int = 100,
+    user: dict = Depends(get_current_user)
+):
     """Get all customers with outstanding balance"""
-    tenant_id = user["tenant_id"]
-    
-    # Get all delivered jobs with credit
-    pipeline = [
-        {"$match": {"tenant_id": tenant_id, "delivery": {"$exists": True}}},
-        {"$group": {
-            "_id": "$customer.mobile",
-            "customer_name": {"$first": "$customer.name"},
-            "total_billed": {"$sum": {"$ifNull": ["$delivery.final_amount", {"$ifNull": ["$repair.final_amount", 0]}]}},
-            "total_received": {"$sum": {"$ifNull": ["$delivery.amount_received", 0]}},
-            "job_count": {"$sum": 1},
-            "last_job_date": {"$max": "$updated_at"}
-        }},
-        {"$project": {
-            "mobile": "$_id",
-            "customer_name": 1,
-            "total_billed": 1,
-            "total_received": 1,
-            "outstanding": {"$subtract": ["$total_billed", "$total_received"]},
-            "job_count": 1,
-            "last_job_date": 1
+    customers = await db.customers.find(
+        {"tenant_id": user["tenant_id"], "balance": {"$gt": 0}},
+        {"_id": 0, "mobile_key": 1, "mobile": 1, "name": 1, "total_billed": 1, "total_received": 1, "balance": 1}
+    ).sort("balance", -1).skip(skip).limit(limit).to_list(limit)
+    
+    # job_count and last_job_date describe the customer's delivered jobs, counted for the whole page at once
+    delivered = {}
+    async for row in db.jobs.aggregate([
+        {"$match": {
+            "tenant_id": user["tenant_id"],
+            "normalized.mobile_last10": {"$in": [c["mobile_key"] for c in customers]},
+            "delivery": {"$ne": None}
         }},
-        {"$match": {"outstanding": {"$gt": 0}}},
-        {"$sort": {"outstanding": -1}}
-    ]
-    
-    customers = await db.jobs.aggregate(pipeline).to_list(100)
-    
-    # Also get direct payments to adjust outstanding
-    for customer in customers:
-        payments = await db.customer_ledger.find(
-            {"tenant_id": tenant_id, "customer_mobile": customer["mobile"], "type": "payment"},
-            {"_id": 0, "amount": 1}
-        ).to_list(100)
-        
-        total_direct_payments = sum(p["amount"] for p in payments)
-        customer["total_received"] += total_direct_payments
-        customer["outstanding"] = max(0, customer["total_billed"] - customer["total_received"])
-    
-    # Filter out customers with no outstanding
-    customers = [c for c in customers if c["outstanding"] > 0]
-    
-    return customers
+        {"$group": {"_id": "$normalized.mobile_last10", "job_count": {"$sum": 1}, "last_job_date": {"$max": "$updated_at"}}}
+    ]):
+        delivered[row["_id"]] = row
+    
+    return [{
+        "mobile": c["mobile"],
+        "customer_name": c["name"],
+        "total_billed": c["total_billed"],
+        "total_received": c["total_received"],
+        "outstanding": c["balance"],
+        "job_count": delivered.get(c["mobile_key"], {}).get("job_count", 0),
+        "last_job_date": delivered.get(c["mobile_key"], {}).get("last_job_date")
+    } for c in customers]
 
 # ==================== INVENTORY ROUTES ====================
 
@@ -4988,7 +7183,9 @@ async def create_inventory_item(data: InventoryItemCreate, user: dict = Depends(
         "created_at": now,
         "updated_at": now
     }
+    item["search_keys"] = inventory_search_keys(item)
     await db.inventory.insert_one(item)
+    await bump_usage(user["tenant_id"], {"inventory_items": 1})
     
     item["is_low_stock"] = item["quantity"] <= item["min_stock_level"]
     return InventoryItemResponse(**item)
@@ -5085,6 +7282,7 @@ async def update_inventory_item(item_id: str, data: InventoryItemUpdate, user: d
     now = datetime.now(timezone.utc).isoformat()
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     update_data["updated_at"] = now
+    update_data["search_keys"] = inventory_search_keys({**item, **update_data})
     
     await db.inventory.update_one({"id": item_id}, {"$set": update_data})
     
@@ -5130,6 +7328,7 @@ async def delete_inventory_item(item_id: str, user: dict = Depends(require_admin
     result = await db.inventory.delete_one({"id": item_id, "tenant_id": user["tenant_id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Item not found")
+    await bump_usage(user["tenant_id"], {"inventory_items": -1})
     return {"message": "Item deleted"}
 
 @api_router.get("/inventory/{item_id}/usage-history")
@@ -5289,7 +7488,7 @@ async def get_technician_metrics(user: dict = Depends(get_current_user)):
     
     return {"technicians": technicians}
 
-@api_router.get("/metrics/overview")
+@api_router.get("/metrics/overview", dependencies=[Depends(job_stats_ready)])
 async def get_metrics_overview(user: dict = Depends(get_current_user)):
     """Get overall shop performance metrics"""
     tenant_id = user["tenant_id"]
@@ -5300,17 +7499,16 @@ async def get_metrics_overview(user: dict = Depends(get_current_user)):
     week_start = today_start - timedelta(days=today_start.weekday())
     month_start = today_start.replace(day=1)
     
-    # Jobs this week
-    jobs_this_week = await db.jobs.count_documents({
-        "tenant_id": tenant_id,
-        "created_at": {"$gte": week_start.isoformat()}
-    })
+    # Status counts and jobs created per day since the earliest date shown
+    trend_start = today_start - timedelta(days=6)
+    since = min(week_start, month_start, trend_start).strftime("%Y-%m-%d")
+    jobs_by_status, jobs_by_date = await job_daily_counts({"tenant_id": tenant_id}, since)
     
-    # Jobs this month
-    jobs_this_month = await db.jobs.count_documents({
-        "tenant_id": tenant_id,
-        "created_at": {"$gte": month_start.isoformat()}
-    })
+    def jobs_since(start: datetime) -> int:
+        return sum(count for date, count in jobs_by_date.items() if date >= start.strftime("%Y-%m-%d"))
+    
+    jobs_this_week = jobs_since(week_start)
+    jobs_this_month = jobs_since(month_start)
     
     # Completed this week
     completed_this_week = await db.jobs.count_documents({
@@ -5338,30 +7536,14 @@ async def get_metrics_overview(user: dict = Depends(get_current_user)):
     revenue_result = await db.jobs.aggregate(pipeline).to_list(1)
     monthly_revenue = revenue_result[0]["total_revenue"] if revenue_result else 0
     
-    # Jobs by status
-    pipeline = [
-        {"$match": {"tenant_id": tenant_id}},
-        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
-    ]
-    status_counts = await db.jobs.aggregate(pipeline).to_list(10)
-    jobs_by_status = {item["_id"]: item["count"] for item in status_counts}
-    
     # Jobs trend (last 7 days)
     trend = []
-    for i in range(6, -1, -1):
-        day = today_start - timedelta(days=i)
-        day_end = day + timedelta(days=1)
-        count = await db.jobs.count_documents({
-            "tenant_id": tenant_id,
-            "created_at": {
-                "$gte": day.isoformat(),
-                "$lt": day_end.isoformat()
-            }
-        })
+    for i in range(7):
+        day = trend_start + timedelta(days=i)
         trend.append({
             "date": day.strftime("%Y-%m-%d"),
             "day": day.strftime("%a"),
-            "jobs": count
+            "jobs": jobs_by_date.get(day.strftime("%Y-%m-%d"), 0)
         })
     
     return {
@@ -5383,7 +7565,7 @@ async def set_profit_password(data: ProfitPasswordSet, user: dict = Depends(get_
         raise HTTPException(status_code=403, detail="Only admin can set profit password")
     
     tenant_id = user["tenant_id"]
-    hashed = bcrypt.hashpw(data.password.encode(), bcrypt.gensalt()).decode()
+    hashed = await hash_password_async(data.password)
     
     await db.tenants.update_one(
         {"id": tenant_id},
@@ -5408,7 +7590,7 @@ async def verify_profit_password(data: ProfitPasswordVerify, user: dict = Depend
     if not profit_password:
         raise HTTPException(status_code=400, detail="Profit password not set. Please set a password first.")
     
-    if not bcrypt.checkpw(data.password.encode(), profit_password.encode()):
+    if not await verify_password_async(data.password, profit_password):
         raise HTTPException(status_code=401, detail="Invalid password")
     
     return {"verified": True, "message": "Password verified successfully"}
@@ -5628,7 +7810,8 @@ async def get_party_wise_profit(
         {"$match": match_query},
         {
             "$group": {
-                "_id": "$customer.mobile",
+                # A job whose mobile has no digits is a party of its own
+                "_id": {"$ifNull": ["$normalized.mobile_last10", "$id"]},
                 "customer_name": {"$first": "$customer.name"},
                 "customer_mobile": {"$first": "$customer.mobile"},
                 "total_jobs": {"$sum": 1},
@@ -5772,14 +7955,41 @@ async def get_profit_summary(
 # Include the router in the main app
 app.include_router(api_router)
 
+# Added before CORS so CORS wraps it and a 413 still reaches the browser with CORS headers
+app.add_middleware(UploadSizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count"],
 )
 
+# Long-running loops started at startup, cancelled on shutdown
+background_tasks = []
+
+@app.on_event("startup")
+async def startup_tasks():
+    global transactions_supported
+    transactions_supported = await detect_transaction_support()
+    logger.info(f"MongoDB transactions {'enabled' if transactions_supported else 'unavailable, ledger postings run without them'}")
+    await ensure_indexes()
+    background_tasks.append(asyncio.create_task(migration_loop()))
+    if USAGE_RECONCILE_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(usage_reconciliation_loop()))
+    if ANALYTICS_ROLLUP_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(analytics_rollup_loop()))
+    background_tasks.append(asyncio.create_task(backfill_photo_variants()))
+    background_tasks.append(asyncio.create_task(pdf_cache.load()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
     client.close()
+    password_executor.shutdown(wait=False)
+    if rate_limiter is not local_rate_limiter:
+        await rate_limiter.client.aclose()
+    if pdf_executor is not None:
+        pdf_executor.shutdown(wait=False, cancel_futures=True)
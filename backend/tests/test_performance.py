@@ -0,0 +1,820 @@
+"""
+Performance checks for the hot API paths
+Run against a live deployment; each test prints its latency numbers and asserts a loose budget
+"""
+import pytest
+import requests
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials from the review request
+TEST_SHOP = {
+    "subdomain": "invtest1769339559",
+    "email": "admin@test.example.com",
+    "password": "Test@123"
+}
+
+SUPER_ADMIN = {
+    "email": os.environ.get('SUPER_ADMIN_EMAIL', 'superadmin@aftersales.pro'),
+    "password": os.environ.get('SUPER_ADMIN_PASSWORD', 'SuperAdmin@123')
+}
+
+LOGIN_STORM_SIZE = int(os.environ.get('LOGIN_STORM_SIZE', 50))
+LOGIN_STORM_P99_BUDGET_MS = float(os.environ.get('LOGIN_STORM_P99_BUDGET_MS', 500))
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def timed(method, url, **kwargs):
+    """Return (response, elapsed milliseconds)"""
+    start = time.perf_counter()
+    response = requests.request(method, url, timeout=60, **kwargs)
+    return response, (time.perf_counter() - start) * 1000
+
+
+def login(request, url, credentials):
+    """Sign in once per test class and share the auth headers with its tests as self.headers"""
+    response = requests.post(url, json=credentials)
+    if response.status_code != 200:
+        pytest.skip(f"Login failed: {response.text}")
+    request.cls.headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+
+@pytest.fixture(scope="class")
+def shop_login(request):
+    login(request, f"{BASE_URL}/api/auth/login", TEST_SHOP)
+
+
+@pytest.fixture(scope="class")
+def super_admin_login(request):
+    login(request, f"{BASE_URL}/api/super-admin/login", SUPER_ADMIN)
+
+
+class TestLoginStorm:
+    """bcrypt runs on a worker pool, so unrelated endpoints stay fast during a burst of logins"""
+
+    def login(self):
+        response, _ = timed("POST", f"{BASE_URL}/api/auth/login", json=TEST_SHOP)
+        return response.status_code
+
+    def test_health_p99_during_login_storm(self):
+        baseline = [timed("GET", f"{BASE_URL}/api/health")[1] for _ in range(20)]
+
+        during = []
+        with ThreadPoolExecutor(max_workers=min(LOGIN_STORM_SIZE, 64)) as pool:
+            logins = [pool.submit(self.login) for _ in range(LOGIN_STORM_SIZE)]
+            while not all(f.done() for f in logins):
+                during.append(timed("GET", f"{BASE_URL}/api/health")[1])
+            statuses = [f.result() for f in logins]
+
+        # The whole storm is one IP and account, which the login rate limit only lets a burst of through
+        # at once; run the server under test with RATE_LIMIT_LOGIN_BURST and RATE_LIMIT_LOGIN_ACCOUNT_BURST
+        # of at least LOGIN_STORM_SIZE
+        assert all(code in (200, 401) for code in statuses), f"Unexpected login statuses: {set(statuses)}"
+        assert during, "Login storm finished before any health probe completed"
+
+        print(f"✓ /api/health p99 baseline: {percentile(baseline, 99):.1f} ms")
+        print(f"✓ /api/health p99 during {LOGIN_STORM_SIZE} logins: {percentile(during, 99):.1f} ms ({len(during)} samples)")
+        assert percentile(during, 99) < LOGIN_STORM_P99_BUDGET_MS
+
+
+JOB_BURST_SIZE = int(os.environ.get('JOB_BURST_SIZE', 1000))
+# The burst's jobs can't be deleted, so they go to a shop of their own instead of TEST_SHOP, where they
+# would use up its plan's job limit and grow the lists every other benchmark reads
+JOB_BURST_SHOP = {
+    "subdomain": "perfjobs",
+    "email": "perfjobs@test.example.com",
+    "password": "Test@123"
+}
+
+
+@pytest.fixture(scope="class")
+def job_burst_shop_login(request):
+    """Log in to JOB_BURST_SHOP, which the super admin creates on an unlimited plan the first time"""
+    admin = requests.post(f"{BASE_URL}/api/super-admin/login", json=SUPER_ADMIN)
+    if admin.status_code != 200:
+        pytest.skip(f"Super admin login failed: {admin.text}")
+    response = requests.post(f"{BASE_URL}/api/super-admin/tenants", timeout=60,
+                             headers={"Authorization": f"Bearer {admin.json()['token']}"}, json={
+        "company_name": "TEST_Perf Job Burst",
+        "subdomain": JOB_BURST_SHOP["subdomain"],
+        "admin_name": "Perf Admin",
+        "admin_email": JOB_BURST_SHOP["email"],
+        "admin_password": JOB_BURST_SHOP["password"],
+        "subscription_plan": "enterprise",
+        "trial_days": 3650
+    })
+    # 400 means an earlier run already created it
+    assert response.status_code in (200, 400), response.text
+    login(request, f"{BASE_URL}/api/auth/login", JOB_BURST_SHOP)
+
+
+@pytest.mark.usefixtures("job_burst_shop_login")
+class TestJobNumberConcurrency:
+    """Job numbers come from an atomic counter, so parallel creates never share a number"""
+
+    def create_job(self, index):
+        response = requests.post(f"{BASE_URL}/api/jobs", headers=self.headers, timeout=60, json={
+            "customer": {"name": f"TEST_Burst {index}", "mobile": f"9{index:09d}"},
+            "device": {"device_type": "Mobile", "brand": "Test", "model": "Burst", "serial_imei": f"BURST{index:06d}"},
+            "accessories": [],
+            "problem_description": "TEST_ concurrency check"
+        })
+        return response.status_code, response.json().get("job_number") if response.status_code == 200 else None
+
+    def test_parallel_creates_get_unique_numbers(self):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            results = list(pool.map(self.create_job, range(JOB_BURST_SIZE)))
+        elapsed = time.perf_counter() - start
+
+        statuses = [code for code, _ in results]
+        numbers = [number for _, number in results if number]
+        assert all(code in (200, 403) for code in statuses), f"Unexpected statuses: {set(statuses)}"
+        if not numbers:
+            pytest.skip("Plan job limit reached before any job was created")
+
+        duplicates = len(numbers) - len(set(numbers))
+        print(f"✓ Created {len(numbers)}/{JOB_BURST_SIZE} jobs in {elapsed:.1f}s, {duplicates} duplicate numbers")
+        assert duplicates == 0
+
+
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 20))
+PAGE_DEPTH = int(os.environ.get('PAGE_DEPTH', 500))
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestJobListPagination:
+    """Deep pages of GET /api/jobs: cursor pagination vs skip/limit"""
+
+    def test_deep_page_cursor_vs_skip(self):
+        cursor = ""
+        for page in range(1, PAGE_DEPTH + 1):
+            response, cursor_ms = timed("GET", f"{BASE_URL}/api/jobs", headers=self.headers,
+                                        params={"limit": PAGE_SIZE, "cursor": cursor})
+            assert response.status_code == 200
+            data = response.json()
+            if page < PAGE_DEPTH and not data["next_cursor"]:
+                pytest.skip(f"Only {page} pages of {PAGE_SIZE} jobs available, need {PAGE_DEPTH}")
+            cursor = data["next_cursor"]
+        cursor_ids = [job["id"] for job in data["jobs"]]
+
+        response, skip_ms = timed("GET", f"{BASE_URL}/api/jobs", headers=self.headers,
+                                  params={"limit": PAGE_SIZE, "skip": (PAGE_DEPTH - 1) * PAGE_SIZE})
+        assert response.status_code == 200
+        skip_ids = [job["id"] for job in response.json()]
+
+        print(f"✓ Page {PAGE_DEPTH} via skip/limit: {skip_ms:.1f} ms")
+        print(f"✓ Page {PAGE_DEPTH} via cursor: {cursor_ms:.1f} ms")
+        assert cursor_ids == skip_ids, "Cursor and skip pages disagree (were jobs created during the run?)"
+        assert cursor_ms <= max(skip_ms, 50) * 1.5
+
+
+SEARCH_QUERIES = ["job", "98765", "iphone", "screen", "TEST"]
+SEARCH_P95_BUDGET_MS = float(os.environ.get('SEARCH_P95_BUDGET_MS', 50))
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestUniversalSearch:
+    """Universal search resolves through the search_keys index"""
+
+    def test_search_latency(self):
+        samples = []
+        for _ in range(10):
+            for q in SEARCH_QUERIES:
+                response, ms = timed("GET", f"{BASE_URL}/api/search", headers=self.headers, params={"q": q, "limit": 15})
+                assert response.status_code == 200
+                samples.append(ms)
+
+        print(f"✓ /api/search p50 {percentile(samples, 50):.1f} ms, p95 {percentile(samples, 95):.1f} ms over {len(samples)} queries")
+        assert percentile(samples, 95) < SEARCH_P95_BUDGET_MS
+
+    def test_partial_job_number_matches(self):
+        response = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1})
+        jobs = response.json()
+        if not jobs:
+            pytest.skip("No jobs to search for")
+        job_number = jobs[0]["job_number"]
+
+        response = requests.get(f"{BASE_URL}/api/search", headers=self.headers, params={"q": job_number[:-2]})
+        assert response.status_code == 200
+        assert any(r.get("job_number") == job_number for r in response.json()["results"]) or response.json()["total"] >= 15
+
+    def test_job_list_mid_word_search(self):
+        # Search keys are word prefixes; the job list still finds "avi" in "Ravi" through its substring fallback
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs or len(jobs[0]["customer"]["name"].split()[0]) < 4:
+            pytest.skip("No job with a customer name long enough to search mid-word")
+        job = jobs[0]
+
+        response = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers,
+                                params={"search": job["customer"]["name"].split()[0][1:], "limit": 100})
+        assert response.status_code == 200
+        assert job["id"] in [j["id"] for j in response.json()]
+
+
+TENANT_SEED_COUNT = int(os.environ.get('TENANT_SEED_COUNT', 200))
+TENANT_LIST_P95_BUDGET_MS = float(os.environ.get('TENANT_LIST_P95_BUDGET_MS', 500))
+
+
+@pytest.mark.usefixtures("super_admin_login")
+class TestSuperAdminTenantList:
+    """The tenant list is enriched with batched counts, so its latency doesn't grow by 3 queries per tenant"""
+
+    def seed_tenant(self, index):
+        response = requests.post(f"{BASE_URL}/api/super-admin/tenants", headers=self.headers, timeout=60, json={
+            "company_name": f"TEST_Perf Shop {index}",
+            "subdomain": f"perftest{index}",
+            "admin_name": "Perf Admin",
+            "admin_email": f"perf{index}@test.example.com",
+            "admin_password": "Test@123"
+        })
+        # 400 means another run seeded it first
+        return response.status_code
+
+    def test_tenant_list_latency(self):
+        # Every run reuses the same perftest0..N shops and only seeds the missing ones, so a deployment
+        # never collects more than TENANT_SEED_COUNT of them
+        response = requests.get(f"{BASE_URL}/api/super-admin/tenants", headers=self.headers,
+                                params={"search": "perftest", "limit": 1000})
+        existing = {t["subdomain"] for t in response.json()}
+        missing = [index for index in range(TENANT_SEED_COUNT) if f"perftest{index}" not in existing]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            statuses = list(pool.map(self.seed_tenant, missing))
+        assert all(code in (200, 400) for code in statuses), f"Unexpected statuses: {set(statuses)}"
+
+        samples = []
+        for _ in range(10):
+            response, ms = timed("GET", f"{BASE_URL}/api/super-admin/tenants", headers=self.headers)
+            assert response.status_code == 200
+            samples.append(ms)
+        total = int(response.headers["X-Total-Count"])
+        assert total >= TENANT_SEED_COUNT
+        assert len(response.json()) == min(total, 1000)
+
+        response = requests.get(f"{BASE_URL}/api/super-admin/tenants", headers=self.headers,
+                                params={"sort_by": "subdomain", "sort_order": "asc", "limit": 25, "skip": 25})
+        assert response.status_code == 200
+        subdomains = [t["subdomain"] for t in response.json()]
+        assert subdomains == sorted(subdomains) and len(subdomains) == 25
+
+        print(f"✓ /api/super-admin/tenants ({total} tenants) p50 {percentile(samples, 50):.1f} ms, p95 {percentile(samples, 95):.1f} ms")
+        assert percentile(samples, 95) < TENANT_LIST_P95_BUDGET_MS
+
+
+ANALYTICS_P95_BUDGET_MS = float(os.environ.get('ANALYTICS_P95_BUDGET_MS', 200))
+
+
+@pytest.mark.usefixtures("super_admin_login")
+class TestSuperAdminAnalytics:
+    """Analytics are served from pre-aggregated rollups; fresh=true recomputes from the source collections"""
+
+    def test_rollup_vs_live_latency(self):
+        response = requests.post(f"{BASE_URL}/api/super-admin/system/analytics/refresh", headers=self.headers, timeout=300)
+        assert response.status_code in (200, 409)
+
+        rollup, live = [], []
+        for _ in range(10):
+            response, ms = timed("GET", f"{BASE_URL}/api/super-admin/analytics", headers=self.headers)
+            assert response.status_code == 200
+            rollup.append(ms)
+            response, ms = timed("GET", f"{BASE_URL}/api/super-admin/analytics", headers=self.headers, params={"fresh": "true"})
+            assert response.status_code == 200
+            live.append(ms)
+        assert "as_of" in response.json()
+
+        print(f"✓ /api/super-admin/analytics p95 from rollups: {percentile(rollup, 95):.1f} ms")
+        print(f"✓ /api/super-admin/analytics p95 with fresh=true: {percentile(live, 95):.1f} ms")
+        assert percentile(rollup, 95) < ANALYTICS_P95_BUDGET_MS
+
+
+DASHBOARD_P95_BUDGET_MS = float(os.environ.get('DASHBOARD_P95_BUDGET_MS', 100))
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestDashboardStats:
+    """Dashboard counters come from the job_daily_stats rollup"""
+
+    def test_dashboard_latency(self):
+        for path in ("/api/jobs/stats", "/api/metrics/overview"):
+            samples = []
+            for _ in range(20):
+                response, ms = timed("GET", f"{BASE_URL}{path}", headers=self.headers)
+                assert response.status_code == 200
+                samples.append(ms)
+            print(f"✓ {path} p95 {percentile(samples, 95):.1f} ms")
+            assert percentile(samples, 95) < DASHBOARD_P95_BUDGET_MS
+
+    def test_stats_match_job_list(self):
+        stats = requests.get(f"{BASE_URL}/api/jobs/stats", headers=self.headers).json()
+        response = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"status_filter": "received", "limit": 1000})
+        assert response.status_code == 200
+        if len(response.json()) < 1000:
+            assert stats["received"] == len(response.json())
+
+
+PDF_BURST_SIZE = int(os.environ.get('PDF_BURST_SIZE', 50))
+PDF_BURST_P99_BUDGET_MS = float(os.environ.get('PDF_BURST_P99_BUDGET_MS', 500))
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestPdfRendering:
+    """Job sheet PDFs render in worker processes, so a print batch doesn't stall the job list"""
+
+    def test_job_list_p99_during_pdf_burst(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 20}).json()
+        if not jobs:
+            pytest.skip("No jobs to render")
+
+        def list_jobs():
+            return timed("GET", f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 20})[1]
+
+        def render(index):
+            response, ms = timed("GET", f"{BASE_URL}/api/jobs/{jobs[index % len(jobs)]['id']}/pdf", headers=self.headers)
+            if response.status_code == 200:
+                assert response.content.startswith(b"%PDF")
+            return response.status_code
+
+        baseline = [list_jobs() for _ in range(20)]
+
+        during = []
+        with ThreadPoolExecutor(max_workers=min(PDF_BURST_SIZE, 32)) as pool:
+            renders = [pool.submit(render, i) for i in range(PDF_BURST_SIZE)]
+            while not all(f.done() for f in renders):
+                during.append(list_jobs())
+            statuses = [f.result() for f in renders]
+
+        assert all(code in (200, 429) for code in statuses), f"Unexpected PDF statuses: {set(statuses)}"
+        assert during, "PDF burst finished before any job list probe completed"
+
+        print(f"✓ {statuses.count(200)} PDFs rendered, {statuses.count(429)} turned away with 429")
+        print(f"✓ /api/jobs p99 baseline: {percentile(baseline, 99):.1f} ms")
+        print(f"✓ /api/jobs p99 during {PDF_BURST_SIZE} PDF requests: {percentile(during, 99):.1f} ms ({len(during)} samples)")
+        assert percentile(during, 99) < PDF_BURST_P99_BUDGET_MS
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestPdfCache:
+    """Job sheets are cached by content hash and revalidated with ETag/If-None-Match"""
+
+    def test_cached_pdf_and_etag(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs:
+            pytest.skip("No jobs to render")
+        url = f"{BASE_URL}/api/jobs/{jobs[0]['id']}/pdf"
+
+        first, first_ms = timed("GET", url, headers=self.headers)
+        assert first.status_code == 200
+        etag = first.headers["ETag"]
+
+        cached = [timed("GET", url, headers=self.headers) for _ in range(10)]
+        assert all(r.headers["ETag"] == etag and r.content == first.content for r, _ in cached)
+
+        not_modified, not_modified_ms = timed("GET", url, headers={**self.headers, "If-None-Match": etag})
+        assert not_modified.status_code == 304
+
+        print(f"✓ First PDF {first_ms:.1f} ms, cached p50 {percentile([ms for _, ms in cached], 50):.1f} ms, 304 {not_modified_ms:.1f} ms")
+
+
+BULK_EXPORT_SIZE = int(os.environ.get('BULK_EXPORT_SIZE', 100))
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestBulkExport:
+    """Bulk job sheet export streams a ZIP as sheets finish rendering"""
+
+    def test_zip_export_streams(self):
+        import io
+        import zipfile
+
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": BULK_EXPORT_SIZE}).json()
+        if not jobs:
+            pytest.skip("No jobs to export")
+
+        start = time.perf_counter()
+        first_byte_ms = None
+        body = io.BytesIO()
+        with requests.get(f"{BASE_URL}/api/jobs/export", headers=self.headers, stream=True, timeout=600,
+                          params={"limit": BULK_EXPORT_SIZE}) as response:
+            assert response.status_code == 200
+            for chunk in response.iter_content(chunk_size=None):
+                if first_byte_ms is None:
+                    first_byte_ms = (time.perf_counter() - start) * 1000
+                body.write(chunk)
+        total_ms = (time.perf_counter() - start) * 1000
+
+        archive = zipfile.ZipFile(body)
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == sorted(f"job-{j['job_number']}.pdf" for j in jobs)
+        print(f"✓ Exported {len(jobs)} job sheets: first byte {first_byte_ms:.0f} ms, complete {total_ms:.0f} ms")
+
+    def test_combined_pdf_export(self):
+        response = requests.get(f"{BASE_URL}/api/jobs/export", headers=self.headers, timeout=300,
+                                params={"format": "pdf", "limit": 5})
+        if response.status_code == 404:
+            pytest.skip("No jobs to export")
+        assert response.status_code == 200
+        assert response.content.startswith(b"%PDF")
+
+
+TEMPLATE_BENCH_RENDERS = int(os.environ.get('TEMPLATE_BENCH_RENDERS', 100))
+
+
+class TestJobSheetTemplates:
+    """Job sheet styles are built once per worker and reused, but every render lays out fresh flowables"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        import sys
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.pdf = pytest.importorskip("job_sheet_pdf")
+        self.tenant = {"company_name": "TEST_Template Shop", "settings": {"address": "1 Main Road", "phone": "9876543210"}}
+        self.job = {
+            "job_number": "JOB-2026-000001", "tracking_token": "ABCD1234", "status": "repaired",
+            "created_at": "2026-01-01T10:00:00+00:00",
+            "customer": {"name": "TEST_Customer", "mobile": "9876543210"},
+            "device": {"device_type": "Mobile", "brand": "Test", "model": "Bench", "serial_imei": "123456789012345"},
+            "accessories": [{"name": "Charger", "checked": True}],
+            "problem_description": "TEST_ screen not working",
+            "diagnosis": {"diagnosis": "Display", "estimated_cost": 1500, "estimated_timeline": "2 days"},
+            "repair": {"work_done": "Replaced display", "final_amount": 1500}
+        }
+
+    def page_count(self, pdf_bytes):
+        return pdf_bytes.count(b"/Type /Page\n") + pdf_bytes.count(b"/Type /Page ")
+
+    def test_multi_page_sheet_renders_twice(self):
+        # Growing the problem text moves the page break across every section after it
+        pages = set()
+        for repeats in range(0, 120, 3):
+            job = {**self.job, "problem_description": "TEST_ screen not working after a drop. " * repeats}
+            self.pdf.job_sheet_styles.cache_clear()
+            first = self.pdf.render_job_sheet(job, self.tenant)
+            second = self.pdf.render_job_sheet(job, self.tenant)
+            assert self.page_count(second) == self.page_count(first)
+            pages.add(self.page_count(first))
+
+        assert max(pages) > 1
+        print(f"✓ Job sheets of {min(pages)}-{max(pages)} pages rendered twice with one set of styles")
+
+    def test_bulk_render_reuses_styles(self):
+        self.pdf.job_sheet_styles.cache_clear()
+        jobs = [
+            {**self.job, "problem_description": "TEST_ screen not working after a drop. " * repeats}
+            for repeats in (0, 12, 30, 45, 60, 90)
+        ]
+
+        combined = self.pdf.render_job_sheets(jobs, self.tenant)
+        again = self.pdf.render_job_sheets(jobs, self.tenant)
+
+        assert self.page_count(combined) >= len(jobs)
+        assert self.page_count(again) == self.page_count(combined)
+        assert self.pdf.job_sheet_styles.cache_info().misses == 1
+        print(f"✓ {len(jobs)} jobs rendered into {self.page_count(combined)} pages, twice, from one set of styles")
+
+    def cpu_ms_per_call(self, fn):
+        start = time.process_time()
+        for _ in range(TEMPLATE_BENCH_RENDERS):
+            fn()
+        return (time.process_time() - start) / TEMPLATE_BENCH_RENDERS * 1000
+
+    def test_shared_styles_save_cpu(self):
+        # Clearing the cache before every call rebuilds the stylesheet each time, as renders used to
+        def rebuilt():
+            self.pdf.job_sheet_styles.cache_clear()
+            return self.pdf.job_sheet_elements(self.job, self.tenant)
+
+        def shared():
+            return self.pdf.job_sheet_elements(self.job, self.tenant)
+
+        rebuilt_ms = self.cpu_ms_per_call(rebuilt)
+        shared_ms = self.cpu_ms_per_call(shared)
+        render_ms = self.cpu_ms_per_call(lambda: self.pdf.render_job_sheet(self.job, self.tenant))
+
+        print(f"✓ Sheet elements: {rebuilt_ms:.2f} ms CPU building the styles each time, {shared_ms:.2f} ms sharing them")
+        print(f"✓ Full render with shared styles: {render_ms:.2f} ms CPU")
+        assert shared_ms < rebuilt_ms
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestTrackingQr:
+    """Tracking QR codes are generated once per payload and served with immutable cache headers"""
+
+    def test_qr_formats_and_caching(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs:
+            pytest.skip("No jobs for a QR code")
+        url = f"{BASE_URL}/api/jobs/{jobs[0]['id']}/qr"
+
+        png, first_ms = timed("GET", url, headers=self.headers)
+        assert png.status_code == 200
+        assert png.content.startswith(b"\x89PNG")
+        assert "immutable" in png.headers["Cache-Control"]
+
+        repeated = [timed("GET", url, headers=self.headers) for _ in range(10)]
+        assert all(r.content == png.content for r, _ in repeated)
+
+        svg = requests.get(url, headers=self.headers, params={"format": "svg"})
+        assert svg.status_code == 200
+        assert svg.headers["Content-Type"].startswith("image/svg+xml")
+
+        not_modified = requests.get(url, headers={**self.headers, "If-None-Match": png.headers["ETag"]})
+        assert not_modified.status_code == 304
+
+        print(f"✓ First QR {first_ms:.1f} ms, memoized p50 {percentile([ms for _, ms in repeated], 50):.1f} ms")
+
+
+UPLOAD_BURST_SIZE = int(os.environ.get('UPLOAD_BURST_SIZE', 50))
+UPLOAD_RSS_BUDGET_MB = float(os.environ.get('UPLOAD_RSS_BUDGET_MB', 150))
+# RSS is only observable when the server runs on this machine; set SERVER_PID to its process id
+SERVER_PID = os.environ.get('SERVER_PID')
+
+
+def server_rss_mb():
+    with open(f"/proc/{SERVER_PID}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestPhotoUploads:
+    """Photos stream to disk in chunks, so concurrent uploads don't grow the worker's memory"""
+
+    def test_concurrent_uploads_keep_rss_flat(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs:
+            pytest.skip("No jobs to attach photos to")
+        url = f"{BASE_URL}/api/jobs/{jobs[0]['id']}/photos"
+        photo = os.urandom(10 * 1024 * 1024 - 4096)
+
+        def upload(index):
+            response, ms = timed("POST", url, headers=self.headers, data={"photo_type": "before"},
+                                 files={"file": (f"TEST_bench_{index}.jpg", photo, "image/jpeg")})
+            if response.status_code == 200:
+                requests.delete(f"{url}/{response.json()['photo']['id']}", headers=self.headers)
+            return response.status_code, ms
+
+        baseline_mb = server_rss_mb() if SERVER_PID else None
+        peak_mb = baseline_mb
+        with ThreadPoolExecutor(max_workers=UPLOAD_BURST_SIZE) as pool:
+            uploads = [pool.submit(upload, i) for i in range(UPLOAD_BURST_SIZE)]
+            while SERVER_PID and not all(f.done() for f in uploads):
+                peak_mb = max(peak_mb, server_rss_mb())
+                time.sleep(0.05)
+            results = [f.result() for f in uploads]
+
+        statuses = [code for code, _ in results]
+        if statuses.count(403) == len(statuses):
+            pytest.skip("Photo uploads are not available on this plan")
+        assert all(code in (200, 403) for code in statuses), f"Unexpected upload statuses: {set(statuses)}"
+        print(f"✓ {statuses.count(200)} uploads of 10 MB, p99 {percentile([ms for _, ms in results], 99):.0f} ms")
+        if SERVER_PID:
+            print(f"✓ Server RSS {baseline_mb:.0f} MB before, {peak_mb:.0f} MB peak")
+            assert peak_mb - baseline_mb < UPLOAD_RSS_BUDGET_MB
+
+    def test_oversized_upload_rejected_early(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs:
+            pytest.skip("No jobs to attach photos to")
+        response = requests.post(f"{BASE_URL}/api/jobs/{jobs[0]['id']}/photos", headers=self.headers,
+                                 files={"file": ("TEST_too_big.jpg", os.urandom(11 * 1024 * 1024), "image/jpeg")})
+        assert response.status_code == 413
+
+    def test_chunked_oversized_upload_rejected(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs:
+            pytest.skip("No jobs to attach photos to")
+        boundary = "TESTboundary"
+
+        # A generator body is sent chunked, without a Content-Length for the server to check up front
+        def body():
+            yield (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="TEST_too_big.jpg"\r\n'
+                   'Content-Type: image/jpeg\r\n\r\n').encode()
+            for _ in range(11):
+                yield os.urandom(1024 * 1024)
+            yield f"\r\n--{boundary}--\r\n".encode()
+
+        response = requests.post(f"{BASE_URL}/api/jobs/{jobs[0]['id']}/photos", data=body(),
+                                 headers={**self.headers, "Content-Type": f"multipart/form-data; boundary={boundary}"})
+        assert response.status_code == 413
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestPhotoVariants:
+    """Galleries load small WebP variants made in the background instead of full camera images"""
+
+    def camera_jpeg(self):
+        from io import BytesIO
+        image_module = pytest.importorskip("PIL.Image")
+        body = BytesIO()
+        image_module.frombytes("RGB", (4000, 3000), os.urandom(4000 * 3000 * 3)).save(body, "JPEG", quality=85)
+        return body.getvalue()
+
+    def test_thumbnail_bytes_vs_original(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs:
+            pytest.skip("No jobs to attach photos to")
+        job_url = f"{BASE_URL}/api/jobs/{jobs[0]['id']}"
+        original = self.camera_jpeg()[:10 * 1024 * 1024]
+
+        response = requests.post(f"{job_url}/photos", headers=self.headers,
+                                 files={"file": ("TEST_variants.jpg", original, "image/jpeg")})
+        if response.status_code == 403:
+            pytest.skip("Photo uploads are not available on this plan")
+        assert response.status_code == 200
+        photo_id = response.json()["photo"]["id"]
+
+        try:
+            start = time.perf_counter()
+            photo = None
+            while time.perf_counter() - start < 30:
+                photos = requests.get(job_url, headers=self.headers).json().get("photos", [])
+                photo = next(p for p in photos if p["id"] == photo_id)
+                if "variants" in photo:
+                    break
+                time.sleep(0.2)
+            ready_ms = (time.perf_counter() - start) * 1000
+            assert photo and photo.get("variants"), "Variants were not generated"
+
+            thumb = requests.get(f"{BASE_URL}{photo['variants']['thumb']}")
+            medium = requests.get(f"{BASE_URL}{photo['variants']['medium']}")
+            assert thumb.headers["Content-Type"] == "image/webp"
+            assert "immutable" in thumb.headers["Cache-Control"]
+            print(f"✓ Variants ready in {ready_ms:.0f} ms: original {len(original) // 1024} KB, "
+                  f"medium {len(medium.content) // 1024} KB, thumb {len(thumb.content) // 1024} KB")
+            assert len(thumb.content) < len(original) / 10
+        finally:
+            requests.delete(f"{job_url}/photos/{photo_id}", headers=self.headers)
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestPhotoDedup:
+    """Re-uploading the same image stores it once; storage usage is counted per stored file"""
+
+    def storage_mb(self):
+        usage = requests.get(f"{BASE_URL}/api/tenants/plan-usage", headers=self.headers).json()
+        return usage["usage"]["storage_mb"]["current"]
+
+    def test_duplicate_upload_shares_one_file(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs:
+            pytest.skip("No jobs to attach photos to")
+        url = f"{BASE_URL}/api/jobs/{jobs[0]['id']}/photos"
+        image = os.urandom(2 * 1024 * 1024)
+
+        before_mb = self.storage_mb()
+        photos = []
+        try:
+            for name in ("TEST_dup_before.jpg", "TEST_dup_retry.jpg"):
+                response = requests.post(url, headers=self.headers, files={"file": (name, image, "image/jpeg")})
+                if response.status_code == 403:
+                    pytest.skip(f"Photo upload not allowed: {response.json()['detail']}")
+                assert response.status_code == 200
+                photos.append(response.json()["photo"])
+
+            assert photos[0]["url"] == photos[1]["url"]
+            stored_mb = self.storage_mb() - before_mb
+            print(f"✓ Two uploads of a 2 MB image added {stored_mb:.2f} MB of storage")
+            assert stored_mb < 3
+
+            requests.delete(f"{url}/{photos.pop(0)['id']}", headers=self.headers)
+            assert requests.get(f"{BASE_URL}{photos[0]['url']}").status_code == 200
+        finally:
+            for photo in photos:
+                requests.delete(f"{url}/{photo['id']}", headers=self.headers)
+
+
+@pytest.mark.usefixtures("shop_login")
+class TestPhotoStorage:
+    """With STORAGE_BACKEND=s3 (e.g. against a local MinIO via S3_ENDPOINT_URL) /uploads redirects to presigned
+    URLs, so the API no longer streams image bytes; with local storage it serves them itself"""
+
+    def test_upload_served_from_storage(self):
+        jobs = requests.get(f"{BASE_URL}/api/jobs", headers=self.headers, params={"limit": 1}).json()
+        if not jobs:
+            pytest.skip("No jobs to attach photos to")
+        url = f"{BASE_URL}/api/jobs/{jobs[0]['id']}/photos"
+        image = os.urandom(9 * 1024 * 1024)
+
+        response, upload_ms = timed("POST", url, headers=self.headers, files={"file": ("TEST_storage.jpg", image, "image/jpeg")})
+        if response.status_code == 403:
+            pytest.skip(f"Photo upload not allowed: {response.json()['detail']}")
+        assert response.status_code == 200
+        photo = response.json()["photo"]
+
+        try:
+            served, serve_ms = timed("GET", f"{BASE_URL}{photo['url']}", allow_redirects=False)
+            if served.status_code == 307:
+                stored, fetch_ms = timed("GET", served.headers["Location"])
+                assert stored.content == image
+                print(f"✓ 9 MB upload {upload_ms:.0f} ms; redirect {serve_ms:.1f} ms, object store fetch {fetch_ms:.0f} ms")
+            else:
+                assert served.status_code == 200 and served.content == image
+                print(f"✓ 9 MB upload {upload_ms:.0f} ms; served from local disk in {serve_ms:.0f} ms")
+        finally:
+            requests.delete(f"{url}/{photo['id']}", headers=self.headers)
+
+
+TRACKING_POLLS = int(os.environ.get('TRACKING_POLLS', 200))
+
+
+@pytest.mark.usefixtures("job_burst_shop_login")
+class TestPublicTracking:
+    """Repeat polls of the public tracking page are served from cache and revalidate with 304"""
+
+    def test_tracking_polls(self):
+        # A job of its own, in the shop whose jobs are never cleaned up, so real jobs keep their status
+        response = requests.post(f"{BASE_URL}/api/jobs", headers=self.headers, timeout=60, json={
+            "customer": {"name": "TEST_Tracking", "mobile": "9000000001"},
+            "device": {"device_type": "Mobile", "brand": "Test", "model": "Tracking", "serial_imei": "TRACK000001"},
+            "accessories": [],
+            "problem_description": "TEST_ tracking poll"
+        })
+        assert response.status_code == 200, response.text
+        job = response.json()
+        link = requests.get(f"{BASE_URL}/api/jobs/{job['id']}/tracking-link", headers=self.headers).json()
+        url = f"{BASE_URL}/api/public/track/{link['job_number']}/{link['tracking_token']}"
+
+        first = requests.get(url)
+        assert first.status_code == 200
+        etag = first.headers["ETag"]
+
+        full = [timed("GET", url)[1] for _ in range(TRACKING_POLLS)]
+        revalidated = [timed("GET", url, headers={"If-None-Match": etag}) for _ in range(TRACKING_POLLS)]
+        assert all(r.status_code == 304 and not r.content for r, _ in revalidated)
+
+        print(f"✓ Tracking poll p50 {percentile(full, 50):.1f} ms, p99 {percentile(full, 99):.1f} ms")
+        print(f"✓ 304 revalidation p50 {percentile([ms for _, ms in revalidated], 50):.1f} ms")
+
+        # A status change has to reach the next poll, not the cached body or a 304 for the old ETag
+        response = requests.put(f"{BASE_URL}/api/jobs/{job['id']}/status", headers=self.headers,
+                                json={"status": "in_progress", "notes": "TEST_ tracking poll"})
+        assert response.status_code == 200
+        changed = requests.get(url, headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["ETag"] != etag
+        assert changed.json()["status"] == "in_progress" != first.json()["status"]
+
+        # So does renaming the shop, whose name is part of every cached tracking body
+        settings_url = f"{BASE_URL}/api/tenants/settings"
+        company_name = changed.json()["company_name"]
+        response = requests.put(settings_url, headers=self.headers, json={"company_name": "TEST_Perf Renamed"})
+        assert response.status_code == 200
+        try:
+            renamed = requests.get(url, headers={"If-None-Match": changed.headers["ETag"]})
+            assert renamed.status_code == 200
+            assert renamed.json()["company_name"] == "TEST_Perf Renamed"
+        finally:
+            requests.put(settings_url, headers=self.headers, json={"company_name": company_name})
+
+
+BRUTE_FORCE_SIZE = int(os.environ.get('BRUTE_FORCE_SIZE', 500))
+BRUTE_FORCE_HEALTH_P99_BUDGET_MS = float(os.environ.get('BRUTE_FORCE_HEALTH_P99_BUDGET_MS', 200))
+
+
+class TestRateLimiting:
+    """A client guessing tracking tokens is cut off with 429s, which are cheap enough to keep the API responsive"""
+
+    def test_tracking_token_brute_force(self):
+        def guess(index):
+            response, ms = timed("GET", f"{BASE_URL}/api/public/track/JOB-2026-000001/TEST{index:04d}")
+            return response.status_code, response.headers.get("Retry-After"), ms
+
+        during = []
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            guesses = [pool.submit(guess, i) for i in range(BRUTE_FORCE_SIZE)]
+            while not all(f.done() for f in guesses):
+                during.append(timed("GET", f"{BASE_URL}/api/health")[1])
+            results = [f.result() for f in guesses]
+
+        statuses = [code for code, _, _ in results]
+        rejected = [ms for code, _, ms in results if code == 429]
+        assert set(statuses) <= {404, 429}, f"Unexpected tracking statuses: {set(statuses)}"
+        assert rejected, "No guesses were rate limited"
+        assert all(retry for code, retry, _ in results if code == 429)
+
+        print(f"✓ {statuses.count(404)} guesses reached the database, {len(rejected)} rejected (p50 {percentile(rejected, 50):.1f} ms)")
+        if during:
+            print(f"✓ /api/health p99 during the brute force: {percentile(during, 99):.1f} ms ({len(during)} samples)")
+            assert percentile(during, 99) < BRUTE_FORCE_HEALTH_P99_BUDGET_MS
+
+    def test_login_brute_force_is_per_account(self):
+        # An address with no account, so the guesses never lock out the shop's real admin
+        target = {**TEST_SHOP, "email": "bruteforce@test.example.com", "password": "wrong"}
+        statuses = [requests.post(f"{BASE_URL}/api/auth/login", json=target).status_code for _ in range(40)]
+        assert set(statuses) <= {401, 429}, f"Unexpected login statuses: {set(statuses)}"
+        assert 429 in statuses, "No guesses were rate limited"
+
+        # The same client can still sign in to a different account
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=TEST_SHOP)
+        assert response.status_code == 200
+        print(f"✓ {statuses.count(401)} wrong passwords checked before the account's budget ran out")
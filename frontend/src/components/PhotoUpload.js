@@ -158,7 +158,8 @@ export default function PhotoUpload({ jobId, photos = [], onPhotoChange }) {
                       data-testid={`photo-${photo.id}`}
                     >
                       <img
-                        src={`${BACKEND_URL}${photo.url}`}
+                        src={`${BACKEND_URL}${photo.variants?.thumb || photo.url}`}
+                        loading="lazy"
                         alt={`${type.label}`}
                         className="w-full h-full object-cover"
                         onError={(e) => {